@@ -0,0 +1,123 @@
+"""
+Допуск сообщений к дорогой части обработки (LLM) с ограниченной очередью.
+
+aiogram запускает каждый апдейт отдельной задачей без лимита. Во время
+рейда сотни handle_message ждут LLM разом — растут память и задержка.
+Контроллер держит не больше max_active сообщений в LLM-стадии и не больше
+max_queue в ожидании; ждать можно не дольше max_wait. Кто не допущен —
+сразу получает отказ (shed), и обработчик применяет политику перегрузки
+(см. main._overload_verdict). Так задержка ограничена max_wait, а не
+длиной очереди.
+
+Быстрые пути (доверенные, fingerprint, спам-базы) идут до контроллера и
+под нагрузкой не страдают.
+"""
+import asyncio
+import time
+
+from metrics import LatencyWindow
+
+
+class AdmissionController:
+    def __init__(self, max_active: int = 16, max_queue: int = 64, max_wait: float = 10.0,
+                 clock=time.monotonic):
+        self.max_active = max_active  # <= 0 — без ограничений
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self._clock = clock
+        self._cond: asyncio.Condition | None = None
+        self._cond_loop = None
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.shed_no_wait = 0
+        self.wait_time = LatencyWindow()
+        self.depth = LatencyWindow()  # глубина очереди в момент прихода
+
+    def _condition(self) -> asyncio.Condition:
+        # Как в LLMScheduler: Condition привязан к event loop, а контроллер
+        # создаётся на импорте модуля
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._cond_loop is not loop:
+            self._cond = asyncio.Condition()
+            self._cond_loop = loop
+        return self._cond
+
+    def _has_slot(self) -> bool:
+        return self.max_active <= 0 or self.active < self.max_active
+
+    @property
+    def overloaded(self) -> bool:
+        return self.queued > 0 or not self._has_slot()
+
+    async def acquire(self, max_wait: float | None = None) -> bool:
+        """Занять слот. False — отказ: очередь полна или ожидание истекло.
+
+        max_wait=0 — только свободный слот прямо сейчас, без очереди.
+        """
+        self.depth.add(self.queued)
+        if self._has_slot() and not self.queued:
+            self.active += 1
+            self.admitted += 1
+            self.wait_time.add(0.0)
+            return True
+        max_wait = self.max_wait if max_wait is None else max_wait
+        if max_wait <= 0:
+            self.shed_no_wait += 1
+            return False
+        if self.queued >= self.max_queue:
+            self.shed_queue_full += 1
+            return False
+
+        enqueued = self._clock()
+        deadline = enqueued + max_wait
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            cond = self._condition()
+            async with cond:
+                while not self._has_slot():
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        self.shed_timeout += 1
+                        return False
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self.active += 1
+        finally:
+            self.queued -= 1
+        self.admitted += 1
+        self.wait_time.add(self._clock() - enqueued)
+        return True
+
+    async def release(self):
+        self.active -= 1  # до await: слот освобождается даже при отмене
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    @property
+    def shed(self) -> int:
+        return self.shed_queue_full + self.shed_timeout + self.shed_no_wait
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "max_queued": self.max_queued,
+            "depth_p95": self.depth.percentile(95),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout,
+            "shed_no_wait": self.shed_no_wait,
+            "wait_p50": self.wait_time.percentile(50),
+            "wait_p95": self.wait_time.percentile(95),
+        }
@@ -0,0 +1,153 @@
+"""
+Micro-batching: копим однотипные запросы несколько десятков миллисекунд
+и отправляем одним вызовом.
+
+MicroBatcher не знает ничего про LLM — он группирует элементы по ключу
+(например, по system prompt: в один батч можно сложить только запросы
+с одинаковым префиксом), а отправку делает переданная функция run_batch.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Собирает элементы в батчи по group_key.
+
+    run_batch(group_key, items) -> list — результаты в порядке items;
+    элемент-исключение передаётся ожидающему как ошибка.
+    Батч уходит, когда набралось max_size элементов или прошло max_wait
+    секунд с момента прихода первого.
+    """
+
+    def __init__(self, run_batch, max_size: int = 8, max_wait: float = 0.04):
+        self._run_batch = run_batch
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._pending: dict = {}  # group_key -> [(item, future), ...]
+        self._timers: dict = {}   # group_key -> asyncio.TimerHandle
+        self._tasks: set = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, group_key, item):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        bucket = self._pending.setdefault(group_key, [])
+        bucket.append((item, fut))
+        if len(bucket) >= self.max_size:
+            self._flush(group_key)
+        elif group_key not in self._timers:
+            self._timers[group_key] = loop.call_later(self.max_wait, self._flush, group_key)
+        return await fut
+
+    def _flush(self, group_key):
+        timer = self._timers.pop(group_key, None)
+        if timer:
+            timer.cancel()
+        bucket = self._pending.pop(group_key, [])
+        if not bucket:
+            return
+        task = asyncio.ensure_future(self._dispatch(group_key, bucket))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, group_key, bucket):
+        self.batches += 1
+        self.items += len(bucket)
+        items = [item for item, _ in bucket]
+        try:
+            results = await self._run_batch(group_key, items)
+        except Exception as e:
+            results = [e] * len(bucket)
+        if len(results) != len(bucket):
+            logger.error(f"run_batch вернул {len(results)} результатов на {len(bucket)} элементов")
+            results = [RuntimeError("batch result size mismatch")] * len(bucket)
+        for (_, fut), res in zip(bucket, results):
+            if fut.done():
+                continue  # ожидающий уже отменён
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+    @property
+    def avg_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+
+class BurstCoalescer:
+    """Склеивает серию быстрых элементов с одним ключом в один вызов.
+
+    В отличие от MicroBatcher окно скользящее: каждый новый элемент
+    продлевает его на window секунд тишины, но не дальше max_wait от первого
+    элемента — добавленная задержка ограничена. Серия уходит и по max_items.
+
+    run(key, items) -> результат, общий для всех элементов серии. Каждый
+    ожидающий получает (результат, burst), где burst — общий для серии dict:
+    {"size": n, "items": [элементы серии по порядку], "claimed": set()}
+    (см. main._burst_claim).
+    """
+
+    def __init__(self, run, window: float = 1.5, max_wait: float = 4.0, max_items: int = 5):
+        self._run = run
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.max_items = max(1, max_items)
+        self._pending: dict = {}  # key -> {"items", "futures", "first_at", "timer"}
+        self._tasks: set = set()
+        self.bursts = 0
+        self.items = 0
+        self.coalesced_bursts = 0  # серий из 2+ элементов
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        now = loop.time()
+        bucket = self._pending.get(key)
+        if bucket is None:
+            bucket = self._pending[key] = {"items": [], "futures": [], "first_at": now, "timer": None}
+        bucket["items"].append(item)
+        bucket["futures"].append(fut)
+        if bucket["timer"]:
+            bucket["timer"].cancel()
+        if len(bucket["items"]) >= self.max_items:
+            self._flush(key)
+        else:
+            delay = min(now + self.window, bucket["first_at"] + self.max_wait) - now
+            bucket["timer"] = loop.call_later(max(0.0, delay), self._flush, key)
+        return await fut
+
+    def _flush(self, key):
+        bucket = self._pending.pop(key, None)
+        if not bucket:
+            return
+        if bucket["timer"]:
+            bucket["timer"].cancel()
+        task = asyncio.ensure_future(self._dispatch(key, bucket))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, key, bucket):
+        items, futures = bucket["items"], bucket["futures"]
+        self.bursts += 1
+        self.items += len(items)
+        if len(items) > 1:
+            self.coalesced_bursts += 1
+        burst = {"size": len(items), "items": list(items), "claimed": set()}
+        try:
+            result, error = await self._run(key, items), None
+        except Exception as e:
+            result, error = None, e
+        for fut in futures:
+            if fut.done():
+                continue  # ожидающий уже отменён
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result((result, burst))
+
+    @property
+    def avg_burst_size(self) -> float:
+        return self.items / self.bursts if self.bursts else 0.0
@@ -0,0 +1,146 @@
+"""
+Ограниченные in-memory кеши для горячего пути модерации.
+
+TTLCache — LRU + TTL: старые записи вытесняются по размеру, протухшие —
+по времени. Считает попадания/промахи, чтобы было видно, окупается ли кеш.
+
+SingleFlight — дедупликация одновременных одинаковых вызовов: пока первый
+вызов по ключу в полёте, остальные ждут его результат, а не делают свой.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU-кеш с ограничением по размеру и времени жизни записей.
+
+    maxsize  — сколько записей держать (самые давно использованные вытесняются)
+    ttl      — сколько секунд запись считается свежей (None = бессрочно)
+    on_evict — вызывается как on_evict(key, value) для вытесненной или протухшей записи
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None, clock=time.monotonic, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, self._MISSING)
+        if entry is self._MISSING:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._data[key]
+            self.misses += 1
+            if self._on_evict is not None:
+                self._on_evict(key, value)
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float | None = _MISSING):
+        ttl = self.ttl if ttl is self._MISSING else ttl
+        expires_at = self._clock() + ttl if ttl is not None else None
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = (expires_at, value)
+        while len(self._data) > self.maxsize:
+            old_key, (_, old_value) = self._data.popitem(last=False)
+            self.evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, self._MISSING)
+        if entry is self._MISSING:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key, self._MISSING)
+        if entry is self._MISSING:
+            return False
+        expires_at, _ = entry
+        return expires_at is None or expires_at > self._clock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hit_ratio,
+        }
+
+
+class SingleFlight:
+    """In-flight дедупликация корутин по ключу (singleflight).
+
+    Первый вызов do(key, fn) становится «ведущим» и выполняет fn();
+    одновременные вызовы с тем же ключом ждут его результат (или исключение).
+    Если ведущий отменён — ждущие выполняют fn() сами, а не падают вместе с ним.
+    После завершения ключ освобождается: кешированием занимается TTLCache.
+    """
+
+    def __init__(self):
+        self._calls: dict = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        fut = self._calls.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise  # отменили нас самих, а не ведущего
+                return await fn()
+
+        fut = asyncio.get_running_loop().create_future()
+        self._calls[key] = fut
+        self.leaders += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как полученное — ждущих может не быть
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            self._calls.pop(key, None)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": self.in_flight}
@@ -0,0 +1,98 @@
+"""
+Circuit breaker для LLM-провайдера.
+
+closed → (failure_threshold ошибок провайдера подряд) → open → (прошло
+open_seconds) → пробный вызов → closed при успехе, open с удвоенной паузой
+(до max_open_seconds) при неудаче.
+
+Пока breaker открыт, вызовы не ждут таймаутов провайдера — allow() сразу
+возвращает False, и бот работает в деградированном режиме. Пробу делает
+фоновая задача (см. main.degraded_mode_loop), а не сообщения пользователей.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+
+
+class CircuitOpenError(Exception):
+    """LLM-вызов отклонён без обращения к провайдеру: breaker открыт."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        open_seconds: float = 30.0,
+        max_open_seconds: float = 300.0,
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max(open_seconds, max_open_seconds)
+        self._clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.retry_at = 0.0
+        self._pause = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.probes = 0
+        self.last_error = ""
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        self.rejected += 1
+        return False
+
+    def probe_due(self) -> bool:
+        return self.state == OPEN and self._clock() >= self.retry_at
+
+    def record_success(self, probe: bool = False):
+        self.consecutive_failures = 0
+        # Открытый breaker закрывает только проба: успех вызова, начатого до
+        # открытия, не говорит, что провайдер поднялся
+        if self.state == OPEN and probe:
+            logger.info(f"LLM circuit breaker закрыт после {self._clock() - self.opened_at:.0f}s")
+            self.state = CLOSED
+            self._pause = 0.0
+
+    def record_failure(self, exc: BaseException):
+        self.consecutive_failures += 1
+        self.last_error = f"{type(exc).__name__}: {str(exc)[:100]}"
+        now = self._clock()
+        if self.state == OPEN:
+            if now < self.retry_at:
+                return  # вызовы, начатые до открытия, паузу не продлевают
+            # Неудачная проба — пауза удваивается
+            self._pause = min(self.max_open_seconds, self._pause * 2)
+            self.retry_at = now + self._pause
+        elif self.consecutive_failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = now
+            self._pause = self.open_seconds
+            self.retry_at = now + self._pause
+            self.trips += 1
+            logger.warning(f"LLM circuit breaker открыт: {self.consecutive_failures} ошибок подряд ({self.last_error})")
+
+    def stats(self) -> dict:
+        now = self._clock()
+        return {
+            "state": self.state,
+            "open_for": now - self.opened_at if self.state == OPEN else 0.0,
+            "next_probe_in": max(0.0, self.retry_at - now) if self.state == OPEN else 0.0,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "probes": self.probes,
+            "last_error": self.last_error,
+        }
@@ -59,12 +59,203 @@ LLM_TEMPERATURE = 0
 LLM_TIMEOUT = int(os.getenv("LLM_TIMEOUT", "20"))
 # reasoning_effort для классификации: low = быстро и дёшево, точности хватает
 LLM_REASONING_EFFORT = os.getenv("LLM_REASONING_EFFORT", "low")
+# Micro-batching классификации: сообщения, пришедшие в пределах
+# LLM_BATCH_MAX_WAIT_MS, уходят одним запросом (system prompt + few-shot
+# оплачиваются один раз на батч). Выключено по умолчанию.
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "8"))
+LLM_BATCH_MAX_WAIT_MS = int(os.getenv("LLM_BATCH_MAX_WAIT_MS", "40"))
+# Планировщик LLM-вызовов (общий для классификации, Vision, профилей, оценки
+# промпта): окно параллельности растёт на успехах и сужается вдвое на 429,
+# Retry-After выдерживается для всех. LLM_TOKENS_PER_MINUTE=0 — без бюджета.
+LLM_CONCURRENCY_INITIAL = int(os.getenv("LLM_CONCURRENCY_INITIAL", "4"))
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "16"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "2"))
+# Доля окна параллельности и минутного бюджета, зарезервированная за живой
+# модерацией: оценка и генерация промптов её не занимают и стартуют, только
+# когда живые вызовы не ждут в очереди
+LLM_LIVE_RESERVE = float(os.getenv("LLM_LIVE_RESERVE", "0.25"))
+# Hedging классификации: если модель не ответила за LLM_HEDGE_PERCENTILE-й
+# перцентиль своих задержек (не раньше LLM_HEDGE_MIN_DELAY_MS), параллельно
+# уходит второй запрос — к следующему рабочему кандидату из LLM_MODEL_CANDIDATES
+# (или к LLM_HEDGE_MODEL); берётся первый ответ, второй отменяется.
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY_MS = int(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "1500"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "")
+
+# Каскад: сначала дешёвая nano-модель; на основную (mini) уходят только
+# MAYBE_SPAM, ответы с уверенностью ниже LLM_CASCADE_MIN_CONFIDENCE и сообщения
+# с сигналами риска. Доля LLM_CASCADE_AUDIT_RATE принятых nano-вердиктов
+# в фоне перепроверяется основной моделью — чтобы видеть цену экономии.
+LLM_CASCADE_ENABLED = os.getenv("LLM_CASCADE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_FAST_MODEL_CANDIDATES = [
+    "gpt-5.5-nano", "gpt-5.4-nano", "gpt-5-nano", "gpt-4.1-nano", "gpt-4o-mini",
+]
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "")
+LLM_CASCADE_MIN_CONFIDENCE = float(os.getenv("LLM_CASCADE_MIN_CONFIDENCE", "0.8"))
+LLM_CASCADE_AUDIT_RATE = float(os.getenv("LLM_CASCADE_AUDIT_RATE", "0.05"))
+
+# Горячий путь отвечает только вердиктом (без reasoning в JSON): объяснение
+# нужно лишь в отчётах админу (СПАМ / ВОЗМОЖНО_СПАМ) и запрашивается
+# отдельным коротким вызовом при отправке отчёта.
+LLM_VERDICT_ONLY = os.getenv("LLM_VERDICT_ONLY", "true").lower() in ("1", "true", "yes")
+
+# Бюджет на вызов по дешёвым признакам сообщения (длина, ссылки, упоминания,
+# смесь алфавитов, сигналы риска, история пользователя): простые реплики —
+# меньше токенов, сложные — больше reasoning. Исчерпание бюджета
+# (finish_reason=length или пустой ответ) → один повтор с удвоенным лимитом.
+LLM_EFFORT_SIMPLE = os.getenv("LLM_EFFORT_SIMPLE", LLM_REASONING_EFFORT)
+LLM_EFFORT_COMPLEX = os.getenv("LLM_EFFORT_COMPLEX", "medium")
+LLM_MAX_TOKENS_SIMPLE = int(os.getenv("LLM_MAX_TOKENS_SIMPLE", "300"))
+LLM_MAX_TOKENS_COMPLEX = int(os.getenv("LLM_MAX_TOKENS_COMPLEX", "1200"))
+LLM_MAX_TOKENS_RETRY_CAP = int(os.getenv("LLM_MAX_TOKENS_RETRY_CAP", "2400"))
+
+# Потоковая классификация: вердикт берётся из JSON, как только поле result
+# дописано, reasoning догружается в фоне к отчёту админу. Имеет смысл только
+# с полной схемой (LLM_VERDICT_ONLY=false) — иначе после вердикта стримить нечего.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() in ("1", "true", "yes")
+
+# Несколько OpenAI-совместимых эндпоинтов (провайдеры / ключи) с балансировкой
+# и выводом из ротации по здоровью. JSON-список, например:
+# [{"name": "openai-1", "api_key_env": "OPENAI_KEY_1", "weight": 2},
+#  {"name": "gemini", "base_url": "https://generativelanguage.googleapis.com/v1beta/openai/",
+#   "api_key_env": "GEMINI_KEY", "model": "gemini-2.5-flash"}]
+# "model" заменяет только основную модель классификации; другие модели
+# сопоставляются явно: "models": {"gpt-5-nano": "gemini-2.5-flash-lite"}.
+# Пусто — один клиент из LLM_BASE_URL / LLM_API_KEY, как раньше.
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+LLM_ENDPOINT_FAILURE_THRESHOLD = int(os.getenv("LLM_ENDPOINT_FAILURE_THRESHOLD", "3"))
+LLM_ENDPOINT_COOLDOWN_SECONDS = int(os.getenv("LLM_ENDPOINT_COOLDOWN_SECONDS", "30"))
+
+# Circuit breaker: после LLM_BREAKER_FAILURES ошибок провайдера подряд бот
+# перестаёт ходить в LLM и модерирует по fingerprint, спам-базам и сигналам
+# риска; фоновая проба раз в LLM_BREAKER_OPEN_SECONDS (удваивается до MAX).
+# Сообщения без сигналов риска в этом режиме копятся в дайджест админу
+# (раз в LLM_DEGRADED_DIGEST_SECONDS) и перепроверяются LLM после восстановления.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_OPEN_SECONDS = int(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+LLM_BREAKER_MAX_OPEN_SECONDS = int(os.getenv("LLM_BREAKER_MAX_OPEN_SECONDS", "300"))
+LLM_DEGRADED_DIGEST_SECONDS = int(os.getenv("LLM_DEGRADED_DIGEST_SECONDS", "600"))
+
+# Локальный классификатор (n-граммы + наивный Байес) перед LLM.
+# off — выключен; shadow — только логирует решения и сверяет с LLM;
+# on — уверенные вердикты без LLM. Пороги калибруются на отложенной выборке
+# под целевые доли ложных срабатываний (FPR) и пропусков спама (FNR).
+LOCAL_CLASSIFIER_MODE = os.getenv("LOCAL_CLASSIFIER_MODE", "shadow").lower()
+LOCAL_CLASSIFIER_TARGET_FPR = float(os.getenv("LOCAL_CLASSIFIER_TARGET_FPR", "0.005"))
+LOCAL_CLASSIFIER_TARGET_FNR = float(os.getenv("LOCAL_CLASSIFIER_TARGET_FNR", "0.02"))
+LOCAL_CLASSIFIER_MIN_PER_CLASS = int(os.getenv("LOCAL_CLASSIFIER_MIN_PER_CLASS", "50"))
 
 # Rate limiting
 MAX_REQUESTS_PER_MINUTE = 5
 
+# Кеш вердиктов LLM по нормализованному тексту («спасибо», «+», «привет всем»
+# приходят сотни раз с одинаковым ответом). Ключ включает хеш промпта и
+# few-shot блока — при их смене старые записи просто перестают совпадать.
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "2000"))
+VERDICT_CACHE_TTL_SECONDS = int(os.getenv("VERDICT_CACHE_TTL_SECONDS", "21600"))
+
+# Репутация источников пересылок (канал/чат/пользователь, откуда переслано).
+# Плохой источник → бан без LLM; чистый → forward не считается сигналом риска.
+FORWARD_REPUTATION_SIZE = int(os.getenv("FORWARD_REPUTATION_SIZE", "5000"))
+FORWARD_REPUTATION_TTL_SECONDS = int(os.getenv("FORWARD_REPUTATION_TTL_SECONDS", "604800"))
+# Сколько вердиктов LLM нужно, чтобы считать источник плохим/чистым
+# (решение админа действует сразу)
+FORWARD_BAD_AFTER_SPAM = int(os.getenv("FORWARD_BAD_AFTER_SPAM", "2"))
+FORWARD_CLEAN_AFTER = int(os.getenv("FORWARD_CLEAN_AFTER", "3"))
+
+# Буфер недавних сообщений: правки и кнопки админа почти всегда касаются
+# сообщений последних минут — читаем их из памяти, БД только как fallback
+RECENT_MESSAGES_SIZE = int(os.getenv("RECENT_MESSAGES_SIZE", "5000"))
+RECENT_MESSAGES_TTL_SECONDS = int(os.getenv("RECENT_MESSAGES_TTL_SECONDS", "86400"))
+
+# Предзагрузка сигналов риска при входе в группу (базы спамеров, профиль,
+# описание канала, LLM-вердикт по профилю) — первое сообщение новичка
+# находит их готовыми. TTL короткий: профиль могут поменять.
+JOIN_PREFETCH_SIZE = int(os.getenv("JOIN_PREFETCH_SIZE", "2000"))
+JOIN_PREFETCH_TTL_SECONDS = int(os.getenv("JOIN_PREFETCH_TTL_SECONDS", "600"))
+
+# Дедупликация апдейтов: повторная доставка (перезапуск polling, сетевые
+# повторы) отбрасывается до обработчиков. Окно в памяти + таблица
+# processed_updates, которая переживает перезапуск; отметки старше
+# DEDUP_RETENTION_HOURS удаляются (Telegram хранит апдейты до суток).
+DEDUP_WINDOW_SIZE = int(os.getenv("DEDUP_WINDOW_SIZE", "20000"))
+DEDUP_WINDOW_TTL_SECONDS = int(os.getenv("DEDUP_WINDOW_TTL_SECONDS", "86400"))
+DEDUP_PERSISTENT = os.getenv("DEDUP_PERSISTENT", "true").lower() in ("1", "true", "yes")
+DEDUP_RETENTION_HOURS = int(os.getenv("DEDUP_RETENTION_HOURS", "48"))
+
 # Few-shot: сколько примеров из training_examples подставлять в контекст
 FEW_SHOT_EXAMPLES_COUNT = 10
+# Бюджеты в токенах (считаются локально, tiktoken если установлен):
+# пример few-shot не длиннее FEW_SHOT_EXAMPLE_MAX_TOKENS, весь блок —
+# не больше FEW_SHOT_TOKEN_BUDGET (лишние старые примеры отбрасываются)
+FEW_SHOT_TOKEN_BUDGET = int(os.getenv("FEW_SHOT_TOKEN_BUDGET", "600"))
+FEW_SHOT_EXAMPLE_MAX_TOKENS = int(os.getenv("FEW_SHOT_EXAMPLE_MAX_TOKENS", "40"))
+# Текст сообщения для LLM: длиннее — остаются начало, конец, все ссылки и упоминания
+LLM_MESSAGE_TOKEN_BUDGET = int(os.getenv("LLM_MESSAGE_TOKEN_BUDGET", "700"))
+# Блок few-shot живёт «поколениями»: новый пример не перестраивает его сразу,
+# а не чаще раза в N секунд. Пока поколение не сменилось, system prompt
+# побайтно тот же — и prefix-кеш провайдера попадает.
+FEW_SHOT_REFRESH_SECONDS = int(os.getenv("FEW_SHOT_REFRESH_SECONDS", "3600"))
+# static — общий блок последних примеров в system prompt (как раньше);
+# retrieval — system prompt без примеров, а в user prompt к каждому сообщению
+# k самых похожих размеченных примеров из локального индекса.
+# Сравнение режимов по точности и задержке — /fewshotbench
+FEW_SHOT_MODE = os.getenv("FEW_SHOT_MODE", "static").lower()
+FEW_SHOT_RETRIEVAL_K = int(os.getenv("FEW_SHOT_RETRIEVAL_K", "6"))
+FEW_SHOT_RETRIEVAL_MIN_SCORE = float(os.getenv("FEW_SHOT_RETRIEVAL_MIN_SCORE", "0.1"))
+
+# Сбор сигналов риска в handle_message: спам-базы, профиль и фото стартуют
+# одновременно; дольше SIGNAL_TIMEOUT_SECONDS от начала сбора не ждём никого.
+# Профиль ждём для контекста LLM не дольше PROFILE_CONTEXT_WAIT_SECONDS —
+# опоздавший сигнал профиля учитывается уже только в эскалации.
+SIGNAL_TIMEOUT_SECONDS = float(os.getenv("SIGNAL_TIMEOUT_SECONDS", "4"))
+PROFILE_CONTEXT_WAIT_SECONDS = float(os.getenv("PROFILE_CONTEXT_WAIT_SECONDS", "1.5"))
+
+# Конвейер модерации (pipeline.py): порядок дешёвых стадий до LLM.
+# PIPELINE_ORDER — явный порядок через запятую (fingerprint,forward_reputation,spam_db);
+# пусто — по объявленной стоимости. PIPELINE_ADAPTIVE=true — порядок по
+# замеренной экономии: доля срабатываний на миллисекунду задержки стадии,
+# после PIPELINE_ADAPTIVE_MIN_RUNS запусков стадии.
+PIPELINE_ORDER = [s.strip() for s in os.getenv("PIPELINE_ORDER", "").split(",") if s.strip()]
+PIPELINE_ADAPTIVE = os.getenv("PIPELINE_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+PIPELINE_ADAPTIVE_MIN_RUNS = int(os.getenv("PIPELINE_ADAPTIVE_MIN_RUNS", "200"))
+
+# Допуск к LLM-стадии под нагрузкой (admission.py): одновременно не больше
+# ADMISSION_MAX_ACTIVE сообщений, в очереди не больше ADMISSION_MAX_QUEUE,
+# ожидание не дольше ADMISSION_MAX_WAIT_SECONDS. Не допущенные сообщения
+# решаются по спам-базам и сигналам риска, а LLM-проверка откладывается
+# (до ADMISSION_DEFERRED_MAX сообщений) до спада нагрузки.
+# ADMISSION_MAX_ACTIVE=0 — без ограничений.
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "16"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "10"))
+ADMISSION_DEFERRED_MAX = int(os.getenv("ADMISSION_DEFERRED_MAX", "500"))
+
+# Серии сообщений: спам-боты режут рекламу на 3–5 быстрых сообщений, и
+# первые части выглядят безобидно. Текстовые сообщения непроверенного
+# пользователя, пришедшие с паузой меньше BURST_WINDOW_MS, классифицируются
+# одним LLM-вызовом, вердикт — на всю серию. Цена — задержка каждого такого
+# сообщения: не меньше BURST_WINDOW_MS (ждём продолжения) и не больше
+# BURST_MAX_WAIT_MS от первого. По умолчанию выключено (0); включать, если
+# в группах встречается нарезанный спам, например BURST_WINDOW_MS=1500.
+BURST_WINDOW_MS = int(os.getenv("BURST_WINDOW_MS", "0"))
+BURST_MAX_WAIT_MS = int(os.getenv("BURST_MAX_WAIT_MS", "4000"))
+BURST_MAX_MESSAGES = int(os.getenv("BURST_MAX_MESSAGES", "5"))
+
+# Риск-скор по сигналам (risk_scorer.py): веса подбираются по истории (/riskfit).
+# shadow — только сверяет решения с итоговым вердиктом; on — уверенные
+# решения (бан / пропуск) принимаются до LLM; off — выключен. Пороги
+# калибруются так, чтобы бан задел не больше RISK_SCORER_TARGET_FPR чистых
+# сообщений, а пропуск — не больше RISK_SCORER_TARGET_FNR спама.
+RISK_SCORER_MODE = os.getenv("RISK_SCORER_MODE", "shadow").lower()
+RISK_SCORER_TARGET_FPR = float(os.getenv("RISK_SCORER_TARGET_FPR", "0.002"))
+RISK_SCORER_TARGET_FNR = float(os.getenv("RISK_SCORER_TARGET_FNR", "0.01"))
+RISK_SCORER_MIN_PER_CLASS = int(os.getenv("RISK_SCORER_MIN_PER_CLASS", "30"))
 
 # Combot Anti-Spam (CAS) — бесплатная база спамеров
 CAS_API_URL = "https://api.cas.chat/check"
@@ -3,7 +3,7 @@
 Единая точка доступа — все запросы идут через execute_query().
 """
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 from config import DATABASE_URL, DATABASE_PATH
 import logging
 
@@ -73,7 +73,8 @@ CREATE TABLE IF NOT EXISTS messages (
     llm_result TEXT,
     reasoning TEXT,
     admin_decision TEXT,
-    admin_decided_at TIMESTAMP
+    admin_decided_at TIMESTAMP,
+    risk_features TEXT
 );
 
 CREATE INDEX IF NOT EXISTS idx_messages_user_chat_time
@@ -117,6 +118,13 @@ CREATE TABLE IF NOT EXISTS banned_profiles (
 );
 
 CREATE INDEX IF NOT EXISTS idx_banned_profiles_time ON banned_profiles (banned_at);
+
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_key TEXT PRIMARY KEY,
+    processed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates (processed_at);
 """
 
 _SCHEMA_POSTGRES = """
@@ -131,7 +139,8 @@ CREATE TABLE IF NOT EXISTS messages (
     llm_result TEXT,
     reasoning TEXT,
     admin_decision TEXT,
-    admin_decided_at TIMESTAMP
+    admin_decided_at TIMESTAMP,
+    risk_features TEXT
 );
 
 CREATE INDEX IF NOT EXISTS idx_messages_user_chat_time
@@ -175,6 +184,13 @@ CREATE TABLE IF NOT EXISTS banned_profiles (
 );
 
 CREATE INDEX IF NOT EXISTS idx_banned_profiles_time ON banned_profiles (banned_at);
+
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_key TEXT PRIMARY KEY,
+    processed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates (processed_at);
 """
 
 DEFAULT_PROMPT = """Ты антиспам-классификатор для русскоязычных Telegram-групп.
@@ -266,6 +282,17 @@ def init_database():
         except Exception:
             conn.rollback()
 
+    # Миграция: добавить колонку risk_features (сигналы риска для риск-скора)
+    try:
+        cursor.execute("SELECT risk_features FROM messages LIMIT 1")
+    except Exception:
+        conn.rollback()
+        try:
+            cursor.execute("ALTER TABLE messages ADD COLUMN risk_features TEXT")
+            logger.info("Добавлена колонка risk_features в messages")
+        except Exception:
+            conn.rollback()
+
     # Миграция: добавить колонку spam_type в training_examples
     try:
         cursor.execute("SELECT spam_type FROM training_examples LIMIT 1")
@@ -459,6 +486,83 @@ def update_message_after_edit(message_id: int, text: str, llm_result: str, reaso
     )
 
 
+def update_message_reasoning(message_id: int, chat_id: int, reasoning: str):
+    """Дописать объяснение вердикта, полученное после сохранения (verdict-only режим)."""
+    execute_query(
+        "UPDATE messages SET reasoning = ? WHERE message_id = ? AND chat_id = ?",
+        (reasoning, message_id, chat_id)
+    )
+
+
+def get_risk_features(message_id: int, chat_id: int) -> str | None:
+    row = execute_query(
+        "SELECT risk_features FROM messages WHERE message_id = ? AND chat_id = ?",
+        (message_id, chat_id), fetch='one'
+    )
+    return row[0] if row else None
+
+
+def set_risk_features(message_id: int, chat_id: int, features_json: str):
+    """Сигналы риска сообщения (JSON) — обучающие данные для риск-скора."""
+    execute_query(
+        "UPDATE messages SET risk_features = ? WHERE message_id = ? AND chat_id = ?",
+        (features_json, message_id, chat_id)
+    )
+
+
+def _exclude_reasoning_sql(exclude_reasoning) -> tuple[str, tuple]:
+    """Условие «вердикт бота без решения админа, reasoning содержит одну из строк» — исключить.
+
+    exclude_reasoning — строка или кортеж строк; возвращает (SQL, параметры).
+    """
+    if not exclude_reasoning:
+        return "", ()
+    patterns = (exclude_reasoning,) if isinstance(exclude_reasoning, str) else tuple(exclude_reasoning)
+    likes = " OR ".join(["COALESCE(reasoning, '') LIKE ?"] * len(patterns))
+    return f"AND NOT (admin_decision IS NULL AND ({likes}))", tuple(f"%{p}%" for p in patterns)
+
+
+def get_risk_dataset(limit: int = 5000, exclude_reasoning=None):
+    """[(risk_features, is_spam, by_admin), ...] — метки по тем же правилам, что get_validation_dataset."""
+    exclude_sql, params = _exclude_reasoning_sql(exclude_reasoning)
+    rows = execute_query(
+        f"""SELECT risk_features, llm_result, admin_decision FROM messages
+           WHERE risk_features IS NOT NULL
+             AND NOT (admin_decision IS NULL AND (llm_result = 'ВОЗМОЖНО_СПАМ' OR llm_result IS NULL))
+             {exclude_sql}
+           ORDER BY created_at DESC LIMIT ?""",
+        params + (limit,), fetch='all'
+    ) or []
+    result = []
+    for features, llm_result, admin_decision in rows:
+        decision = admin_decision or llm_result
+        if decision in ('СПАМ', 'НЕ_СПАМ'):
+            result.append((features, decision == 'СПАМ', admin_decision is not None))
+    return result
+
+
+def get_labeled_messages(limit: int = 20000):
+    """[(text, risk_features, is_spam, by_admin), ...] — сообщения с меткой по правилам get_risk_dataset.
+
+    Кто вынес вердикт бота — в risk_features ("by"); без risk_features это
+    неизвестно, такие строки годятся только с решением админа.
+    """
+    rows = execute_query(
+        """SELECT text, risk_features, llm_result, admin_decision FROM messages
+           WHERE text IS NOT NULL AND LENGTH(text) > 5
+             AND (admin_decision IS NOT NULL OR risk_features IS NOT NULL)
+             AND NOT (admin_decision IS NULL AND (llm_result = 'ВОЗМОЖНО_СПАМ' OR llm_result IS NULL))
+           ORDER BY created_at DESC LIMIT ?""",
+        (limit,), fetch='all'
+    ) or []
+    result = []
+    for text, features, llm_result, admin_decision in rows:
+        decision = admin_decision or llm_result
+        if decision in ('СПАМ', 'НЕ_СПАМ'):
+            result.append((text, features, decision == 'СПАМ', admin_decision is not None))
+    return result
+
+
 def get_user_messages(user_id: int, limit=100):
     """Получить все message_id и chat_id сообщений пользователя (для удаления)."""
     return execute_query(
@@ -653,6 +757,34 @@ def get_meta(key: str) -> str | None:
     return None
 
 
+# ──────────────────────────────────────────────
+# Обработанные апдейты (идемпотентность при повторной доставке)
+# ──────────────────────────────────────────────
+
+def is_update_processed(update_key: str) -> bool:
+    """True — апдейт уже обработан (повторная доставка)."""
+    return execute_query(
+        "SELECT 1 FROM processed_updates WHERE update_key = ?", (update_key,), fetch='one'
+    ) is not None
+
+
+def mark_update_processed(update_key: str):
+    """Отметить апдейт обработанным — после того, как обработчик завершился."""
+    execute_query(
+        "INSERT INTO processed_updates (update_key, processed_at) VALUES (?, ?) "
+        "ON CONFLICT (update_key) DO NOTHING",
+        (update_key, datetime.now())
+    )
+
+
+def prune_processed_updates(older_than_hours: float):
+    """Удалить отметки старше окна, в котором Telegram может повторить апдейт."""
+    execute_query(
+        "DELETE FROM processed_updates WHERE processed_at < ?",
+        (datetime.now() - timedelta(hours=older_than_hours),)
+    )
+
+
 # ──────────────────────────────────────────────
 # Профили забаненных (для детектора спам-волн)
 # ──────────────────────────────────────────────
@@ -701,7 +833,7 @@ def get_all_admin_decisions(limit=500):
     ) or []
 
 
-def get_validation_dataset(limit: int = 1000):
+def get_validation_dataset(limit: int = 1000, exclude_reasoning=None):
     """Возвращает все сообщения с известной ground truth для валидации.
 
     Правила определения метки is_spam:
@@ -714,15 +846,21 @@ def get_validation_dataset(limit: int = 1000):
       - llm_result = 'ВОЗМОЖНО_СПАМ' AND admin_decision IS NULL — статус неизвестен
       - Пустые / слишком короткие тексты
 
+    exclude_reasoning — строка или кортеж строк: пропустить вердикты бота без
+    решения админа, чей reasoning содержит одну из них (вердикты без LLM,
+    решения самого обучаемого классификатора).
+
     Возвращает [(text, is_spam, source), ...] с указанием источника метки.
     """
+    exclude_sql, params = _exclude_reasoning_sql(exclude_reasoning)
     rows = execute_query(
-        """SELECT text, llm_result, admin_decision FROM messages
+        f"""SELECT text, llm_result, admin_decision FROM messages
            WHERE text IS NOT NULL AND LENGTH(text) > 5
              AND NOT (admin_decision IS NULL AND llm_result = 'ВОЗМОЖНО_СПАМ')
              AND NOT (admin_decision IS NULL AND llm_result IS NULL)
+             {exclude_sql}
            ORDER BY created_at DESC LIMIT ?""",
-        (limit,), fetch='all'
+        params + (limit,), fetch='all'
     ) or []
 
     result = []
@@ -738,8 +876,8 @@ def get_validation_dataset(limit: int = 1000):
     return result
 
 
-def count_validation_dataset() -> dict:
-    """Статистика по доступным для валидации сообщениям."""
+def count_validation_dataset(exclude_reasoning=None) -> dict:
+    """Статистика по доступным для валидации сообщениям (exclude_reasoning — как в get_validation_dataset)."""
     result = {
         'admin_spam': 0,
         'admin_not_spam': 0,
@@ -747,11 +885,13 @@ def count_validation_dataset() -> dict:
         'bot_not_spam_no_admin': 0,
         'skipped_maybe_spam': 0,
     }
+    exclude_sql, params = _exclude_reasoning_sql(exclude_reasoning)
     rows = execute_query(
-        """SELECT llm_result, admin_decision, COUNT(*) FROM messages
+        f"""SELECT llm_result, admin_decision, COUNT(*) FROM messages
            WHERE text IS NOT NULL AND LENGTH(text) > 5
+             {exclude_sql}
            GROUP BY llm_result, admin_decision""",
-        fetch='all'
+        params, fetch='all'
     ) or []
     for llm_result, admin_decision, count in rows:
         if admin_decision == 'СПАМ':
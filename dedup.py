@@ -0,0 +1,108 @@
+"""
+Идемпотентная обработка апдейтов Telegram.
+
+После перезапуска polling и при сетевых повторах Telegram может прислать тот
+же апдейт ещё раз — без защиты он проходит весь путь заново: LLM, запись в
+БД, отчёт админу. Дедупликатор смотрит на апдейт до любого обработчика:
+
+  • ключ апдейта — update_id;
+  • ключ сообщения — (chat_id, message_id, edit_date): тот же текст под
+    новым update_id тоже повтор, а каждая правка — новое событие.
+
+Сначала — ограниченное окно в памяти (TTLCache, O(1), без I/O): ловит
+повторы в рамках процесса, ключ резервируется в нём до обработчика, так что
+параллельный повтор отбрасывается сразу. В компактную таблицу
+processed_updates (одна строка на апдейт) ключ пишется только после того,
+как обработчик завершился: она переживает перезапуск, когда Telegram и
+присылает повторы, а апдейт, обработку которого прервали падение или
+рестарт, придёт снова и будет обработан. Если обработчик упал, резерв в
+памяти снимается. Обращения к таблице — в потоке, event loop не ждёт БД.
+Ошибка таблицы не роняет обработку: лучше обработать дважды, чем потерять
+апдейт.
+"""
+import asyncio
+import logging
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def update_keys(update) -> tuple[str, str | None]:
+    """(ключ апдейта, ключ сообщения или None) — компактные строки для окна и таблицы."""
+    message = update.message or update.edited_message
+    message_key = None
+    if message is not None:
+        edit_date = message.edit_date
+        stamp = int(edit_date.timestamp()) if hasattr(edit_date, "timestamp") else int(edit_date or 0)
+        message_key = f"m:{message.chat.id}:{message.message_id}:{stamp}"
+    return f"u:{update.update_id}", message_key
+
+
+class UpdateDeduplicator:
+    """begin → обработчик → done (или abort, если он упал).
+
+    is_processed(key) / mark_processed(key) — синхронные функции таблицы
+    (None — без таблицы), вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float | None = 86400,
+                 is_processed=None, mark_processed=None):
+        self.window = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._is_processed = is_processed
+        self._mark_processed = mark_processed
+        self.checked = 0
+        self.duplicates_memory = 0
+        self.duplicates_persistent = 0
+        self.aborted = 0
+        self.table_errors = 0
+
+    async def _table(self, fn, key: str, default):
+        try:
+            return await asyncio.to_thread(fn, key)
+        except Exception as e:
+            self.table_errors += 1
+            logger.warning(f"Дедупликация: таблица недоступна, обрабатываем апдейт: {e}")
+            return default
+
+    async def begin(self, update) -> list[str] | None:
+        """Проверить и зарезервировать апдейт. None — уже обрабатывался, пропустить."""
+        self.checked += 1
+        keys = [k for k in update_keys(update) if k]
+        if any(k in self.window for k in keys):
+            self.duplicates_memory += 1
+            return None
+        # Без await между проверкой и резервом — параллельный повтор увидит резерв
+        for k in keys:
+            self.window.set(k, True)
+        # В таблице — один ключ: сообщения по содержимому, прочее по update_id
+        if self._is_processed is not None and await self._table(self._is_processed, keys[-1], False):
+            self.duplicates_persistent += 1
+            return None
+        return keys
+
+    async def done(self, keys: list[str]):
+        """Обработчик завершился — отметить апдейт в таблице."""
+        if self._mark_processed is not None:
+            await self._table(self._mark_processed, keys[-1], None)
+
+    def abort(self, keys: list[str]):
+        """Обработчик упал — снять резерв, повторная доставка будет обработана."""
+        self.aborted += 1
+        for k in keys:
+            self.window.pop(k)
+
+    @property
+    def duplicates(self) -> int:
+        return self.duplicates_memory + self.duplicates_persistent
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "window": len(self.window),
+            "duplicates": self.duplicates,
+            "duplicates_memory": self.duplicates_memory,
+            "duplicates_persistent": self.duplicates_persistent,
+            "aborted": self.aborted,
+            "table_errors": self.table_errors,
+        }
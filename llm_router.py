@@ -0,0 +1,202 @@
+"""
+Маршрутизация LLM-вызовов по нескольким OpenAI-совместимым эндпоинтам
+(разные провайдеры или несколько ключей одного провайдера).
+
+- Выбор: «два случайных по весу — берём менее нагруженный» (power of two
+  choices); нагрузка = (в полёте + 1) × EWMA задержки / вес.
+- Здоровье: после failure_threshold ошибок подряд (или сразу на 429)
+  эндпоинт выводится из ротации на cooldown (удваивается до max_cooldown),
+  потом получает пробный вызов; успех возвращает его в строй.
+- Ошибка эндпоинта (429, 5xx, сеть, таймаут) → тот же запрос уходит на
+  следующий; ошибка запроса (400 и т.п.) пробрасывается сразу.
+- Модель другого провайдера: models — соответствие «запрошенная модель →
+  модель эндпоинта»; model — замена только для основной модели
+  классификации (primary_model). Остальные вызовы (быстрая модель каскада,
+  hedge, улучшение промпта) уходят с запрошенной моделью: их параметры
+  (max_completion_tokens, reasoning_effort) подобраны под неё.
+
+Модуль не импортирует openai: клиенты создаёт вызывающий код.
+"""
+import json
+import logging
+import os
+import random
+import time
+
+from llm_scheduler import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def parse_endpoints(raw: str) -> list[dict]:
+    """LLM_ENDPOINTS (JSON-список) → [{name, base_url, api_key, model, models, weight}, ...].
+
+    Ключ можно передать как api_key или как имя env-переменной в api_key_env.
+    """
+    if not raw or not raw.strip():
+        return []
+    items = json.loads(raw)
+    if not isinstance(items, list):
+        raise ValueError("LLM_ENDPOINTS должен быть JSON-списком")
+    endpoints = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"LLM_ENDPOINTS[{i}]: ожидается объект")
+        api_key = item.get("api_key") or os.getenv(item.get("api_key_env", ""), "")
+        if not api_key:
+            raise ValueError(f"LLM_ENDPOINTS[{i}]: нет api_key / api_key_env")
+        models = item.get("models") or {}
+        if not isinstance(models, dict):
+            raise ValueError(f"LLM_ENDPOINTS[{i}]: models — объект «модель запроса → модель эндпоинта»")
+        endpoints.append({
+            "name": item.get("name") or item.get("base_url") or f"endpoint-{i}",
+            "base_url": item.get("base_url") or None,
+            "api_key": api_key,
+            "model": item.get("model") or None,
+            "models": models,
+            "weight": float(item.get("weight", 1.0)),
+        })
+    return endpoints
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """Проблема эндпоинта (стоит попробовать другой), а не самого запроса."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        return True  # сеть, таймаут, обрыв соединения
+    return status in (408, 409, 429) or status >= 500
+
+
+class Endpoint:
+    def __init__(self, name: str, client, weight: float = 1.0, model: str = None, models: dict = None):
+        self.name = name
+        self.client = client
+        self.weight = max(weight, 0.01)
+        self.model = model  # замена основной модели классификации (другой провайдер)
+        self.models = models or {}  # модель запроса → модель эндпоинта
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: float | None = None
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.cooldown = 0.0
+
+    def model_for(self, requested: str, primary: str = None) -> str:
+        if requested in self.models:
+            return self.models[requested]
+        if self.model and requested == primary:
+            return self.model
+        return requested
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def load(self, default_latency: float) -> float:
+        return (self.in_flight + 1) * (self.latency_ewma or default_latency) / self.weight
+
+
+class LLMRouter:
+    """Балансировщик chat.completions.create по списку Endpoint."""
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        failure_threshold: int = 3,
+        base_cooldown: float = 30.0,
+        max_cooldown: float = 300.0,
+        ewma_alpha: float = 0.2,
+        clock=time.monotonic,
+        rng: random.Random = None,
+        primary_model=None,
+    ):
+        if not endpoints:
+            raise ValueError("LLMRouter: пустой список эндпоинтов")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.ewma_alpha = ewma_alpha
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self.failovers = 0
+        # () → текущая основная модель классификации (она выбирается автодетектом
+        # после создания роутера); к ней применяется Endpoint.model
+        self._primary_model = primary_model or (lambda: None)
+
+    def pick(self, exclude: set = frozenset()) -> Endpoint | None:
+        now = self._clock()
+        candidates = [e for e in self.endpoints if e.name not in exclude and e.available(now)]
+        if not candidates:
+            # Все выведены — пробуем тот, чей cooldown кончается раньше всех
+            rest = [e for e in self.endpoints if e.name not in exclude]
+            return min(rest, key=lambda e: e.ejected_until) if rest else None
+        if len(candidates) == 1:
+            return candidates[0]
+        known = [e.latency_ewma for e in self.endpoints if e.latency_ewma]
+        default_latency = sum(known) / len(known) if known else 1.0
+        a, b = self._rng.choices(candidates, weights=[e.weight for e in candidates], k=2)
+        return a if a.load(default_latency) <= b.load(default_latency) else b
+
+    def _on_success(self, ep: Endpoint, latency: float):
+        ep.calls += 1
+        ep.consecutive_failures = 0
+        ep.cooldown = 0.0
+        ep.latency_ewma = latency if ep.latency_ewma is None else (
+            self.ewma_alpha * latency + (1 - self.ewma_alpha) * ep.latency_ewma
+        )
+
+    def _on_failure(self, ep: Endpoint, exc: BaseException):
+        ep.calls += 1
+        ep.errors += 1
+        ep.consecutive_failures += 1
+        rate_limited = getattr(exc, "status_code", None) == 429
+        if rate_limited or ep.consecutive_failures >= self.failure_threshold:
+            ep.cooldown = min(self.max_cooldown, ep.cooldown * 2 or self.base_cooldown)
+            pause = retry_after_seconds(exc, ep.cooldown) if rate_limited else ep.cooldown
+            ep.ejected_until = self._clock() + pause
+            ep.ejections += 1
+            logger.warning(f"LLM-эндпоинт {ep.name} выведен на {pause:.0f}s: {type(exc).__name__}")
+
+    async def create(self, **params):
+        tried: set = set()
+        last_exc = None
+        while True:
+            ep = self.pick(tried)
+            if ep is None:
+                raise last_exc
+            tried.add(ep.name)
+            model = ep.model_for(params.get("model"), self._primary_model())
+            call_params = dict(params, model=model) if model != params.get("model") else params
+            ep.in_flight += 1
+            started = self._clock()
+            try:
+                response = await ep.client.chat.completions.create(**call_params)
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    raise
+                self._on_failure(ep, e)
+                last_exc = e
+                if len(tried) < len(self.endpoints):
+                    self.failovers += 1
+                continue
+            else:
+                self._on_success(ep, self._clock() - started)
+                return response
+            finally:
+                ep.in_flight -= 1
+
+    def stats(self) -> list[dict]:
+        now = self._clock()
+        return [{
+            "name": e.name,
+            "healthy": e.available(now),
+            "ejected_for": max(0.0, e.ejected_until - now),
+            "in_flight": e.in_flight,
+            "calls": e.calls,
+            "errors": e.errors,
+            "latency_ewma": e.latency_ewma or 0.0,
+            "ejections": e.ejections,
+            "weight": e.weight,
+        } for e in self.endpoints]
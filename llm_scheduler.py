@@ -0,0 +1,258 @@
+"""
+Планировщик LLM-вызовов: общий лимит параллельности для всех мест,
+где бот ходит в модель (классификация, Vision, профиль, оценка промпта).
+
+- Окно параллельности AIMD (как TCP): каждый успешный вызов расширяет окно
+  на 1/окно, 429 от провайдера — сужает вдвое.
+- Retry-After: после 429 новые вызовы ждут паузу, которую просил провайдер,
+  а упавший вызов повторяется (до max_retries раз).
+- Бюджет токенов в минуту: вызов не стартует, пока оценка его токенов не
+  влезает в скользящее минутное окно.
+- Классы приоритета: живая модерация (текст, Vision, профиль) идёт раньше
+  оценки и генерации промптов. Фоновые классы не стартуют, пока ждёт кто-то
+  выше, и не занимают зарезервированную под живой трафик долю окна и
+  минутного бюджета токенов — им достаётся только свободная пропускная
+  способность.
+
+Модуль не зависит от openai: 429 распознаётся по status_code исключения,
+Retry-After — по заголовкам его response.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from metrics import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_STATUS = 429
+_TPM_WINDOW = 60.0
+
+# Классы приоритета, от высшего к низшему
+LIVE_TEXT = "live_text"
+LIVE_VISION = "live_vision"
+PROFILE = "profile"
+EVALUATION = "evaluation"
+GENERATION = "generation"
+PRIORITIES = (LIVE_TEXT, LIVE_VISION, PROFILE, EVALUATION, GENERATION)
+BACKGROUND = frozenset({EVALUATION, GENERATION})
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    return getattr(exc, "status_code", None) == RATE_LIMIT_STATUS
+
+
+def retry_after_seconds(exc: BaseException, default: float = 1.0) -> float:
+    """Пауза из retry-after-ms / retry-after (секунды или HTTP-дата)."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return max(0.0, float(ms) / 1000)
+        value = headers.get("retry-after")
+        if value is not None:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        pass
+    return default
+
+
+class LLMScheduler:
+    """Общая очередь LLM-вызовов с адаптивным окном параллельности.
+
+    run(fn, est_tokens) ждёт своей очереди, выполняет fn() и возвращает его
+    результат. Если fn() вернул объект с usage — фактические токены заменяют
+    оценку в минутном бюджете (см. usage_tokens).
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_window: int = 1,
+        max_window: int = 16,
+        tokens_per_minute: int = 0,
+        max_retries: int = 2,
+        default_retry_after: float = 1.0,
+        clock=time.monotonic,
+        usage_tokens=None,
+        live_reserve: float = 0.25,
+    ):
+        self.min_window = max(1, min_window)
+        self.max_window = max(self.min_window, max_window)
+        self.window = float(min(max(initial, self.min_window), self.max_window))
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.default_retry_after = default_retry_after
+        self._clock = clock
+        self._usage_tokens = usage_tokens
+        self.live_reserve = min(max(live_reserve, 0.0), 1.0)  # доля окна и TPM только для живого трафика
+        self._cond: asyncio.Condition | None = None
+        self._cond_loop = None
+        self._paused_until = 0.0
+        self._token_log: deque = deque()  # [started_at, tokens]
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.wait_time = LatencyWindow()
+        self.queued_by = {p: 0 for p in PRIORITIES}
+        self.wait_time_by = {p: LatencyWindow() for p in PRIORITIES}
+        self.completed_by = {p: 0 for p in PRIORITIES}
+        self.completed = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+    # ── Очередь ──
+
+    def _condition(self) -> asyncio.Condition:
+        # Condition привязывается к event loop — планировщик создаётся на
+        # импорте модуля, а loop появляется позже (и в тестах у каждого свой)
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._cond_loop is not loop:
+            self._cond = asyncio.Condition()
+            self._cond_loop = loop
+        return self._cond
+
+    def _tokens_used(self, now: float) -> int:
+        while self._token_log and self._token_log[0][0] <= now - _TPM_WINDOW:
+            self._token_log.popleft()
+        return sum(entry[1] for entry in self._token_log)
+
+    def _slots_for(self, priority: str) -> int:
+        slots = int(self.window)
+        if priority not in BACKGROUND or not self.live_reserve:
+            return slots
+        reserved = max(1, round(slots * self.live_reserve))
+        # Хотя бы один слот фону остаётся: иначе при окне 1 оценка не пойдёт никогда
+        return max(1, slots - reserved)
+
+    def _blocked_for(self, est_tokens: int, priority: str = LIVE_TEXT) -> float | None:
+        """0 — можно стартовать; >0 — подождать столько секунд; None — ждать освобождения слота."""
+        now = self._clock()
+        if self._paused_until > now:
+            return self._paused_until - now
+        # Строгий приоритет: пока ждёт кто-то выше, класс не стартует
+        if any(self.queued_by[p] for p in PRIORITIES[:PRIORITIES.index(priority)]):
+            return None
+        if self.in_flight >= self._slots_for(priority):
+            return None
+        if self.tokens_per_minute:
+            used = self._tokens_used(now)
+            budget = self.tokens_per_minute
+            if priority in BACKGROUND:
+                budget *= 1 - self.live_reserve
+            # Пустое окно пропускает любой вызов, иначе крупный запрос не уйдёт никогда
+            if used and used + est_tokens > budget:
+                return max(0.01, self._token_log[0][0] + _TPM_WINDOW - now)
+        return 0.0
+
+    async def _acquire(self, est_tokens: int, priority: str = LIVE_TEXT) -> list:
+        enqueued = self._clock()
+        self.queued += 1
+        self.queued_by[priority] += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            cond = self._condition()
+            async with cond:
+                while True:
+                    delay = self._blocked_for(est_tokens, priority)
+                    if delay == 0.0:
+                        break
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                self.in_flight += 1
+                entry = [self._clock(), est_tokens]
+                self._token_log.append(entry)
+                # Ушёл вызов выше — ждущие ниже могли разблокироваться
+                self.queued_by[priority] -= 1
+                cond.notify_all()
+        except BaseException:
+            self.queued_by[priority] -= 1
+            raise
+        finally:
+            self.queued -= 1
+        waited = self._clock() - enqueued
+        self.wait_time.add(waited)
+        self.wait_time_by[priority].add(waited)
+        return entry
+
+    async def _release(self):
+        self.in_flight -= 1  # до await: слот освобождается даже при отмене
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    # ── AIMD ──
+
+    def _on_success(self):
+        self.completed += 1
+        self.window = min(self.max_window, self.window + 1 / self.window)
+
+    def _on_rate_limit(self, exc: BaseException):
+        self.rate_limited += 1
+        now = self._clock()
+        # Один 429-всплеск (все вызовы в полёте разом) сужает окно один раз
+        if self._paused_until <= now:
+            self.window = max(self.min_window, self.window / 2)
+        pause = retry_after_seconds(exc, self.default_retry_after)
+        self._paused_until = max(self._paused_until, now + pause)
+        logger.warning(f"LLM 429: окно {self.window:.1f}, пауза {pause:.1f}s")
+
+    async def run(self, fn, est_tokens: int = 0, priority: str = LIVE_TEXT):
+        if priority not in self.queued_by:
+            priority = LIVE_TEXT
+        attempt = 0
+        while True:
+            entry = await self._acquire(est_tokens, priority)
+            try:
+                result = await fn()
+            except Exception as e:
+                if is_rate_limited(e):
+                    self._on_rate_limit(e)
+                    if attempt < self.max_retries:
+                        attempt += 1
+                        self.retries += 1
+                        continue
+                raise
+            else:
+                self._on_success()
+                self.completed_by[priority] += 1
+                if self._usage_tokens is not None:
+                    actual = self._usage_tokens(result)
+                    if actual:
+                        entry[1] = actual
+                return result
+            finally:
+                await self._release()
+
+    def stats(self) -> dict:
+        now = self._clock()
+        return {
+            "window": self.window,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "wait_p50": self.wait_time.percentile(50),
+            "wait_p95": self.wait_time.percentile(95),
+            "completed": self.completed,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "paused_for": max(0.0, self._paused_until - now),
+            "tokens_last_minute": self._tokens_used(now),
+            "classes": {
+                p: {
+                    "queued": self.queued_by[p],
+                    "completed": self.completed_by[p],
+                    "wait_p50": self.wait_time_by[p].percentile(50),
+                    "wait_p95": self.wait_time_by[p].percentile(95),
+                }
+                for p in PRIORITIES
+            },
+        }
@@ -0,0 +1,245 @@
+"""
+Локальный классификатор спама на CPU: хешированные символьные n-граммы +
+наивный Байес (бинарные признаки, сглаживание Лапласа).
+
+Чистый Python без NumPy: обучение на нескольких тысячах коротких сообщений
+занимает доли секунды, оценка одного сообщения — миллисекунды. Модель учится
+инкрементально (learn) — новые решения админа сразу меняют счётчики.
+
+Пороги калибруются по оценкам кросс-валидации (каждый пример оценивает
+модель, не видевшая его при обучении): spam_threshold — так, чтобы доля
+чистых сообщений с оценкой выше него не превышала target_fpr; ham_threshold —
+так, чтобы доля спама ниже него не превышала target_fnr. Итоговая модель
+учится на всех примерах — её оценки распределены так же, как у моделей
+фолдов, поэтому пороги к ней подходят. Всё между порогами решает LLM.
+"""
+import math
+import re
+import zlib
+
+# Начало reasoning вердикта, вынесенного без LLM: такие метки не идут
+# обратно в обучение (иначе классификатор учится на своих же ответах)
+VERDICT_PREFIX = "Локальный классификатор:"
+
+N_FEATURES = 1 << 18
+NGRAM_SIZES = (3, 4, 5)
+
+_DIGITS_RE = re.compile(r"\d")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def features(text: str) -> set[int]:
+    """Множество хешей символьных n-грамм (цифры схлопнуты: суммы и телефоны — один признак)."""
+    text = _SPACES_RE.sub(" ", _DIGITS_RE.sub("0", (text or "").lower())).strip()
+    padded = f" {text} "
+    result = set()
+    for n in NGRAM_SIZES:
+        for i in range(len(padded) - n + 1):
+            # crc32 стабилен между запусками, в отличие от hash()
+            result.add(zlib.crc32(padded[i:i + n].encode("utf-8")) % N_FEATURES)
+    return result
+
+
+class NaiveBayes:
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.feature_docs = ({}, {})  # [класс][признак] → документов с признаком
+        self.docs = [0, 0]  # [ham, spam]
+
+    def learn(self, text: str, is_spam: bool):
+        cls = int(bool(is_spam))
+        counts = self.feature_docs[cls]
+        for f in features(text):
+            counts[f] = counts.get(f, 0) + 1
+        self.docs[cls] += 1
+
+    def forget(self, text: str, is_spam: bool):
+        """Обратное learn: убрать пример, который модель видела."""
+        cls = int(bool(is_spam))
+        counts = self.feature_docs[cls]
+        for f in features(text):
+            left = counts.get(f, 0) - 1
+            if left > 0:
+                counts[f] = left
+            else:
+                counts.pop(f, None)
+        self.docs[cls] -= 1
+
+    def without(self, examples: list) -> "NaiveBayes":
+        """Копия модели, не видевшая examples (для оценок кросс-валидации)."""
+        nb = NaiveBayes(self.alpha)
+        nb.feature_docs = (dict(self.feature_docs[0]), dict(self.feature_docs[1]))
+        nb.docs = list(self.docs)
+        for text, is_spam in examples:
+            nb.forget(text, is_spam)
+        return nb
+
+    def log_odds(self, text: str) -> float:
+        """log P(spam|text) / P(ham|text); признаки, не встречавшиеся в обучении, пропускаются."""
+        ham, spam = self.feature_docs
+        n_ham, n_spam = self.docs
+        a = self.alpha
+        score = math.log((n_spam + a) / (n_ham + a))
+        for f in features(text):
+            h, s = ham.get(f, 0), spam.get(f, 0)
+            if h or s:
+                score += math.log((s + a) / (n_spam + 2 * a)) - math.log((h + a) / (n_ham + 2 * a))
+        return score
+
+
+def calibrate(scored: list, target_fpr: float, target_fnr: float) -> tuple[float, float]:
+    """Пороги (ham_threshold, spam_threshold) по [(log_odds, is_spam), ...].
+
+    Считаем в log-odds, а не в вероятностях: Байес пере-уверен, и вероятности
+    большинства сообщений слипаются в 0.0 / 1.0 — порогу не за что зацепиться.
+    """
+    hams = sorted((s for s, y in scored if not y), reverse=True)
+    spams = sorted(s for s, y in scored if y)
+    # Не больше floor(target * n) ошибок за порогом
+    allowed_fp = int(target_fpr * len(hams))
+    spam_threshold = math.nextafter(hams[allowed_fp], math.inf) if allowed_fp < len(hams) else -math.inf
+    allowed_fn = int(target_fnr * len(spams))
+    ham_threshold = math.nextafter(spams[allowed_fn], -math.inf) if allowed_fn < len(spams) else math.inf
+    return min(ham_threshold, 0.0), max(spam_threshold, 0.0)
+
+
+def evaluate(scored: list, ham_threshold: float, spam_threshold: float) -> dict:
+    """Качество решений с порогами: покрытие, FPR/FNR от всех ham/spam, точность решённых."""
+    n_ham = sum(1 for _, y in scored if not y)
+    n_spam = len(scored) - n_ham
+    fp = sum(1 for s, y in scored if not y and s >= spam_threshold)
+    tp = sum(1 for s, y in scored if y and s >= spam_threshold)
+    fn = sum(1 for s, y in scored if y and s <= ham_threshold and s < spam_threshold)
+    tn = sum(1 for s, y in scored if not y and s <= ham_threshold and s < spam_threshold)
+    decided = tp + fp + tn + fn
+    return {
+        "total": len(scored),
+        "coverage": decided / len(scored) if scored else 0.0,
+        "fpr": fp / n_ham if n_ham else 0.0,
+        "fnr": fn / n_spam if n_spam else 0.0,
+        "accuracy": (tp + tn) / decided if decided else 0.0,
+        "auto_spam": tp + fp,
+        "auto_ham": tn + fn,
+    }
+
+
+def _fold(text: str, folds: int) -> int:
+    # Детерминированный сплит: один и тот же текст всегда в одном фолде
+    return zlib.crc32(text.encode("utf-8")) % folds
+
+
+class LocalClassifier:
+    """Модель + калиброванные пороги. Пока не обучен (или мало данных) — decide() → None.
+
+    Модель, пороги и отчёт лежат в одном кортеже и меняются одним
+    присваиванием: decide() не увидит новые пороги рядом со старой моделью.
+    Переобучение без остановки: fit() строит состояние в рабочем потоке,
+    install() подменяет его и доучивает примеры, пришедшие за это время
+    (их learn() записывает между start_recording() и install()).
+    """
+
+    def __init__(self):
+        self._state: tuple = (None, -math.inf, math.inf, {})
+        self._learned_meanwhile: list | None = None
+
+    @property
+    def model(self) -> NaiveBayes | None:
+        return self._state[0]
+
+    @property
+    def ham_threshold(self) -> float:
+        return self._state[1]
+
+    @property
+    def spam_threshold(self) -> float:
+        return self._state[2]
+
+    @property
+    def report(self) -> dict:
+        return self._state[3]
+
+    @property
+    def ready(self) -> bool:
+        model, _, _, report = self._state
+        return model is not None and bool(report.get("calibrated"))
+
+    @staticmethod
+    def fit(examples: list, target_fpr: float = 0.005, target_fnr: float = 0.02,
+            folds: int = 5, min_per_class: int = 50) -> tuple:
+        """Обучить на [(text, is_spam), ...]: пороги — по оценкам кросс-валидации, модель — на всех.
+
+        Возвращает состояние (модель, ham_threshold, spam_threshold, отчёт) для
+        install(); живой классификатор не трогается.
+        """
+        folds = max(2, folds)
+        by_fold = [[] for _ in range(folds)]
+        for text, is_spam in examples:
+            by_fold[_fold(text, folds)].append((text, bool(is_spam)))
+
+        # Итоговая модель = сумма счётчиков фолдов; модель без фолда k —
+        # итоговая минус его счётчики, так что обучение проходит данные один раз
+        final = NaiveBayes()
+        for text, is_spam in examples:
+            final.learn(text, is_spam)
+        scored = []
+        for part in by_fold:
+            probe = final.without(part)
+            scored += [(probe.log_odds(text), is_spam) for text, is_spam in part]
+        n_spam = sum(1 for _, y in scored if y)
+        n_ham = len(scored) - n_spam
+
+        report = {"examples": len(examples), "scored_spam": n_spam, "scored_ham": n_ham, "folds": folds,
+                  "target_fpr": target_fpr, "target_fnr": target_fnr, "calibrated": False}
+        ham_thr, spam_thr = -math.inf, math.inf
+        if n_spam >= min_per_class and n_ham >= min_per_class:
+            ham_thr, spam_thr = calibrate(scored, target_fpr, target_fnr)
+            report.update(evaluate(scored, ham_thr, spam_thr), calibrated=True)
+        return final, ham_thr, spam_thr, report
+
+    def start_recording(self):
+        """Запоминать learn() до install(): новая модель их не видела."""
+        if self._learned_meanwhile is None:
+            self._learned_meanwhile = []
+
+    def stop_recording(self):
+        self._learned_meanwhile = None
+
+    def install(self, state: tuple, known=()) -> dict:
+        """Подменить состояние из fit() и доучить примеры, выученные за время обучения.
+
+        known — обучающая выборка fit(): пример, уже попавший в неё, повторно не учится.
+        """
+        model = state[0]
+        known = set(known)
+        for text, is_spam in self._learned_meanwhile or ():
+            if (text, is_spam) not in known:
+                model.learn(text, is_spam)
+        self._learned_meanwhile = None
+        self._state = state
+        return state[3]
+
+    def train(self, examples: list, target_fpr: float = 0.005, target_fnr: float = 0.02,
+              folds: int = 5, min_per_class: int = 50) -> dict:
+        """fit() + install() за один вызов."""
+        return self.install(self.fit(examples, target_fpr, target_fnr, folds, min_per_class))
+
+    def learn(self, text: str, is_spam: bool):
+        if not text:
+            return
+        if self._learned_meanwhile is not None:
+            self._learned_meanwhile.append((text, bool(is_spam)))
+        model = self._state[0]
+        if model is not None:
+            model.learn(text, is_spam)
+
+    def decide(self, text: str) -> tuple[bool | None, float]:
+        """(True — спам, False — не спам, None — решает LLM; log-odds)."""
+        model, ham_threshold, spam_threshold, report = self._state
+        if model is None or not report.get("calibrated") or not text:
+            return None, 0.0
+        score = model.log_odds(text)
+        if score >= spam_threshold:
+            return True, score
+        if score <= ham_threshold:
+            return False, score
+        return None, score
@@ -8,11 +8,16 @@ Kill Yr Spammers — Telegram антиспам-бот с LLM-классифик
 4. Применяется только если точность >= текущего, иначе откат
 """
 import asyncio
+import contextlib
+import contextvars
+import hashlib
 import logging
 import os
+import random
 import re
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
 from functools import wraps
@@ -33,15 +38,59 @@ from config import (
     AUTO_IMPROVE_AFTER_ERRORS, AUTO_IMPROVE_COOLDOWN_MINUTES,
     MIN_VALIDATION_EXAMPLES, MAX_VALIDATION_EXAMPLES,
     MAX_IMPROVEMENT_ATTEMPTS, ORDINARY_MESSAGES_SAMPLES, LLM_REASONING_EFFORT,
+    VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL_SECONDS,
+    FORWARD_REPUTATION_SIZE, FORWARD_REPUTATION_TTL_SECONDS,
+    FORWARD_BAD_AFTER_SPAM, FORWARD_CLEAN_AFTER,
+    RECENT_MESSAGES_SIZE, RECENT_MESSAGES_TTL_SECONDS,
+    JOIN_PREFETCH_SIZE, JOIN_PREFETCH_TTL_SECONDS,
+    LLM_BATCH_ENABLED, LLM_BATCH_MAX_SIZE, LLM_BATCH_MAX_WAIT_MS,
+    FEW_SHOT_REFRESH_SECONDS, FEW_SHOT_MODE, FEW_SHOT_RETRIEVAL_K, FEW_SHOT_RETRIEVAL_MIN_SCORE,
+    LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX,
+    LLM_TOKENS_PER_MINUTE, LLM_RATE_LIMIT_RETRIES, LLM_LIVE_RESERVE,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_DELAY_MS, LLM_HEDGE_MIN_SAMPLES,
+    LLM_CASCADE_ENABLED, LLM_FAST_MODEL_CANDIDATES, LLM_CASCADE_MIN_CONFIDENCE, LLM_CASCADE_AUDIT_RATE,
+    LLM_VERDICT_ONLY, LLM_EFFORT_SIMPLE, LLM_EFFORT_COMPLEX,
+    LLM_MAX_TOKENS_SIMPLE, LLM_MAX_TOKENS_COMPLEX, LLM_MAX_TOKENS_RETRY_CAP,
+    FEW_SHOT_TOKEN_BUDGET, FEW_SHOT_EXAMPLE_MAX_TOKENS, LLM_MESSAGE_TOKEN_BUDGET,
+    LLM_STREAMING, LLM_ENDPOINTS, LLM_ENDPOINT_FAILURE_THRESHOLD, LLM_ENDPOINT_COOLDOWN_SECONDS,
+    LLM_BREAKER_FAILURES, LLM_BREAKER_OPEN_SECONDS, LLM_BREAKER_MAX_OPEN_SECONDS, LLM_DEGRADED_DIGEST_SECONDS,
+    LOCAL_CLASSIFIER_MODE, LOCAL_CLASSIFIER_TARGET_FPR, LOCAL_CLASSIFIER_TARGET_FNR, LOCAL_CLASSIFIER_MIN_PER_CLASS,
+    SIGNAL_TIMEOUT_SECONDS, PROFILE_CONTEXT_WAIT_SECONDS,
+    PIPELINE_ORDER, PIPELINE_ADAPTIVE, PIPELINE_ADAPTIVE_MIN_RUNS,
+    ADMISSION_MAX_ACTIVE, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, ADMISSION_DEFERRED_MAX,
+    BURST_WINDOW_MS, BURST_MAX_WAIT_MS, BURST_MAX_MESSAGES,
+    RISK_SCORER_MODE, RISK_SCORER_TARGET_FPR, RISK_SCORER_TARGET_FNR, RISK_SCORER_MIN_PER_CLASS,
+    DEDUP_WINDOW_SIZE, DEDUP_WINDOW_TTL_SECONDS, DEDUP_PERSISTENT, DEDUP_RETENTION_HOURS,
 )
 from config import LLM_MODEL as _ENV_LLM_MODEL
 from config import LLM_IMPROVEMENT_MODEL as _ENV_LLM_IMPROVEMENT_MODEL
+from config import LLM_HEDGE_MODEL as _ENV_LLM_HEDGE_MODEL
+from config import LLM_FAST_MODEL as _ENV_LLM_FAST_MODEL
 
 # Реально используемые модели (определяются на старте через autodetect)
 LLM_MODEL = _ENV_LLM_MODEL or LLM_MODEL_CANDIDATES[0]
 LLM_IMPROVEMENT_MODEL = _ENV_LLM_IMPROVEMENT_MODEL or LLM_IMPROVEMENT_MODEL_CANDIDATES[0]
+# Модель для hedge-запроса; None — та же, что LLM_MODEL
+LLM_HEDGE_MODEL = _ENV_LLM_HEDGE_MODEL or None
+# Первая ступень каскада (nano-тир); None — каскад не работает
+LLM_FAST_MODEL = _ENV_LLM_FAST_MODEL or None
 import database as db
+from admission import AdmissionController
+from batching import BurstCoalescer, MicroBatcher
+from cache import SingleFlight, TTLCache
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from dedup import UpdateDeduplicator
+from local_classifier import VERDICT_PREFIX as LOCAL_VERDICT_PREFIX, LocalClassifier
+from risk_scorer import RiskScorer
+import risk_scorer
+from similarity_index import SimilarityIndex
+from llm_router import Endpoint, LLMRouter, is_endpoint_failure, parse_endpoints
+from llm_scheduler import EVALUATION, GENERATION, LIVE_TEXT, LIVE_VISION, PROFILE, LLMScheduler
+from metrics import LatencyWindow, LLMUsageStats, extract_usage, total_tokens
+from pipeline import Pipeline, Stage
 from text_normalize import normalize_text
+import token_budget
+from token_budget import count_message_tokens, count_tokens, fit_examples, truncate_to_budget
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -49,11 +98,96 @@ logger = logging.getLogger(__name__)
 bot: Bot = None
 dp = Dispatcher()
 openai_client: AsyncOpenAI = None
+# Балансировщик по LLM_ENDPOINTS; None — все вызовы идут в openai_client
+_llm_router: LLMRouter = None
 
 _user_request_times: dict[int, list[float]] = defaultdict(list)
 _http_client: httpx.AsyncClient = None
 # Блокировка чтобы не запускать два улучшения одновременно
 _improvement_in_progress = False
+# Кеш вердиктов: ключ → (SpamResult, reasoning). См. _verdict_cache_key()
+_verdict_cache = TTLCache(maxsize=VERDICT_CACHE_SIZE, ttl=VERDICT_CACHE_TTL_SECONDS)
+# Одновременные одинаковые классификации (спам-волна в нескольких группах) → один вызов LLM
+_classify_flight = SingleFlight()
+# Репутация источников пересылок: origin_key → {spam, clean, admin, title}
+_forward_reputation = TTLCache(maxsize=FORWARD_REPUTATION_SIZE, ttl=FORWARD_REPUTATION_TTL_SECONDS)
+# Какое сообщение из какого источника переслано — чтобы решение админа
+# по сообщению дошло до репутации источника. (chat_id, message_id) → origin_key
+_forward_origin_by_message = TTLCache(maxsize=FORWARD_REPUTATION_SIZE, ttl=FORWARD_REPUTATION_TTL_SECONDS)
+# Недавние сообщения: (chat_id, message_id) → (text, llm_result, user_id, chat_id, reasoning),
+# та же форма, что у db.get_message_by_id. Пишется вместе с БД (write-through)
+_recent_messages = TTLCache(maxsize=RECENT_MESSAGES_SIZE, ttl=RECENT_MESSAGES_TTL_SECONDS)
+# Задачи сигналов в полёте: сильные ссылки, чтобы GC не собрал задачу,
+# которую кеш предзагрузки уже вытеснил (см. _spawn_signal)
+_signal_tasks: set = set()
+# Предзагруженные при входе сигналы: (kind, user_id) → asyncio.Task.
+# Вытесненная или протухшая задача отменяется — её результат больше никто не заберёт
+_join_prefetch = TTLCache(
+    maxsize=JOIN_PREFETCH_SIZE, ttl=JOIN_PREFETCH_TTL_SECONDS,
+    on_evict=lambda key, task: task.cancel(),
+)
+# Повторно доставленные апдейты отбрасываются до обработчиков (см. dedup.py)
+_update_dedup = UpdateDeduplicator(
+    maxsize=DEDUP_WINDOW_SIZE, ttl=DEDUP_WINDOW_TTL_SECONDS,
+    is_processed=db.is_update_processed if DEDUP_PERSISTENT else None,
+    mark_processed=db.mark_update_processed if DEDUP_PERSISTENT else None,
+)
+# Счётчики сэкономленной работы для /perf
+_perf_counters: dict[str, int] = defaultdict(int)
+# Токены (в т.ч. из prefix-кеша провайдера) и задержки LLM-вызовов по типам
+_llm_usage = LLMUsageStats()
+# Общая очередь всех LLM-вызовов: AIMD-окно, Retry-After, бюджет токенов
+_llm_scheduler = LLMScheduler(
+    initial=LLM_CONCURRENCY_INITIAL, min_window=LLM_CONCURRENCY_MIN, max_window=LLM_CONCURRENCY_MAX,
+    tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_retries=LLM_RATE_LIMIT_RETRIES,
+    usage_tokens=total_tokens, live_reserve=LLM_LIVE_RESERVE,
+)
+# Класс приоритета вызова по kind; фоновые задачи (оценка промпта, аудит
+# каскада) задают класс для всех своих вызовов через llm_priority()
+_KIND_PRIORITY = {
+    "vision": LIVE_VISION,
+    "profile": PROFILE,
+    "explain": PROFILE,
+    "generation": GENERATION,
+}
+_llm_priority_override: contextvars.ContextVar = contextvars.ContextVar("llm_priority", default=None)
+# Время обслуживания основной моделью живых классификаций (без очереди) — по нему дедлайн hedging
+_classify_latency = LatencyWindow()
+# Потоковая классификация: reasoning, догружаемый в фоне после вердикта.
+# _reasoning_key(текст) → asyncio.Task[str]; забирается отчётом админу
+_pending_reasoning = TTLCache(maxsize=1000, ttl=300)
+# Время до вердикта и до конца ответа в потоковом режиме
+_stream_time_to_verdict = LatencyWindow()
+_stream_time_to_complete = LatencyWindow()
+# Сколько каждая стадия handle_message добавила к критическому пути (ожидание)
+_stage_latency: dict[str, LatencyWindow] = defaultdict(LatencyWindow)
+# Время поиска похожих примеров в локальном индексе
+_few_shot_retrieval_latency = LatencyWindow()
+# Circuit breaker LLM-провайдера; пока открыт — деградированный режим без LLM
+_llm_breaker = CircuitBreaker(
+    failure_threshold=LLM_BREAKER_FAILURES, open_seconds=LLM_BREAKER_OPEN_SECONDS,
+    max_open_seconds=LLM_BREAKER_MAX_OPEN_SECONDS,
+)
+# Сообщения без сигналов риска, не проверенные LLM в деградированном режиме:
+# идут в дайджест админу и перепроверяются после восстановления провайдера
+_degraded_queue: deque = deque(maxlen=200)
+# Допуск к LLM-стадии: ограниченная очередь вместо неограниченного числа
+# ждущих handle_message во время рейда
+_admission = AdmissionController(
+    max_active=ADMISSION_MAX_ACTIVE, max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_WAIT_SECONDS,
+)
+# Сообщения, не допущенные к LLM под нагрузкой: перепроверяются, когда очередь пуста
+_overload_queue: deque = deque(maxlen=ADMISSION_DEFERRED_MAX)
+# Локальный pre-filter перед LLM; обучается на старте и по /classifier
+_local_classifier = LocalClassifier()
+# Риск-скор по сигналам; веса — из meta (подбираются по /riskfit)
+_risk_scorer = RiskScorer()
+# Индекс размеченных примеров для few-shot по похожести (FEW_SHOT_MODE=retrieval)
+_few_shot_index = SimilarityIndex()
+# Переопределение FEW_SHOT_MODE для текущей задачи (сравнение режимов в /fewshotbench)
+_few_shot_mode_override: contextvars.ContextVar = contextvars.ContextVar("few_shot_mode", default=None)
+# Текущее поколение few-shot блока. См. get_few_shot_block()
+_few_shot_snapshot = {"block": None, "generation": 0, "built_at": 0.0, "dirty": False}
 
 
 def _is_reasoning_model(model: str) -> bool:
@@ -61,9 +195,15 @@ def _is_reasoning_model(model: str) -> bool:
     return model.startswith(("gpt-5", "o1", "o3", "o4"))
 
 
-async def _probe_model(model: str) -> tuple[bool, str]:
+async def _probe_model(model: str, health_check: bool = False) -> tuple[bool, str]:
     """Проверяет доступность модели одним минимальным запросом.
-    Возвращает (доступна, описание_ошибки_если_нет)."""
+    Возвращает (доступна, описание_ошибки_если_нет).
+
+    health_check=True — проба провайдера для circuit breaker (llm_create, kind="probe"):
+    её успех закрывает breaker. Проверки моделей (/models, автодетект) идут
+    в планировщик мимо breaker: несуществующая модель — не сбой провайдера,
+    а ответ чужой модели ничего не говорит о здоровье основной.
+    """
     try:
         params = {
             "model": model,
@@ -75,7 +215,14 @@ async def _probe_model(model: str) -> tuple[bool, str]:
         else:
             params["max_tokens"] = 5
             params["temperature"] = 0
-        await openai_client.chat.completions.create(**params)
+        if health_check:
+            await llm_create("probe", **params)
+        else:
+            await _llm_scheduler.run(
+                lambda: _completions_create(**params),
+                est_tokens=count_message_tokens(params["messages"], model) + 5,
+                priority=_priority_for("probe"),
+            )
         return True, ""
     except Exception as e:
         return False, f"{type(e).__name__}: {str(e)[:200]}"
@@ -83,10 +230,11 @@ async def _probe_model(model: str) -> tuple[bool, str]:
 
 async def _autodetect_models() -> dict:
     """Подбирает доступные модели из списков-кандидатов.
-    Возвращает {classification, improvement, errors: [...]} для отчёта."""
-    global LLM_MODEL, LLM_IMPROVEMENT_MODEL
+    Возвращает {classification, improvement, hedge, fast, errors: [...]} для отчёта."""
+    global LLM_MODEL, LLM_IMPROVEMENT_MODEL, LLM_HEDGE_MODEL, LLM_FAST_MODEL
 
-    result = {"classification": None, "improvement": None, "errors": []}
+    result = {"classification": None, "improvement": None, "hedge": LLM_HEDGE_MODEL,
+              "fast": LLM_FAST_MODEL, "errors": []}
 
     # Если env переменная задана — используем её без проверки
     if _ENV_LLM_MODEL:
@@ -104,6 +252,30 @@ async def _autodetect_models() -> dict:
                 result["errors"].append(f"{candidate}: {err[:80]}")
                 logger.warning(f"❌ {candidate} недоступна: {err[:80]}")
 
+    # Hedge-модель — следующий рабочий кандидат после основной: у другой
+    # модели хвост задержек не коррелирует с хвостом основной
+    if LLM_HEDGE_ENABLED and not _ENV_LLM_HEDGE_MODEL and not _ENV_LLM_MODEL and result["classification"]:
+        for candidate in LLM_MODEL_CANDIDATES[LLM_MODEL_CANDIDATES.index(LLM_MODEL) + 1:]:
+            ok, _ = await _probe_model(candidate)
+            if ok:
+                LLM_HEDGE_MODEL = candidate
+                result["hedge"] = candidate
+                logger.info(f"✅ Hedge-модель: {candidate}")
+                break
+
+    # Nano-ступень каскада (только если каскад включён и модель не задана в env)
+    if LLM_CASCADE_ENABLED and not _ENV_LLM_FAST_MODEL:
+        for candidate in LLM_FAST_MODEL_CANDIDATES:
+            if candidate == LLM_MODEL:
+                continue
+            ok, err = await _probe_model(candidate)
+            if ok:
+                LLM_FAST_MODEL = candidate
+                result["fast"] = candidate
+                logger.info(f"✅ Автодетект LLM_FAST_MODEL: {candidate}")
+                break
+            result["errors"].append(f"{candidate}: {err[:80]}")
+
     if _ENV_LLM_IMPROVEMENT_MODEL:
         result["improvement"] = _ENV_LLM_IMPROVEMENT_MODEL
         logger.info(f"LLM_IMPROVEMENT_MODEL задан через env: {_ENV_LLM_IMPROVEMENT_MODEL}")
@@ -122,9 +294,9 @@ async def _autodetect_models() -> dict:
     return result
 
 
-def _token_limit_param(max_tokens: int) -> dict:
+def _token_limit_param(max_tokens: int, model: str = None) -> dict:
     """gpt-5+ требуют max_completion_tokens вместо max_tokens."""
-    if _is_reasoning_model(LLM_MODEL):
+    if _is_reasoning_model(model or LLM_MODEL):
         return {"max_completion_tokens": max_tokens}
     return {"max_tokens": max_tokens}
 
@@ -145,13 +317,15 @@ def _temperature_param(model: str, value: float) -> dict:
 def get_forward_info(message: types.Message) -> dict:
     """Единая точка чтения forward-данных через Bot API 7.0+ forward_origin.
 
-    Возвращает {is_forward, user_id, username, chat_title, description}.
+    Возвращает {is_forward, user_id, username, chat_title, description, origin_key}.
     user_id есть только если оригинал от видимого пользователя (MessageOriginUser);
     скрытые пользователи (privacy) дают только имя, каналы — title.
+    origin_key — стабильный ключ источника для репутации ('channel:<id>',
+    'chat:<id>', 'user:<id>'); у скрытых пользователей его нет.
     """
     origin = getattr(message, 'forward_origin', None)
     info = {"is_forward": bool(origin), "user_id": None, "username": None,
-            "chat_title": None, "description": ""}
+            "chat_title": None, "description": "", "origin_key": None}
     if not origin:
         return info
     ot = getattr(origin, 'type', '')
@@ -160,6 +334,7 @@ def get_forward_info(message: types.Message) -> dict:
         info["user_id"] = u.id
         info["username"] = u.username or u.full_name
         info["description"] = f"Переслано от {u.full_name}"
+        info["origin_key"] = f"user:{u.id}"
     elif ot == 'hidden_user':
         info["username"] = getattr(origin, 'sender_user_name', None)
         info["description"] = f"Переслано от {info['username']}"
@@ -167,21 +342,158 @@ def get_forward_info(message: types.Message) -> dict:
         info["chat_title"] = origin.chat.title
         info["username"] = origin.chat.title
         info["description"] = f"Переслано из канала «{origin.chat.title}»"
+        info["origin_key"] = f"channel:{origin.chat.id}"
     elif ot == 'chat' and getattr(origin, 'sender_chat', None):
         info["chat_title"] = origin.sender_chat.title
         info["username"] = origin.sender_chat.title
         info["description"] = f"Переслано из чата «{origin.sender_chat.title}»"
+        info["origin_key"] = f"chat:{origin.sender_chat.id}"
     return info
 
 
-def _reasoning_effort_param(model: str) -> dict:
+def record_forward_verdict(origin_key: str, verdict: str, title: str = "", by_admin: bool = False):
+    """Учесть вердикт по пересылке из источника origin_key.
+
+    verdict — 'СПАМ' / 'НЕ_СПАМ' (ВОЗМОЖНО_СПАМ не учитывается).
+    Решение админа перекрывает накопленную статистику LLM.
+    """
+    if not origin_key or verdict not in ("СПАМ", "НЕ_СПАМ"):
+        return
+    entry = _forward_reputation.get(origin_key) or {"spam": 0, "clean": 0, "admin": None, "title": title}
+    if by_admin:
+        entry["admin"] = verdict
+    elif verdict == "СПАМ":
+        entry["spam"] += 1
+    else:
+        entry["clean"] += 1
+    if title:
+        entry["title"] = title
+    _forward_reputation.set(origin_key, entry)
+
+
+def forward_reputation(origin_key: str) -> str | None:
+    """'bad' / 'clean' / None (неизвестно или спорно)."""
+    if not origin_key:
+        return None
+    entry = _forward_reputation.get(origin_key)
+    if not entry:
+        return None
+    if entry["admin"]:
+        return "bad" if entry["admin"] == "СПАМ" else "clean"
+    if entry["spam"] >= FORWARD_BAD_AFTER_SPAM and entry["clean"] == 0:
+        return "bad"
+    if entry["clean"] >= FORWARD_CLEAN_AFTER and entry["spam"] == 0:
+        return "clean"
+    return None
+
+
+def _reasoning_effort_param(model: str, effort: str = None) -> dict:
     """Для reasoning-моделей (gpt-5.x) ограничиваем 'размышления' на классификации:
-    low = быстрее, дешевле, меньше шансов выжечь max_completion_tokens reasoning-токенами."""
+    low = быстрее, дешевле, меньше шансов выжечь max_completion_tokens reasoning-токенами.
+    effort — значение от политики вызова (_classification_policy), иначе LLM_REASONING_EFFORT."""
     if _is_reasoning_model(model) and model.startswith("gpt-5"):
-        return {"reasoning_effort": LLM_REASONING_EFFORT}
+        return {"reasoning_effort": effort or LLM_REASONING_EFFORT}
     return {}
 
 
+def _completions_create(**params):
+    """chat.completions.create через роутер эндпоинтов, если он настроен."""
+    if _llm_router is not None:
+        return _llm_router.create(**params)
+    return openai_client.chat.completions.create(**params)
+
+
+@contextlib.contextmanager
+def llm_priority(priority: str):
+    """Все LLM-вызовы внутри блока (и созданных в нём задач) — с этим классом."""
+    token = _llm_priority_override.set(priority)
+    try:
+        yield
+    finally:
+        _llm_priority_override.reset(token)
+
+
+def _priority_for(kind: str) -> str:
+    return _llm_priority_override.get() or _KIND_PRIORITY.get(kind, LIVE_TEXT)
+
+
+async def _run_with_breaker(kind: str, call, est_tokens: int):
+    """_llm_scheduler.run под circuit breaker.
+
+    Пока breaker открыт, вызов отклоняется сразу (CircuitOpenError) — кроме
+    проб (kind="probe"): ими фоновая задача проверяет, ожил ли провайдер.
+    Ошибки запроса (400 и т.п.) breaker не считает — провайдер при них жив.
+    """
+    if kind != "probe" and not _llm_breaker.allow():
+        raise CircuitOpenError("LLM-провайдер недоступен (circuit breaker открыт)")
+    try:
+        result = await _llm_scheduler.run(call, est_tokens=est_tokens, priority=_priority_for(kind))
+    except Exception as e:
+        if is_endpoint_failure(e):
+            _llm_breaker.record_failure(e)
+        raise
+    _llm_breaker.record_success(probe=kind == "probe")
+    return result
+
+
+async def llm_stream(kind: str, on_text, **params) -> tuple[str, str | None]:
+    """Потоковый вызов chat.completions через тот же планировщик.
+
+    on_text(накопленный_текст) вызывается на каждом куске ответа.
+    Возвращает (полный текст, finish_reason); usage берётся из последнего чанка.
+    """
+    est_prompt = count_message_tokens(params.get("messages", []), params.get("model", ""))
+
+    async def _call():
+        started = time.monotonic()
+        stream = await _completions_create(stream=True, stream_options={"include_usage": True}, **params)
+        parts, finish_reason, usage_chunk = [], None, None
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage_chunk = chunk
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    on_text("".join(parts))
+                finish_reason = choice.finish_reason or finish_reason
+        prompt_tokens, cached_tokens, completion_tokens = extract_usage(usage_chunk)
+        _llm_usage.record(kind, time.monotonic() - started, prompt_tokens, cached_tokens, completion_tokens,
+                          estimated_prompt_tokens=est_prompt)
+        return "".join(parts), finish_reason
+
+    limit = params.get("max_completion_tokens") or params.get("max_tokens") or 0
+    return await _run_with_breaker(kind, _call, est_prompt + limit)
+
+
+async def llm_create(kind: str, **params):
+    """Единая точка вызова chat.completions: очередь планировщика, задержка, usage.
+
+    kind — тип вызова для статистики (text, batch, vision, profile, ...).
+    cached_tokens из usage.prompt_tokens_details показывает, сколько входа
+    провайдер взял из prefix-кеша, — по нему видно, стабилен ли префикс.
+    Задержка считается без ожидания в очереди — оно в статистике планировщика.
+    """
+    est_prompt = count_message_tokens(params.get("messages", []), params.get("model", ""))
+
+    async def _call():
+        started = time.monotonic()
+        response = await _completions_create(**params)
+        elapsed = time.monotonic() - started
+        prompt_tokens, cached_tokens, completion_tokens = extract_usage(response)
+        _llm_usage.record(kind, elapsed, prompt_tokens, cached_tokens, completion_tokens,
+                          estimated_prompt_tokens=est_prompt)
+        # Дедлайн hedging — по времени обслуживания живых классификаций основной
+        # моделью: без ожидания в очереди и без фоновых (оценка, улучшение) вызовов
+        if kind == "text" and params.get("model") == LLM_MODEL and _priority_for(kind) == LIVE_TEXT:
+            _classify_latency.add(elapsed)
+        logger.info(f"LLM {kind}: вход оценка {est_prompt} / факт {prompt_tokens} (кеш {cached_tokens}), выход {completion_tokens}")
+        return response
+
+    limit = params.get("max_completion_tokens") or params.get("max_tokens") or 0
+    return await _run_with_breaker(kind, _call, est_prompt + limit)
+
+
 class SpamResult(Enum):
     SPAM = "СПАМ"
     NOT_SPAM = "НЕ_СПАМ"
@@ -249,18 +561,104 @@ def parse_llm_response(response_text: str) -> SpamResult:
     return SpamResult.MAYBE_SPAM
 
 
+def _few_shot_line(text: str, is_spam: bool) -> str:
+    label = "СПАМ" if is_spam else "НЕ_СПАМ"
+    return f"- «{text}» → {label}"
+
+
 def build_few_shot_block() -> str:
     examples = db.get_few_shot_examples(FEW_SHOT_EXAMPLES_COUNT)
     if not examples:
         return ""
+    examples = fit_examples(
+        [(text[:120].replace(chr(10), ' '), is_spam) for text, is_spam in examples],
+        FEW_SHOT_TOKEN_BUDGET, FEW_SHOT_EXAMPLE_MAX_TOKENS, LLM_MODEL, render=_few_shot_line,
+    )
     lines = ["Примеры из прошлых решений администратора:"]
-    for text, is_spam in examples:
-        label = "СПАМ" if is_spam else "НЕ_СПАМ"
-        lines.append(f"- «{text[:120].replace(chr(10), ' ')}» → {label}")
+    lines += [_few_shot_line(text, is_spam) for text, is_spam in examples]
     lines.append("")
     return "\n".join(lines)
 
 
+def _few_shot_retrieval() -> bool:
+    return (_few_shot_mode_override.get() or FEW_SHOT_MODE) == "retrieval"
+
+
+def retrieve_examples(normalized: str) -> list:
+    """Ближайшие к сообщению размеченные примеры [(text, is_spam), ...] под бюджет токенов."""
+    started = time.monotonic()
+    found = _few_shot_index.search(normalized, FEW_SHOT_RETRIEVAL_K, FEW_SHOT_RETRIEVAL_MIN_SCORE)
+    _few_shot_retrieval_latency.add(time.monotonic() - started)
+    return fit_examples(
+        [(text[:120].replace(chr(10), ' '), is_spam) for text, is_spam, _score in found],
+        FEW_SHOT_TOKEN_BUDGET, FEW_SHOT_EXAMPLE_MAX_TOKENS, LLM_MODEL, render=_few_shot_line,
+    )
+
+
+def _similar_for(message_text: str) -> list | None:
+    """Похожие примеры для сообщения или None вне режима retrieval."""
+    if not _few_shot_retrieval():
+        return None
+    return retrieve_examples(normalize_text(message_text.strip()))
+
+
+def _similar_examples_xml(examples: list) -> str:
+    if not examples:
+        return ""
+    lines = "\n".join(_few_shot_line(text, is_spam) for text, is_spam in examples)
+    return f"<similar_examples>\n{lines}\n</similar_examples>\n"
+
+
+def learn_training_example(text: str, is_spam: bool, spam_type: str = "text"):
+    """Новый обучающий пример → локальный классификатор и индекс похожих примеров.
+
+    Профильный спам (spam_type='context') в индекс не идёт — по той же
+    причине, что и в get_few_shot_examples: невинный текст с меткой СПАМ.
+    """
+    normalized = normalize_text(text or "")
+    _local_classifier.learn(normalized, is_spam)
+    if not is_spam or spam_type == "text":
+        _few_shot_index.add(normalized, is_spam)
+
+
+def build_few_shot_index():
+    _few_shot_index.build(
+        (normalize_text(text), bool(is_spam))
+        for text, is_spam, _source, _created in db.get_all_training_examples(text_only=True)
+        if text
+    )
+    logger.info(f"Индекс few-shot примеров: {len(_few_shot_index)}")
+
+
+def get_few_shot_block() -> str:
+    """Few-shot блок текущего поколения — его и подставляем в system prompt.
+
+    В режиме retrieval блок пустой: примеры подбираются к каждому сообщению
+    (retrieve_examples) и идут в user prompt.
+
+    build_few_shot_block() берёт последние примеры, поэтому каждый новый пример
+    сдвигает весь блок, и prefix-кеш провайдера промахивается. Здесь блок
+    перестраивается только если были новые примеры (mark_few_shot_dirty) и
+    с прошлой сборки прошло FEW_SHOT_REFRESH_SECONDS. Между сменами поколений
+    system prompt побайтно одинаков для данной версии промпта.
+    """
+    if _few_shot_retrieval():
+        return ""
+    snap = _few_shot_snapshot
+    now = time.monotonic()
+    if snap["block"] is None or (snap["dirty"] and now - snap["built_at"] >= FEW_SHOT_REFRESH_SECONDS):
+        block = build_few_shot_block()
+        if block != snap["block"]:
+            snap["generation"] += 1
+        snap.update(block=block, built_at=now, dirty=False)
+    return snap["block"]
+
+
+def mark_few_shot_dirty():
+    """Появился новый обучающий пример — следующее поколение few-shot соберётся по таймеру."""
+    _few_shot_snapshot["dirty"] = True
+
+
 def safe_format_prompt(template: str, message_text: str, few_shot_block: str) -> str:
     safe_text = message_text.replace("{", "{{").replace("}", "}}")
     try:
@@ -375,7 +773,8 @@ async def check_user_profile(user_id: int) -> str:
     # Если keywords не сработали, но есть личный канал — проверяем через LLM
     if personal_chat and len(profile_parts) >= 2:
         try:
-            resp = await openai_client.chat.completions.create(
+            resp = await llm_create(
+                "profile",
                 model=LLM_MODEL,
                 messages=[
                     {"role": "system", "content": "Ты проверяешь профили пользователей Telegram на спам. Ответь YES если профиль похож на спам/скам (реклама, букмекеры, крипта, мошенничество, продажа), иначе NO. Отвечай одним словом."},
@@ -394,6 +793,82 @@ async def check_user_profile(user_id: int) -> str:
     return ""
 
 
+def _signal_done(task: asyncio.Task):
+    """Снять задачу сигнала с учёта и забрать её исключение (иначе asyncio пишет
+    «Task exception was never retrieved»)."""
+    _signal_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.debug(f"Фоновый сигнал упал: {task.exception()}")
+
+
+def _spawn_signal(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _signal_tasks.add(task)
+    task.add_done_callback(_signal_done)
+    return task
+
+
+def prefetch_signal(kind: str, user_id: int, fn) -> asyncio.Task:
+    """Запустить вычисление сигнала риска в фоне (при входе в группу).
+
+    fn — фабрика корутины. Повторный вызов не дублирует работу: возвращает
+    уже запущенную задачу, пока она не протухла в кеше.
+    """
+    task = _join_prefetch.get((kind, user_id))
+    if task is None:
+        task = _spawn_signal(fn())
+        _join_prefetch.set((kind, user_id), task)
+    return task
+
+
+def start_signal(kind: str, user_id: int, fn) -> asyncio.Task:
+    """Задача сигнала: предзагруженная при входе (если ещё жива) или новая.
+
+    Если предзагрузка ещё в полёте — берём её, а не запускаем второй запрос.
+    """
+    task = _join_prefetch.get((kind, user_id))
+    if task is not None and not task.cancelled():
+        _perf_counters[f"prefetch_hits_{kind}"] += 1
+        return task
+    _perf_counters[f"prefetch_misses_{kind}"] += 1
+    return _spawn_signal(fn())
+
+
+async def await_signal(stage: str, task: asyncio.Task, deadline: float, default):
+    """Результат задачи сигнала, но не позже deadline (time.monotonic()).
+
+    По таймауту возвращается default, а сама задача продолжает работать
+    (shield): её может ждать кто-то ещё, и она же лежит в кеше предзагрузки.
+    Время ожидания записывается как вклад стадии в критический путь.
+    """
+    started = time.monotonic()
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - started))
+    except asyncio.TimeoutError:
+        _perf_counters[f"signal_timeouts_{stage}"] += 1
+        return default
+    except asyncio.CancelledError:
+        # Отменили саму задачу (вытеснена из кеша предзагрузки), а не нас
+        if not task.cancelled():
+            raise
+        return default
+    except Exception as e:
+        logger.warning(f"Сигнал {stage} упал: {e}")
+        return default
+    finally:
+        _stage_latency[stage].add(time.monotonic() - started)
+
+
+async def _photo_url(message: types.Message) -> str | None:
+    """URL самого большого фото сообщения для Vision API."""
+    try:
+        file_info = await bot.get_file(message.photo[-1].file_id)
+        return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
+    except Exception as e:
+        logger.error(f"Ошибка получения фото: {e}")
+        return None
+
+
 def _classify_spam_type(text: str) -> str:
     """Определяет, можно ли распознать спам по тексту или только по контексту.
 
@@ -445,24 +920,78 @@ async def _get_profile_data(user_id: int) -> dict:
 # ──────────────────────────────────────────────
 
 # Structured output schema — модель ФИЗИЧЕСКИ не может ответить ничего другого
-CLASSIFICATION_SCHEMA = {
+def _classification_schema(with_confidence: bool = False, with_reasoning: bool = True) -> dict:
+    """Structured output для одного сообщения.
+
+    with_confidence — для nano-ступени каскада; with_reasoning=False — только
+    вердикт (горячий путь, объяснение запрашивается потом, см. explain_verdict).
+    """
+    properties = {
+        "result": {
+            "type": "string",
+            "enum": ["SPAM", "NOT_SPAM", "MAYBE_SPAM"]
+        },
+    }
+    if with_reasoning:
+        properties["reasoning"] = {
+            "type": "string",
+            "description": "Brief explanation why this classification was chosen (1-2 sentences)"
+        }
+    if with_confidence:
+        properties["confidence"] = {
+            "type": "number",
+            "description": "How sure you are in the result, from 0.0 (guess) to 1.0 (certain)"
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "spam_classification",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            }
+        }
+    }
+
+
+CLASSIFICATION_SCHEMA = _classification_schema()
+CASCADE_CLASSIFICATION_SCHEMA = _classification_schema(with_confidence=True)
+VERDICT_ONLY_SCHEMA = _classification_schema(with_reasoning=False)
+CASCADE_VERDICT_ONLY_SCHEMA = _classification_schema(with_confidence=True, with_reasoning=False)
+
+# Батч-вариант: один ответ на несколько сообщений, вердикт на каждый id
+BATCH_CLASSIFICATION_SCHEMA = {
     "type": "json_schema",
     "json_schema": {
-        "name": "spam_classification",
+        "name": "spam_classification_batch",
         "strict": True,
         "schema": {
             "type": "object",
             "properties": {
-                "result": {
-                    "type": "string",
-                    "enum": ["SPAM", "NOT_SPAM", "MAYBE_SPAM"]
-                },
-                "reasoning": {
-                    "type": "string",
-                    "description": "Brief explanation why this classification was chosen (1-2 sentences)"
+                "verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "result": {
+                                "type": "string",
+                                "enum": ["SPAM", "NOT_SPAM", "MAYBE_SPAM"]
+                            },
+                            "reasoning": {
+                                "type": "string",
+                                "description": "Brief explanation for this item (1-2 sentences)"
+                            }
+                        },
+                        "required": ["id", "result", "reasoning"],
+                        "additionalProperties": False,
+                    }
                 }
             },
-            "required": ["result", "reasoning"],
+            "required": ["verdicts"],
             "additionalProperties": False,
         }
     }
@@ -476,12 +1005,397 @@ _STRUCTURED_MAP = {
 }
 
 
+def _build_context_xml(user_msg_count: int, is_cas_banned: bool, similar: list = None) -> str:
+    """Блок <context> для user prompt (пустая строка, если контекста нет).
+
+    similar — похожие размеченные примеры (режим retrieval), идут перед <context>.
+    """
+    examples_xml = _similar_examples_xml(similar)
+    context_parts = []
+    if user_msg_count > 0:
+        context_parts.append(f"user_messages_in_group: {user_msg_count}")
+    if is_cas_banned:
+        context_parts.append("cas_banned: true")
+    if not context_parts:
+        return examples_xml
+    return examples_xml + "<context>\n" + "\n".join(context_parts) + "\n</context>\n"
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _verdict_cache_key(
+    prompt_template: str, few_shot: str, message_text: str,
+    user_msg_count: int = 0, is_cas_banned: bool = False,
+) -> tuple:
+    """Ключ кеша вердиктов: (текст, версия промпта, поколение few-shot, модель, контекст).
+
+    Промпт и few-shot входят в ключ хешем — после /improve, /rollback или
+    нового обучающего примера старые записи перестают совпадать сами. В режиме
+    retrieval примеры подбираются к сообщению, общий блок пуст — в ключ идёт
+    поколение индекса похожих примеров.
+    Контекст (счётчик сообщений, CAS) меняет ответ модели, поэтому тоже в ключе.
+    """
+    context_xml = _build_context_xml(user_msg_count, is_cas_banned)
+    few_shot_key = _digest(few_shot)
+    if _few_shot_retrieval():
+        few_shot_key += f":r{_few_shot_index.generation}"
+    return (
+        _digest(normalize_text(message_text)),
+        _digest(prompt_template),
+        few_shot_key,
+        f"{LLM_FAST_MODEL}>{LLM_MODEL}" if _cascade_active() else LLM_MODEL,
+        _digest(context_xml) if context_xml else "",
+    )
+
+
+def _build_system_prompt(prompt_template: str, few_shot: str) -> str:
+    """System prompt: инструкции + few-shot (доверенный контекст)."""
+    system_prompt = safe_format_prompt(prompt_template, "", few_shot)
+    # Убираем пустое «Сообщение: «»» из system prompt
+    return system_prompt.replace("Сообщение: «»", "").strip()
+
+
+# Reasoning заглушки ВОЗМОЖНО_СПАМ, когда ответ модели не разобран (пустой,
+# обрезанный по бюджету, без result) — такой вердикт не кешируется
+UNPARSED_REASON = "Ответ модели не распознан"
+
+
+def _parse_classification(raw: str) -> tuple[SpamResult, str]:
+    """Structured output → (SpamResult, reasoning); свободный текст — через parse_llm_response."""
+    try:
+        parsed = json_module.loads(raw)
+        result_key = parsed.get("result")
+        if result_key not in _STRUCTURED_MAP:
+            return SpamResult.MAYBE_SPAM, UNPARSED_REASON
+        return _STRUCTURED_MAP[result_key], parsed.get("reasoning", "")
+    except (json_module.JSONDecodeError, AttributeError):
+        # Fallback: parse as free text (для совместимости со старыми моделями)
+        result = parse_llm_response(raw)
+        # ВОЗМОЖНО_СПАМ без слова «возможно/maybe» — заглушка parse_llm_response
+        if result == SpamResult.MAYBE_SPAM and not re.search(r"ВОЗМОЖНО|MAYBE", raw.upper()):
+            return result, UNPARSED_REASON
+        return result, ""
+
+
+# Префикс информационного контекста в <message>. Заметка передаётся отдельно
+# от текста и дописывается после обрезки — в тексте её никто не ищет, иначе
+# пользователь впечатал бы маркер сам
+_CONTEXT_NOTE_MARKER = "[CONTEXT:"
+
+
+def _cap_message(normalized: str) -> str:
+    """Текст сообщения в пределах LLM_MESSAGE_TOKEN_BUDGET."""
+    capped = truncate_to_budget(normalized, LLM_MESSAGE_TOKEN_BUDGET, LLM_MODEL)
+    if capped is not normalized:
+        _perf_counters["messages_truncated"] += 1
+    return capped
+
+
+def _with_context_note(text: str, context_note: str = "") -> str:
+    """Текст с дописанной контекст-заметкой бота (если она есть)."""
+    if not context_note:
+        return text
+    return f"{text}\n\n{_CONTEXT_NOTE_MARKER} {context_note}]"
+
+
+_URL_RE = re.compile(r"https?://|www\.|t\.me/|\b[\w-]+\.(?:com|ru|io|me|net|org|xyz|top|site|online)\b", re.I)
+_MENTION_RE = re.compile(r"@\w{4,}")
+_MIXED_SCRIPT_RE = re.compile(r"\b(?=\w*[а-яё])(?=\w*[a-z])\w+\b", re.I)
+
+
+def _classification_policy(message_text: str, user_msg_count: int = 0, has_risk: bool = False) -> tuple[str, str, int]:
+    """Политика вызова по дешёвым признакам: (tier, reasoning_effort, max_tokens).
+
+    simple  — короткая реплика без ссылок, упоминаний, смеси алфавитов и сигналов
+    complex — сигналы риска или ≥2 признаков (ссылки, упоминания, смесь
+              алфавитов в словах, длинный текст, первое сообщение)
+    normal  — всё остальное, глобальные LLM_REASONING_EFFORT / LLM_MAX_TOKENS
+    """
+    text = message_text or ""
+    links = bool(_URL_RE.search(text))
+    mentions = bool(_MENTION_RE.search(text))
+    mixed = bool(_MIXED_SCRIPT_RE.search(text))
+    if has_risk:
+        return "complex", LLM_EFFORT_COMPLEX, LLM_MAX_TOKENS_COMPLEX
+    score = links + mentions + mixed + (len(text) > 500) + (user_msg_count == 0)
+    if score >= 2:
+        return "complex", LLM_EFFORT_COMPLEX, LLM_MAX_TOKENS_COMPLEX
+    if len(text) <= 80 and not (links or mentions or mixed):
+        return "simple", LLM_EFFORT_SIMPLE, LLM_MAX_TOKENS_SIMPLE
+    return "normal", LLM_REASONING_EFFORT, LLM_MAX_TOKENS
+
+
+def _budget_exhausted(response) -> bool:
+    """Модель выжгла лимит (обычно reasoning-токенами) и не дописала JSON."""
+    choice = response.choices[0]
+    return choice.finish_reason == "length" or not (choice.message.content or "").strip()
+
+
+_STREAM_RESULT_RE = re.compile(r'"result"\s*:\s*"(SPAM|NOT_SPAM|MAYBE_SPAM)"')
+
+
+def _reasoning_key(message_text: str) -> str:
+    """Ключ фонового reasoning: нормализованный текст сообщения.
+    Тот же ключ получается из message.text при отправке отчёта."""
+    return _digest(normalize_text(message_text.strip()))
+
+
+async def _classify_streaming(
+    messages: list, effort: str, max_tokens: int, reasoning_key: str = None,
+) -> tuple[SpamResult, str] | None:
+    """Потоковая классификация: возвращается, как только в JSON дописан result.
+
+    reasoning дочитывается в фоне и кладётся в _pending_reasoning[reasoning_key]
+    для отчёта админу. None — поток закончился без вердикта.
+    """
+    started = time.monotonic()
+    verdict = asyncio.get_running_loop().create_future()
+
+    def on_text(text: str):
+        if not verdict.done():
+            m = _STREAM_RESULT_RE.search(text)
+            if m:
+                _stream_time_to_verdict.add(time.monotonic() - started)
+                verdict.set_result(_STRUCTURED_MAP[m.group(1)])
+
+    stream = asyncio.ensure_future(llm_stream(
+        "stream",
+        on_text,
+        model=LLM_MODEL,
+        messages=messages,
+        response_format=CLASSIFICATION_SCHEMA,
+        **_token_limit_param(max_tokens or LLM_MAX_TOKENS),
+        **_temperature_param(LLM_MODEL, LLM_TEMPERATURE),
+        **_reasoning_effort_param(LLM_MODEL, effort),
+        timeout=LLM_TIMEOUT,
+    ))
+    await asyncio.wait({stream, verdict}, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _finish() -> str:
+        try:
+            raw, _ = await stream
+        except Exception as e:
+            logger.warning(f"Поток классификации оборвался после вердикта: {e}")
+            return ""
+        _stream_time_to_complete.add(time.monotonic() - started)
+        reasoning = _parse_classification(raw.strip())[1]
+        return "" if reasoning == UNPARSED_REASON else reasoning
+
+    if verdict.done():
+        rest = asyncio.ensure_future(_finish())
+        if reasoning_key:
+            _pending_reasoning.set(reasoning_key, rest)
+        logger.info(f"LLM stream → {verdict.result().value} за {time.monotonic() - started:.2f}s")
+        return verdict.result(), ""
+
+    raw, finish_reason = stream.result()  # поток завершился (или упал) раньше вердикта
+    _stream_time_to_complete.add(time.monotonic() - started)
+    if finish_reason == "length" or not raw.strip():
+        return None
+    return _parse_classification(raw.strip())
+
+
+async def _classify_single(
+    system_prompt: str, context_xml: str, normalized: str, policy: tuple = None, reasoning_key: str = None,
+) -> tuple[SpamResult, str]:
+    """Один запрос к LLM на одно сообщение.
+
+    policy — (tier, effort, max_tokens) из _classification_policy; без неё — по тексту.
+    reasoning_key — куда положить фоновый reasoning в потоковом режиме.
+    Если бюджет исчерпан, запрос повторяется один раз с удвоенным лимитом:
+    пустой ответ иначе превратился бы в ВОЗМОЖНО_СПАМ.
+    """
+    if LLM_VERDICT_ONLY:
+        _perf_counters["verdict_only_calls"] += 1
+    tier, effort, max_tokens = policy or _classification_policy(normalized)
+    _perf_counters[f"policy_{tier}"] += 1
+    # User prompt: sandwich defense с XML-тегами
+    user_prompt = (
+        f"{context_xml}"
+        f"<message>\n{normalized}\n</message>\n\n"
+        f"Classify the message above. Respond with JSON."
+    )
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    if LLM_STREAMING and not LLM_VERDICT_ONLY:
+        streamed = await _classify_streaming(messages, effort, max_tokens, reasoning_key)
+        if streamed is not None:
+            return streamed
+        # Поток закончился без вердикта — обычный запрос с повтором по бюджету
+    response = await _hedged_classification(messages, effort, max_tokens)
+    if _budget_exhausted(response) and max_tokens < LLM_MAX_TOKENS_RETRY_CAP:
+        _perf_counters["budget_retries"] += 1
+        logger.info(f"LLM: бюджет {max_tokens} исчерпан ({tier}), повтор с {min(max_tokens * 2, LLM_MAX_TOKENS_RETRY_CAP)}")
+        response = await _classification_request(
+            LLM_MODEL, messages, effort=effort, max_tokens=min(max_tokens * 2, LLM_MAX_TOKENS_RETRY_CAP),
+        )
+    if _budget_exhausted(response):
+        _perf_counters["budget_exhausted"] += 1
+    raw = (response.choices[0].message.content or "").strip()
+    result, reasoning = _parse_classification(raw)
+    logger.info(f"LLM raw: '{raw}' → {result.value}")
+    return result, reasoning
+
+
+def _classification_request(
+    model: str, messages: list, kind: str = "text", effort: str = None, max_tokens: int = None,
+):
+    return llm_create(
+        kind,
+        model=model,
+        messages=messages,
+        response_format=VERDICT_ONLY_SCHEMA if LLM_VERDICT_ONLY else CLASSIFICATION_SCHEMA,
+        **_token_limit_param(max_tokens or LLM_MAX_TOKENS, model),
+        **_temperature_param(model, LLM_TEMPERATURE),
+        **_reasoning_effort_param(model, effort),
+        timeout=LLM_TIMEOUT,
+    )
+
+
+def _hedge_delay() -> float:
+    """Через сколько секунд без ответа отправлять hedge-запрос."""
+    floor = LLM_HEDGE_MIN_DELAY_MS / 1000
+    if len(_classify_latency) < LLM_HEDGE_MIN_SAMPLES:
+        return max(floor, LLM_TIMEOUT / 4)
+    return max(floor, _classify_latency.percentile(LLM_HEDGE_PERCENTILE))
+
+
+def _estimate_hedge_saving(elapsed: float) -> float:
+    """Сколько сэкономил выигравший hedge: медиана задержек основной модели
+    из хвоста длиннее elapsed (или таймаут, если таких не было) минус elapsed."""
+    tail = [s for s in _classify_latency.samples() if s > elapsed]
+    expected = sorted(tail)[len(tail) // 2] if tail else LLM_TIMEOUT
+    return max(0.0, expected - elapsed)
+
+
+async def _hedged_classification(messages: list, effort: str = None, max_tokens: int = None):
+    """Запрос к основной модели; если она не успела к _hedge_delay() —
+    второй запрос к LLM_HEDGE_MODEL, берётся первый успешный ответ.
+
+    Hedge не отправляется, если в очереди планировщика уже ждут вызовы:
+    при перегрузке второй запрос только удлинит очередь.
+    """
+    started = time.monotonic()
+    _perf_counters["hedge_eligible"] += 1
+    primary = asyncio.ensure_future(
+        _classification_request(LLM_MODEL, messages, effort=effort, max_tokens=max_tokens)
+    )
+    if not LLM_HEDGE_ENABLED:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=_hedge_delay())
+    if done or _llm_scheduler.queued:
+        return await primary
+
+    _perf_counters["hedges"] += 1
+    hedge = asyncio.ensure_future(
+        _classification_request(LLM_HEDGE_MODEL or LLM_MODEL, messages, kind="hedge",
+                                effort=effort, max_tokens=max_tokens)
+    )
+    pending = {primary, hedge}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [task for task in done if task.exception() is None]
+            if not ok:
+                if not pending:
+                    raise done.pop().exception()
+                continue  # один упал — ждём второй
+            if primary in ok:
+                return primary.result()
+            elapsed = time.monotonic() - started
+            _perf_counters["hedge_wins"] += 1
+            _perf_counters["hedge_saved_ms"] += int(_estimate_hedge_saving(elapsed) * 1000)
+            return hedge.result()
+    finally:
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
+
+
+# Порядок reasoning_effort: батч идёт с самым сильным из усилий своих сообщений
+_EFFORT_RANK = {"minimal": 0, "low": 1, "medium": 2, "high": 3}
+
+
+async def _run_classification_batch(system_prompt: str, items: list) -> list:
+    """Классификация батча [(context_xml, normalized, policy, reasoning_key), ...] одним запросом.
+
+    Сообщения с одинаковым system prompt идут в одном user turn, каждое —
+    в своём <item id>. Лимит токенов — сумма лимитов политик сообщений, effort —
+    самый сильный из них. Вердикты раскладываются по id; если батч-запрос упал,
+    выжег бюджет или какого-то id нет в ответе — эти сообщения классифицируются
+    поодиночке со своей политикой (и повтором по бюджету).
+    """
+    if len(items) == 1:
+        return [await _classify_single(system_prompt, *items[0])]
+
+    blocks = [
+        f'<item id="{i}">\n{context_xml}<message>\n{normalized}\n</message>\n</item>'
+        for i, (context_xml, normalized, *_) in enumerate(items, 1)
+    ]
+    policies = [policy for _, _, policy, *_ in items]
+    effort = max((p[1] for p in policies), key=lambda e: _EFFORT_RANK.get(e, 0))
+    max_tokens = sum(p[2] for p in policies)
+    user_prompt = (
+        "\n".join(blocks)
+        + "\n\nClassify EACH message above independently; <context> applies only to its own item. "
+        "Respond with JSON: exactly one verdict per item id."
+    )
+    verdicts = {}
+    try:
+        response = await llm_create(
+            "batch",
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            response_format=BATCH_CLASSIFICATION_SCHEMA,
+            **_token_limit_param(max_tokens),
+            **_temperature_param(LLM_MODEL, LLM_TEMPERATURE),
+            **_reasoning_effort_param(LLM_MODEL, effort),
+            timeout=LLM_TIMEOUT,
+        )
+        if _budget_exhausted(response):
+            # Обрезанный JSON мог бы отдать часть id — одиночные запросы
+            # с повтором по бюджету надёжнее
+            _perf_counters["batch_budget_exhausted"] += 1
+            raise ValueError(f"бюджет {max_tokens} токенов исчерпан")
+        parsed = json_module.loads((response.choices[0].message.content or "").strip())
+        for v in parsed.get("verdicts", []):
+            if isinstance(v, dict) and v.get("result") in _STRUCTURED_MAP:
+                verdicts[v.get("id")] = (_STRUCTURED_MAP[v["result"]], v.get("reasoning", ""))
+    except Exception as e:
+        logger.warning(f"Батч-классификация ({len(items)} сообщений) не удалась, по одному: {e}")
+
+    missing = [i for i in range(1, len(items) + 1) if i not in verdicts]
+    if missing:
+        _perf_counters["batch_fallback_items"] += len(missing)
+        singles = await asyncio.gather(
+            *[_classify_single(system_prompt, *items[i - 1]) for i in missing],
+            return_exceptions=True,
+        )
+        verdicts.update(zip(missing, singles))
+    logger.info(f"LLM batch: {len(items)} сообщений, добрано поодиночке: {len(missing)}")
+    return [verdicts[i] for i in range(1, len(items) + 1)]
+
+
+_classification_batcher = MicroBatcher(
+    _run_classification_batch, max_size=LLM_BATCH_MAX_SIZE, max_wait=LLM_BATCH_MAX_WAIT_MS / 1000,
+)
+
+
 async def classify_message(
     prompt_template: str,
     message_text: str,
     few_shot: str = "",
     user_msg_count: int = 0,
     is_cas_banned: bool = False,
+    context_note: str = "",
 ) -> tuple[SpamResult, str]:
     """Классификация сообщения с защитой от prompt injection.
 
@@ -490,61 +1404,190 @@ async def classify_message(
     2. System prompt содержит инструкции классификации
     3. User prompt содержит только сообщение в XML-тегах (sandwich defense)
     4. Structured output (JSON enum) — модель не может ответить произвольным текстом
+
+    При LLM_BATCH_ENABLED запрос ждёт попутчиков с тем же system prompt
+    (до LLM_BATCH_MAX_WAIT_MS) и уходит одним батчем. Сообщения с политикой
+    complex (сигналы риска, много признаков) в батч не попадают.
+
+    context_note — информационный контекст бота; дописывается после обрезки
+    текста и включает политику для сообщений с сигналами риска.
     """
     # Нормализация текста
-    normalized = normalize_text(message_text)
+    normalized = _with_context_note(_cap_message(normalize_text(message_text)), context_note)
+    system_prompt = _build_system_prompt(prompt_template, few_shot)
+    # Контекст пользователя (+ похожие примеры в режиме retrieval)
+    context_xml = _build_context_xml(user_msg_count, is_cas_banned, _similar_for(message_text))
 
-    # System prompt: инструкции + few-shot (доверенный контекст)
-    system_prompt = safe_format_prompt(prompt_template, "", few_shot)
-    # Убираем пустое «Сообщение: «»» из system prompt
-    system_prompt = system_prompt.replace("Сообщение: «»", "").strip()
+    has_risk = is_cas_banned or bool(context_note)
+    policy = _classification_policy(message_text, user_msg_count, has_risk)
+    item = (context_xml, normalized, policy, _reasoning_key(message_text))
 
-    # Контекст пользователя
-    context_parts = []
-    if user_msg_count > 0:
-        context_parts.append(f"user_messages_in_group: {user_msg_count}")
-    if is_cas_banned:
-        context_parts.append("cas_banned: true")
-    context_xml = ""
-    if context_parts:
-        context_xml = "<context>\n" + "\n".join(context_parts) + "\n</context>\n"
+    # Фоновые вызовы в батч к живым не попадают: батч уходит с классом
+    # того, кто его открыл
+    if LLM_BATCH_ENABLED and _llm_priority_override.get() is None and policy[0] != "complex":
+        return await _classification_batcher.submit(system_prompt, item)
+    return await _classify_single(system_prompt, *item)
 
-    # User prompt: sandwich defense с XML-тегами
+
+def _cascade_active() -> bool:
+    return LLM_CASCADE_ENABLED and bool(LLM_FAST_MODEL) and LLM_FAST_MODEL != LLM_MODEL
+
+
+async def _classify_fast(system_prompt: str, context_xml: str, normalized: str) -> tuple[SpamResult, str, float]:
+    """Nano-ступень каскада: вердикт + уверенность модели (0..1)."""
+    if LLM_VERDICT_ONLY:
+        _perf_counters["verdict_only_calls"] += 1
     user_prompt = (
         f"{context_xml}"
         f"<message>\n{normalized}\n</message>\n\n"
         f"Classify the message above. Respond with JSON."
     )
-
-    response = await openai_client.chat.completions.create(
-        model=LLM_MODEL,
+    response = await llm_create(
+        "fast",
+        model=LLM_FAST_MODEL,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ],
-        response_format=CLASSIFICATION_SCHEMA,
-        **_token_limit_param(LLM_MAX_TOKENS),
-        **_temperature_param(LLM_MODEL, LLM_TEMPERATURE),
-        **_reasoning_effort_param(LLM_MODEL),
+        response_format=CASCADE_VERDICT_ONLY_SCHEMA if LLM_VERDICT_ONLY else CASCADE_CLASSIFICATION_SCHEMA,
+        **_token_limit_param(LLM_MAX_TOKENS, LLM_FAST_MODEL),
+        **_temperature_param(LLM_FAST_MODEL, LLM_TEMPERATURE),
+        **_reasoning_effort_param(LLM_FAST_MODEL),
         timeout=LLM_TIMEOUT,
     )
-    raw = response.choices[0].message.content.strip()
+    raw = (response.choices[0].message.content or "").strip()
+    result, reasoning = _parse_classification(raw)
+    try:
+        confidence = float(json_module.loads(raw).get("confidence", 0.0))
+    except (json_module.JSONDecodeError, AttributeError, TypeError, ValueError):
+        confidence = 0.0
+    logger.info(f"LLM fast raw: '{raw}' → {result.value}")
+    return result, reasoning, confidence
 
-    # Parse structured output
-    reasoning = ""
+
+async def _cascade_audit(fast_result: SpamResult, prompt_template: str, message_text: str, few_shot: str,
+                         user_msg_count: int, is_cas_banned: bool, context_note: str = ""):
+    """Фоновая перепроверка принятого nano-вердикта основной моделью."""
     try:
-        parsed = json_module.loads(raw)
-        result_key = parsed.get("result", "MAYBE_SPAM")
-        result = _STRUCTURED_MAP.get(result_key, SpamResult.MAYBE_SPAM)
-        reasoning = parsed.get("reasoning", "")
-    except (json_module.JSONDecodeError, AttributeError):
-        # Fallback: parse as free text (для совместимости со старыми моделями)
-        result = parse_llm_response(raw)
+        with llm_priority(EVALUATION):
+            strong_result, _ = await classify_message(
+                prompt_template, message_text, few_shot, user_msg_count, is_cas_banned, context_note
+            )
+    except Exception as e:
+        logger.debug(f"Cascade audit не удался: {e}")
+        return
+    _perf_counters["cascade_audits"] += 1
+    if strong_result != fast_result:
+        _perf_counters["cascade_audit_disagreements"] += 1
+        logger.info(f"Cascade audit: nano={fast_result.value}, основная={strong_result.value} «{message_text[:80]}»")
 
-    logger.info(f"LLM raw: '{raw}' → {result.value}")
+
+async def classify_message_cascade(
+    prompt_template: str,
+    message_text: str,
+    few_shot: str = "",
+    user_msg_count: int = 0,
+    is_cas_banned: bool = False,
+    context_note: str = "",
+) -> tuple[SpamResult, str]:
+    """Каскад: nano-модель, при неуверенности — основная (classify_message).
+
+    Наверх уходят MAYBE_SPAM и ответы с confidence < LLM_CASCADE_MIN_CONFIDENCE;
+    сообщения с сигналами риска сюда не попадают вовсе (см. check_message_with_llm).
+    """
+    normalized = _with_context_note(_cap_message(normalize_text(message_text)), context_note)
+    system_prompt = _build_system_prompt(prompt_template, few_shot)
+    context_xml = _build_context_xml(user_msg_count, is_cas_banned, _similar_for(message_text))
+    _perf_counters["cascade_calls"] += 1
+    try:
+        fast_result, fast_reasoning, confidence = await _classify_fast(system_prompt, context_xml, normalized)
+    except Exception as e:
+        logger.warning(f"Nano-ступень каскада упала, сразу основная модель: {e}")
+        _perf_counters["cascade_fast_errors"] += 1
+        return await classify_message(prompt_template, message_text, few_shot, user_msg_count, is_cas_banned, context_note)
+
+    if fast_result != SpamResult.MAYBE_SPAM and confidence >= LLM_CASCADE_MIN_CONFIDENCE:
+        _perf_counters["cascade_fast_final"] += 1
+        if random.random() < LLM_CASCADE_AUDIT_RATE:
+            asyncio.create_task(_cascade_audit(
+                fast_result, prompt_template, message_text, few_shot, user_msg_count, is_cas_banned, context_note
+            ))
+        return fast_result, fast_reasoning
+
+    _perf_counters["cascade_escalations"] += 1
+    result, reasoning = await classify_message(
+        prompt_template, message_text, few_shot, user_msg_count, is_cas_banned, context_note
+    )
+    if fast_result != SpamResult.MAYBE_SPAM and result != fast_result:
+        _perf_counters["cascade_disagreements"] += 1
     return result, reasoning
 
 
+async def explain_verdict(message_text: str, result: SpamResult) -> str:
+    """Объяснение вердикта для отчёта админу (горячий путь отвечает без reasoning).
+
+    System prompt тот же, что у классификации, — префикс попадает в кеш
+    провайдера. Ошибка не мешает отчёту: вернётся пустая строка.
+    """
+    verdict = next(k for k, v in _STRUCTURED_MAP.items() if v == result)
+    system_prompt = _build_system_prompt(db.get_current_prompt(), get_few_shot_block())
+    user_prompt = (
+        f"<message>\n{_cap_message(normalize_text(message_text))}\n</message>\n\n"
+        f"The message above was classified as {verdict}. "
+        f"Explain why in 1-2 sentences, in Russian. Plain text, no JSON."
+    )
+    try:
+        response = await llm_create(
+            "explain",
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            **_token_limit_param(LLM_MAX_TOKENS),
+            **_temperature_param(LLM_MODEL, LLM_TEMPERATURE),
+            **_reasoning_effort_param(LLM_MODEL),
+            timeout=LLM_TIMEOUT,
+        )
+        return (response.choices[0].message.content or "").strip()
+    except Exception as e:
+        logger.warning(f"Не удалось получить объяснение вердикта: {e}")
+        return ""
+
+
+async def _report_reasoning(message: types.Message, result: SpamResult, reasoning: str) -> str:
+    """reasoning для отчёта: если вердикт пришёл без объяснения — берём
+    догружаемый в фоне (потоковый режим) или запрашиваем его сейчас.
+    Полученное объяснение дописывается в запись о сообщении — для аудита
+    решений админа и разметки обучающих примеров."""
+    text = message.text or message.caption or ""
+    if reasoning or not text:
+        return reasoning
+    pending = _pending_reasoning.pop(_reasoning_key(text))
+    if pending is not None:
+        try:
+            reasoning = await asyncio.wait_for(pending, timeout=LLM_TIMEOUT)
+        except Exception:
+            reasoning = ""
+    if not reasoning and LLM_VERDICT_ONLY:
+        reasoning = await explain_verdict(text, result)
+    if reasoning:
+        _store_reasoning(message, reasoning)
+    return reasoning
+
+
+def _store_reasoning(message: types.Message, reasoning: str):
+    key = (message.chat.id, message.message_id)
+    try:
+        db.update_message_reasoning(message.message_id, message.chat.id, reasoning)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить объяснение вердикта: {e}")
+        return
+    cached = _recent_messages.get(key)
+    if cached is not None:
+        _recent_messages.set(key, cached[:4] + (reasoning,))
+
+
 async def classify_image(
     image_url: str,
     caption: str = "",
@@ -558,9 +1601,8 @@ async def classify_image(
     vision-инструкция: анализировать текст на картинке.
     """
     learned_prompt = db.get_current_prompt()
-    few_shot = build_few_shot_block()
-    base_prompt = safe_format_prompt(learned_prompt, "", few_shot)
-    base_prompt = base_prompt.replace("Сообщение: «»", "").strip()
+    few_shot = get_few_shot_block()
+    base_prompt = _build_system_prompt(learned_prompt, few_shot)
     system_prompt = (
         base_prompt
         + "\n\nОСОБЫЙ РЕЖИМ: тебе придёт ИЗОБРАЖЕНИЕ из чата. Прочитай текст на картинке "
@@ -585,7 +1627,8 @@ async def classify_image(
     text_part += "\nClassify this image. Respond with JSON."
     user_content.append({"type": "text", "text": text_part})
 
-    response = await openai_client.chat.completions.create(
+    response = await llm_create(
+        "vision",
         model=LLM_MODEL,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -597,21 +1640,85 @@ async def classify_image(
         **_reasoning_effort_param(LLM_MODEL),
         timeout=LLM_TIMEOUT,
     )
-    raw = response.choices[0].message.content.strip()
-
-    reasoning = ""
-    try:
-        parsed = json_module.loads(raw)
-        result_key = parsed.get("result", "MAYBE_SPAM")
-        result = _STRUCTURED_MAP.get(result_key, SpamResult.MAYBE_SPAM)
-        reasoning = parsed.get("reasoning", "")
-    except (json_module.JSONDecodeError, AttributeError):
-        result = parse_llm_response(raw)
+    raw = (response.choices[0].message.content or "").strip()
+    result, reasoning = _parse_classification(raw)
 
     logger.info(f"Vision LLM raw: '{raw}' → {result.value}")
     return result, reasoning
 
 
+# ──────────────────────────────────────────────
+# Локальный классификатор (pre-filter перед LLM)
+# ──────────────────────────────────────────────
+
+def _local_training_examples() -> list:
+    """[(нормализованный текст, is_spam), ...] из сообщений с известной меткой и training_examples.
+
+    Берём только решения админа и вердикты, вынесенные моделью (как
+    _risk_training_rows): решения самого классификатора, риск-скора и
+    запасных путей без LLM — догадки, на них пороги калибровать нельзя.
+    """
+    examples = {}
+    for text, raw, is_spam, by_admin in db.get_labeled_messages(limit=20000):
+        if by_admin or _risk_record(raw).get("by") in _MODEL_STAGES:
+            examples[normalize_text(text)] = bool(is_spam)
+    # Решения админа и пересланный спам надёжнее меток бота — записываются поверх
+    for text, is_spam, _source, _created in db.get_all_training_examples(text_only=True):
+        if text:
+            examples[normalize_text(text)] = bool(is_spam)
+    return list(examples.items())
+
+
+async def train_local_classifier() -> dict:
+    """Переобучить локальный классификатор и откалибровать пороги (CPU, секунды).
+
+    Выборка и обучение — в рабочем потоке, живой классификатор тем временем
+    отвечает старой моделью. Новые модель и пороги подменяются на event loop
+    одним присваиванием; решения админа, выученные за время обучения, доучиваются.
+    """
+    # Запись — до чтения выборки: пример, попавший и туда, и в запись, не задвоится
+    _local_classifier.start_recording()
+    try:
+        examples = await asyncio.to_thread(_local_training_examples)
+        state = await asyncio.to_thread(
+            _local_classifier.fit, examples,
+            target_fpr=LOCAL_CLASSIFIER_TARGET_FPR, target_fnr=LOCAL_CLASSIFIER_TARGET_FNR,
+            min_per_class=LOCAL_CLASSIFIER_MIN_PER_CLASS,
+        )
+    except BaseException:
+        _local_classifier.stop_recording()
+        raise
+    report = _local_classifier.install(state, known=examples)
+    if report["calibrated"]:
+        logger.info(
+            f"Локальный классификатор: {report['examples']} примеров, покрытие {report['coverage']:.0%}, "
+            f"FPR {report['fpr']:.2%}, FNR {report['fnr']:.2%}"
+        )
+    else:
+        logger.info(f"Локальный классификатор: мало данных для калибровки ({report['examples']} примеров)")
+    return report
+
+
+def _local_verdict(normalized: str) -> tuple[SpamResult, str] | None:
+    """Уверенный вердикт локального классификатора или None (решает LLM)."""
+    is_spam, score = _local_classifier.decide(normalized)
+    if is_spam is None:
+        return None
+    _perf_counters["local_decided"] += 1
+    result = SpamResult.SPAM if is_spam else SpamResult.NOT_SPAM
+    return result, f"{LOCAL_VERDICT_PREFIX} {'спам' if is_spam else 'не спам'} (log-odds {score:+.1f})"
+
+
+def _record_local_shadow(local_result: SpamResult, llm_result: SpamResult, message_text: str):
+    if local_result == llm_result:
+        _perf_counters["local_agree"] += 1
+        return
+    _perf_counters["local_disagree"] += 1
+    if local_result == SpamResult.SPAM and llm_result == SpamResult.NOT_SPAM:
+        _perf_counters["local_false_spam"] += 1
+    logger.info(f"Local shadow: локальный={local_result.value}, LLM={llm_result.value} «{message_text[:80]}»")
+
+
 def apply_risk_escalation(
     result: SpamResult, reasoning: str, risk_signals: list,
 ) -> tuple[SpamResult, str]:
@@ -641,6 +1748,15 @@ def apply_risk_escalation(
     return result, reasoning
 
 
+# Reasoning вердикта, выданного без LLM (breaker открыт) — по нему обработчики
+# отличают деградированный режим от обычного ВОЗМОЖНО_СПАМ
+DEGRADED_REASON = "LLM недоступен (circuit breaker), проверка без LLM"
+# Reasoning прочих запасных путей check_message_with_llm — вердикт без ответа модели
+RATE_LIMIT_TRUSTED_REASON = "Rate limit (trusted user, пропущен)"
+RATE_LIMIT_NEW_REASON = "Rate limit: слишком много сообщений от нового пользователя"
+LLM_ERROR_PREFIX = "Error:"
+
+
 async def check_message_with_llm(
     message_text: str,
     user_id: int = None,
@@ -656,8 +1772,14 @@ async def check_message_with_llm(
         # Доверенные пользователи при rate limit просто пропускаются,
         # новые — на ревью (флуд от нового аккаунта подозрителен сам по себе)
         if user_msg_count >= TRUSTED_USER_MESSAGES:
-            return SpamResult.NOT_SPAM, "Rate limit (trusted user, пропущен)"
-        return SpamResult.MAYBE_SPAM, "Rate limit: слишком много сообщений от нового пользователя"
+            return SpamResult.NOT_SPAM, RATE_LIMIT_TRUSTED_REASON
+        return SpamResult.MAYBE_SPAM, RATE_LIMIT_NEW_REASON
+
+    # Провайдер лежит — не ждём таймаутов; решение по fingerprint, спам-базам
+    # и сигналам риска уже принято вызывающим кодом
+    if _llm_breaker.is_open:
+        _perf_counters["degraded_checks"] += 1
+        return SpamResult.MAYBE_SPAM, DEGRADED_REASON
 
     try:
         # Если есть фото — используем Vision API
@@ -666,19 +1788,57 @@ async def check_message_with_llm(
             logger.info(f"Vision → {result.value} (caption_len={len(message_text or '')}, msgs={user_msg_count})")
             return result, reasoning
 
-        effective_text = message_text or ""
-        if context_note:
-            effective_text += f"\n\n[CONTEXT: {context_note}]"
-
         # Текстовая классификация
         prompt_template = db.get_current_prompt()
-        few_shot = build_few_shot_block()
-        result, reasoning = await classify_message(prompt_template, effective_text, few_shot, user_msg_count, is_cas_banned)
+        few_shot = get_few_shot_block()
+        cache_key = _verdict_cache_key(
+            prompt_template, few_shot, _with_context_note(message_text or "", context_note),
+            user_msg_count, is_cas_banned,
+        )
+        cached = _verdict_cache.get(cache_key)
+        if cached is not None:
+            result, reasoning = cached
+            logger.info(f"LLM cache → {result.value} (len={len(message_text or '')}, msgs={user_msg_count})")
+            return result, reasoning
+
+        # Локальный классификатор — как и каскад, только без сигналов риска;
+        # в shadow-режиме его решение лишь сверяется с LLM
+        local = None
+        if LOCAL_CLASSIFIER_MODE in ("shadow", "on") and not context_note and not is_cas_banned:
+            local = _local_verdict(normalize_text(message_text or ""))
+            if local is not None and LOCAL_CLASSIFIER_MODE == "on":
+                _perf_counters["local_final"] += 1
+                logger.info(f"Local → {local[0].value} (len={len(message_text or '')}, msgs={user_msg_count})")
+                return local
+
+        # Каскад — только для сообщений без сигналов риска: с сигналами
+        # сразу основная модель, ошибка nano-тира там дороже экономии
+        classify = (
+            classify_message_cascade if _cascade_active() and not context_note and not is_cas_banned
+            else classify_message
+        )
+
+        async def _classify():
+            verdict = await classify(prompt_template, message_text or "", few_shot, user_msg_count, is_cas_banned, context_note)
+            # Кешируется только разобранный ответ модели: заглушка после сбоя
+            # иначе держала бы текст в ВОЗМОЖНО_СПАМ весь TTL мимо LLM
+            if _is_model_verdict(verdict[1]):
+                _verdict_cache.set(cache_key, verdict)
+            return verdict
+
+        # Singleflight по тексту+промпту (без контекста): копии одной кампании
+        # ждут первый вызов; эскалацию по сигналам каждая копия проходит сама
+        result, reasoning = await _classify_flight.do(cache_key[:4], _classify)
+        if local is not None:
+            _record_local_shadow(local[0], result, message_text or "")
         logger.info(f"LLM → {result.value} (len={len(message_text or '')}, msgs={user_msg_count}, cas={is_cas_banned}, ctx={'yes' if context_note else 'no'})")
         return result, reasoning
+    except CircuitOpenError:
+        _perf_counters["degraded_checks"] += 1
+        return SpamResult.MAYBE_SPAM, DEGRADED_REASON
     except Exception as e:
         logger.error(f"LLM error: {e}")
-        return SpamResult.MAYBE_SPAM, f"Error: {e}"
+        return SpamResult.MAYBE_SPAM, f"{LLM_ERROR_PREFIX} {e}"
 
 
 # ──────────────────────────────────────────────
@@ -698,7 +1858,7 @@ async def evaluate_prompt(prompt_template: str, examples: list) -> tuple[float,
         return 0.0, 0, 0, []
 
     # ВАЖНО: используем те же few-shot примеры, что и в production
-    few_shot = build_few_shot_block()
+    few_shot = get_few_shot_block()
 
     async def classify_one(text: str, is_spam: bool):
         try:
@@ -709,15 +1869,17 @@ async def evaluate_prompt(prompt_template: str, examples: list) -> tuple[float,
         except Exception as e:
             return text, is_spam, None, None, str(e)
 
-    # Параллельная классификация батчами по 10 (rate limit safety)
+    # Параллельная классификация батчами по 10 (rate limit safety).
+    # Класс EVALUATION: живая модерация обгоняет валидацию в очереди LLM
     BATCH = 10
     results = []
-    for i in range(0, len(examples), BATCH):
-        batch = examples[i:i+BATCH]
-        batch_results = await asyncio.gather(
-            *[classify_one(text, is_spam) for text, is_spam in batch]
-        )
-        results.extend(batch_results)
+    with llm_priority(EVALUATION):
+        for i in range(0, len(examples), BATCH):
+            batch = examples[i:i+BATCH]
+            batch_results = await asyncio.gather(
+                *[classify_one(text, is_spam) for text, is_spam in batch]
+            )
+            results.extend(batch_results)
 
     correct = 0
     total = 0
@@ -743,6 +1905,43 @@ async def evaluate_prompt(prompt_template: str, examples: list) -> tuple[float,
     return accuracy, correct, total, errors
 
 
+async def benchmark_few_shot(prompt_template: str, examples: list) -> dict:
+    """Сравнить static и retrieval few-shot на примерах [(text, is_spam), ...].
+
+    Задержка — только поиск в индексе (CPU); точность — evaluate_prompt в
+    каждом режиме; размер — токены примеров на один запрос.
+    """
+    timings = []
+    retrieved_tokens = []
+    for text, _ in examples:
+        normalized = normalize_text(text)
+        started = time.perf_counter()
+        _few_shot_index.search(normalized, FEW_SHOT_RETRIEVAL_K, FEW_SHOT_RETRIEVAL_MIN_SCORE)
+        timings.append(time.perf_counter() - started)
+        retrieved_tokens.append(count_tokens(_similar_examples_xml(retrieve_examples(normalized)), LLM_MODEL))
+    latency = LatencyWindow(maxlen=len(timings) or 1)
+    for t in timings:
+        latency.add(t)
+
+    report = {
+        "index_size": len(_few_shot_index),
+        "search_p50_ms": latency.percentile(50) * 1000,
+        "search_p95_ms": latency.percentile(95) * 1000,
+        "retrieval_tokens": sum(retrieved_tokens) / len(retrieved_tokens) if retrieved_tokens else 0.0,
+    }
+    for mode in ("static", "retrieval"):
+        # contextvar наследуют задачи evaluate_prompt, живой трафик режим не видит
+        token = _few_shot_mode_override.set(mode)
+        try:
+            accuracy, correct, total, _errors = await evaluate_prompt(prompt_template, examples)
+            if mode == "static":
+                report["static_tokens"] = count_tokens(get_few_shot_block(), LLM_MODEL)
+        finally:
+            _few_shot_mode_override.reset(token)
+        report[mode] = {"accuracy": accuracy, "correct": correct, "total": total}
+    return report
+
+
 # 5 стратегий генерации — каждая попытка использует свою
 # 3 стратегии от консервативной к радикальной. Цикл останавливается на первой,
 # давшей net-positive результат (early-stop) — это экономит 40-60% стоимости.
@@ -876,7 +2075,8 @@ async def generate_improved_prompt_with_strategy(
 <полный текст нового промпта>"""
 
     try:
-        response = await openai_client.chat.completions.create(
+        response = await llm_create(
+            "generation",
             model=LLM_IMPROVEMENT_MODEL,
             messages=[
                 {"role": "system", "content": (
@@ -982,7 +2182,7 @@ async def auto_improve_prompt(trigger_error_type: str, trigger_message: str):
         #   - есть admin_decision → используем её
         #   - нет admin_decision, llm_result = СПАМ/НЕ_СПАМ → используем llm_result
         #   - llm_result = ВОЗМОЖНО_СПАМ без admin_decision → ПРОПУСКАЕМ (неизвестно)
-        dataset = db.get_validation_dataset(limit=ORDINARY_MESSAGES_SAMPLES * 4)
+        dataset = db.get_validation_dataset(limit=ORDINARY_MESSAGES_SAMPLES * 4, exclude_reasoning=_NO_LLM_REASONS)
 
         # Дедупликация по тексту (на случай если одно сообщение в БД дважды)
         seen = set()
@@ -1006,7 +2206,7 @@ async def auto_improve_prompt(trigger_error_type: str, trigger_message: str):
             return
 
         # Статистика по доступным данным во всей БД
-        db_stats = db.count_validation_dataset()
+        db_stats = db.count_validation_dataset(exclude_reasoning=_NO_LLM_REASONS)
         spam_count = source_counts['admin_spam'] + source_counts['bot_spam_no_admin']
         notspam_count = source_counts['admin_not_spam'] + source_counts['bot_not_spam_no_admin']
 
@@ -1340,6 +2540,33 @@ async def _weekly_improve_loop():
 # Telegram: проверки и действия
 # ──────────────────────────────────────────────
 
+def save_message_record(message_id, chat_id, user_id, username, text, llm_result=None, reasoning=None):
+    """db.save_message + запись в буфер недавних сообщений."""
+    db.save_message(message_id, chat_id, user_id, username, text, llm_result, reasoning)
+    _recent_messages.set((chat_id, message_id), (text, llm_result, user_id, chat_id, reasoning))
+
+
+def update_message_record_after_edit(message_id, chat_id, user_id, text, llm_result, reasoning):
+    """db.update_message_after_edit + обновление буфера."""
+    db.update_message_after_edit(message_id, text, llm_result, reasoning)
+    _recent_messages.set((chat_id, message_id), (text, llm_result, user_id, chat_id, reasoning))
+
+
+def get_message_record(message_id: int, chat_id: int = None):
+    """Запись о сообщении: сначала буфер недавних, затем БД.
+
+    chat_id=None — старые кнопки без chat_id в callback_data: только БД.
+    """
+    if chat_id is not None:
+        row = _recent_messages.get((chat_id, message_id))
+        if row is not None:
+            return row
+    row = db.get_message_by_id(message_id)
+    if row and chat_id is not None and row[3] == chat_id:
+        _recent_messages.set((chat_id, message_id), tuple(row))
+    return row
+
+
 def should_skip_message(message: types.Message) -> bool:
     if message.from_user and message.from_user.is_bot:
         return True
@@ -1419,7 +2646,13 @@ async def _finalize_admin_message(admin_msg: types.Message, verdict_line: str):
             pass
 
 
-async def send_to_admin(message: types.Message, result: SpamResult, reasoning: str = ""):
+def _series_text(series: list, empty: str = '📷 [Фото без подписи]') -> str:
+    """Текст сообщения (или серии сообщений по порядку) для отчёта админу."""
+    return "\n".join(m.text or m.caption or empty for m in series)
+
+
+async def send_to_admin(message: types.Message, result: SpamResult, reasoning: str = "", series: list = None):
+    reasoning = await _report_reasoning(message, result, reasoning)
     emoji = "🔴" if result == SpamResult.SPAM else "🟡"
     reasoning_line = f"\n\n💭 <i>{html.escape(reasoning[:200])}</i>" if reasoning else ""
     text = (
@@ -1427,12 +2660,12 @@ async def send_to_admin(message: types.Message, result: SpamResult, reasoning: s
         f"<b>От:</b> {message.from_user.full_name} (@{message.from_user.username or 'n/a'})\n"
         f"<b>Группа:</b> {message.chat.title}\n"
         f"<b>Время:</b> {message.date.strftime('%H:%M:%S')}\n\n"
-        f"<b>Сообщение:</b>\n<code>{html.escape(message.text or message.caption or '📷 [Фото без подписи]')}</code>"
+        f"<b>Сообщение:</b>\n<code>{html.escape(_series_text(series or [message]))}</code>"
         f"{reasoning_line}"
     )
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-        InlineKeyboardButton(text="🔴 СПАМ", callback_data=f"spam_{message.message_id}"),
-        InlineKeyboardButton(text="🟢 НЕ СПАМ", callback_data=f"not_spam_{message.message_id}"),
+        InlineKeyboardButton(text="🔴 СПАМ", callback_data=f"spam_{message.message_id}_{message.chat.id}"),
+        InlineKeyboardButton(text="🟢 НЕ СПАМ", callback_data=f"not_spam_{message.message_id}_{message.chat.id}"),
     ]])
     try:
         # Если есть фото — пересылаем его + текст кнопками
@@ -1444,21 +2677,218 @@ async def send_to_admin(message: types.Message, result: SpamResult, reasoning: s
         logger.error(f"Ошибка отправки админу: {e}")
 
 
-async def ban_and_report(message: types.Message, result: SpamResult, reasoning: str = "", force: bool = False):
+def defer_degraded_review(message: types.Message, text: str, user_msg_count: int, photo_url: str = None,
+                          context_note: str = "", is_cas_banned: bool = False):
+    """Отложить сообщение, не проверенное LLM: дайджест админу + перепроверка после сбоя."""
+    _perf_counters["degraded_deferred"] += 1
+    _degraded_queue.append({
+        "message": message, "text": text, "user_msg_count": user_msg_count, "photo_url": photo_url,
+        "context_note": context_note, "is_cas_banned": is_cas_banned,
+        "deferred_at": time.monotonic(), "in_digest": False,
+    })
+
+
+async def _send_degraded_digest():
+    """Одно сообщение админу обо всех отложенных с прошлого дайджеста."""
+    fresh = [e for e in _degraded_queue if not e["in_digest"]]
+    if not fresh:
+        return
+    br = _llm_breaker.stats()
+    lines = [
+        f"🟠 <b>LLM недоступен {br['open_for'] / 60:.0f} мин</b> — деградированный режим",
+        f"Без проверки LLM: {len(fresh)} сообщ. от новых пользователей без сигналов риска "
+        f"(fingerprint и спам-базы работают). После восстановления они будут перепроверены.",
+        "",
+    ]
+    for e in fresh[:15]:
+        m = e["message"]
+        preview = (e["text"] or "📷 [Фото]")[:80].replace("\n", " ")
+        lines.append(
+            f"• {html.escape(m.chat.title or '')} | {html.escape(m.from_user.full_name)}: "
+            f"<code>{html.escape(preview)}</code>"
+        )
+    if len(fresh) > 15:
+        lines.append(f"…и ещё {len(fresh) - 15}")
+    lines.append("\nСпам можно переслать боту — он забанит отправителя.")
+    try:
+        await bot.send_message(ADMIN_ID, "\n".join(lines), parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Ошибка отправки дайджеста: {e}")
+        return
+    for e in fresh:
+        e["in_digest"] = True
+    _perf_counters["degraded_digests"] += 1
+
+
+async def _apply_deferred_verdict(e: dict, result: SpamResult, reasoning: str):
+    """Вердикт отложенной LLM-проверки: обновить запись и отреагировать как обычно."""
+    m = e["message"]
+    try:
+        update_message_record_after_edit(m.message_id, m.chat.id, m.from_user.id, e["text"], result.value, reasoning)
+    except Exception as ex:
+        logger.error(f"Ошибка обновления отложенного сообщения: {ex}")
+    if result == SpamResult.SPAM:
+        await ban_and_report(m, result, reasoning, force=e.get("is_edit", False))
+    elif result == SpamResult.MAYBE_SPAM:
+        await send_to_admin(m, result, reasoning)
+
+
+async def _recheck_degraded():
+    """После восстановления провайдера — обычная классификация отложенных сообщений."""
+    rechecked = 0
+    while _degraded_queue and not _llm_breaker.is_open:
+        e = _degraded_queue.popleft()
+        m = e["message"]
+        # user_id=None: rate limit к этим сообщениям уже применён при получении
+        result, reasoning = await check_message_with_llm(
+            e["text"], None, e["user_msg_count"], e["is_cas_banned"], e["photo_url"], e["context_note"]
+        )
+        if reasoning == DEGRADED_REASON:
+            _degraded_queue.appendleft(e)  # провайдер снова упал — ждём следующего восстановления
+            break
+        rechecked += 1
+        await _apply_deferred_verdict(e, result, f"[после сбоя LLM] {reasoning}")
+    if rechecked:
+        _perf_counters["degraded_rechecked"] += rechecked
+        logger.info(f"Перепроверено после сбоя LLM: {rechecked}")
+
+
+async def degraded_mode_loop(interval: float = 5.0):
+    """Фон: пробы провайдера при открытом breaker, дайджест, перепроверка после восстановления."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if _llm_breaker.probe_due():
+                _llm_breaker.probes += 1
+                ok, err = await _probe_model(LLM_MODEL, health_check=True)
+                logger.info(f"Проба LLM: {'ok' if ok else err}")
+            if _llm_breaker.is_open:
+                oldest = next((e for e in _degraded_queue if not e["in_digest"]), None)
+                if oldest and time.monotonic() - oldest["deferred_at"] >= LLM_DEGRADED_DIGEST_SECONDS:
+                    await _send_degraded_digest()
+            elif _degraded_queue:
+                await _recheck_degraded()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи деградированного режима: {e}")
+
+
+# ──────────────────────────────────────────────
+# Перегрузка: сообщения, не допущенные к LLM (admission.py)
+# ──────────────────────────────────────────────
+
+# Reasoning вердикта, вынесенного без LLM из-за перегрузки
+OVERLOAD_REASON = "Перегрузка: проверка без LLM, по спам-базам и сигналам риска"
+
+
+def _overload_verdict(ctx) -> tuple[SpamResult, str]:
+    """Политика перегрузки для сообщения, не допущенного к LLM.
+
+    Новый пользователь (нет истории) — решают спам-базы и сигналы риска:
+    базовый вердикт ВОЗМОЖНО_СПАМ, и эскалация превращает его в СПАМ при
+    сильном сигнале. Пользователь с историей — базовый НЕ_СПАМ: сообщение
+    остаётся, LLM-проверка откладывается до спада нагрузки.
+    """
+    ctx.shed = True
+    _perf_counters["overload_shed_new" if ctx.user_msg_count == 0 else "overload_shed_history"] += 1
+    logger.info(f"🚦 OVERLOAD @{ctx.username} (msgs={ctx.user_msg_count}, signals={len(ctx.risk_signals)}) | «{ctx.preview}»")
+    if ctx.user_msg_count == 0:
+        return SpamResult.MAYBE_SPAM, OVERLOAD_REASON
+    return SpamResult.NOT_SPAM, OVERLOAD_REASON
+
+
+# Вердикты, вынесенные без LLM (провайдер недоступен, перегрузка): не ground
+# truth — в обучение и валидацию без решения админа не попадают
+_NO_LLM_REASONS = (DEGRADED_REASON, OVERLOAD_REASON)
+# Все вердикты LLM-стадии, вынесенные без ответа модели
+_FALLBACK_REASONS = _NO_LLM_REASONS + (
+    LOCAL_VERDICT_PREFIX, RATE_LIMIT_TRUSTED_REASON, RATE_LIMIT_NEW_REASON, LLM_ERROR_PREFIX, UNPARSED_REASON,
+)
+
+
+def _is_model_verdict(reasoning: str) -> bool:
+    """Вердикт дала модель (или кеш её вердиктов), а не запасной путь без неё."""
+    return not any(marker in (reasoning or "") for marker in _FALLBACK_REASONS)
+
+
+def _stored_verdict(ctx, result: SpamResult) -> str | None:
+    """llm_result для записи в БД.
+
+    «Не спам» при перегрузке — не вердикт, а отложенная проверка: пишем NULL,
+    настоящий вердикт запишет перепроверка. Если её вытеснят из очереди,
+    в БД не остаётся ложной метки «не спам».
+    """
+    if ctx.shed and result == SpamResult.NOT_SPAM:
+        return None
+    return result.value
+
+
+def defer_overload_check(ctx):
+    """Отложить LLM-проверку до спада нагрузки; при переполнении вытесняется самое старое."""
+    if len(_overload_queue) == _overload_queue.maxlen:
+        _perf_counters["overload_dropped"] += 1
+    _perf_counters["overload_deferred"] += 1
+    _overload_queue.append({
+        "message": ctx.message, "text": ctx.text, "user_msg_count": ctx.user_msg_count,
+        "photo_url": ctx.photo_url, "context_note": ctx.context_note, "is_cas_banned": ctx.in_spam_db,
+        "is_edit": ctx.is_edit, "deferred_at": time.monotonic(),
+    })
+
+
+async def _recheck_overloaded():
+    """Отложенные под нагрузкой проверки — только пока новые сообщения не ждут допуска."""
+    rechecked = 0
+    while _overload_queue and not _admission.overloaded and not _llm_breaker.is_open:
+        if not await _admission.acquire(max_wait=0):
+            break
+        e = _overload_queue.popleft()
+        try:
+            # user_id=None: rate limit к этим сообщениям уже применён при получении
+            result, reasoning = await check_message_with_llm(
+                e["text"], None, e["user_msg_count"], e["is_cas_banned"], e["photo_url"], e["context_note"]
+            )
+        finally:
+            await _admission.release()
+        if reasoning == DEGRADED_REASON:
+            _overload_queue.appendleft(e)  # провайдер упал — подождём
+            break
+        rechecked += 1
+        _perf_counters["overload_delay_ms"] += int((time.monotonic() - e["deferred_at"]) * 1000)
+        await _apply_deferred_verdict(e, result, f"[после перегрузки] {reasoning}")
+    if rechecked:
+        _perf_counters["overload_rechecked"] += rechecked
+        logger.info(f"Перепроверено после перегрузки: {rechecked}")
+
+
+async def overload_recheck_loop(interval: float = 2.0):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if _overload_queue:
+                await _recheck_overloaded()
+        except Exception as e:
+            logger.error(f"Ошибка перепроверки после перегрузки: {e}")
+
+
+async def ban_and_report(message: types.Message, result: SpamResult, reasoning: str = "", force: bool = False,
+                         series: list = None):
     """Бан + удаление + отчёт админу.
 
     force=True: банить даже пользователя со старой активностью.
     Нужно для edit-to-spam — спамер специально пишет невинное сообщение,
     выжидает и редактирует его в спам; защита «старая активность» иначе
     блокирует бан именно в этом сценарии.
+
+    series — все сообщения серии (см. _burst_messages): удаляются напрямую,
+    не через БД, — остальные части могут быть ещё не сохранены.
     """
     uid, cid = message.from_user.id, message.chat.id
+    series = series or [message]
 
     if message.sender_chat:
-        await send_to_admin(message, result, reasoning)
+        await send_to_admin(message, result, reasoning, series=series)
         return
     if not force and db.has_user_old_activity(uid, cid, 10):
-        await send_to_admin(message, result, reasoning)
+        await send_to_admin(message, result, reasoning, series=series)
         return
 
     try:
@@ -1467,12 +2897,22 @@ async def ban_and_report(message: types.Message, result: SpamResult, reasoning:
         banned, failed = await ban_user_in_all_groups(uid, exclude_chat_id=cid)
     except Exception as e:
         logger.error(f"Ошибка бана: {e}")
-        await send_to_admin(message, result)
+        await send_to_admin(message, result, series=series)
         return
 
     # Удаляем ВСЕ сообщения спамера из всех групп
     deleted = await delete_user_messages(uid)
+    for part in series:
+        if part is message:
+            continue
+        try:
+            await bot.delete_message(part.chat.id, part.message_id)
+            deleted += 1
+        except Exception as e:
+            logger.debug(f"delete_message({part.chat.id}, {part.message_id}) failed: {e}")
     logger.info(f"Удалено {deleted} сообщений спамера {uid}")
+    # Объяснение — уже после бана: его генерация не задерживает удаление спама
+    reasoning = await _report_reasoning(message, result, reasoning)
 
     # Сохраняем профиль спамера для детектора спам-волн
     try:
@@ -1481,7 +2921,7 @@ async def ban_and_report(message: types.Message, result: SpamResult, reasoning:
             uid, message.from_user.username or '', message.from_user.full_name,
             profile.get('bio', ''), profile.get('channel_title', ''),
             profile.get('channel_desc', ''),
-            message.text or message.caption or '', reasoning[:200]
+            _series_text(series, ''), reasoning[:200]
         )
     except Exception as e:
         logger.warning(f"Не удалось сохранить профиль спамера: {e}")
@@ -1491,7 +2931,7 @@ async def ban_and_report(message: types.Message, result: SpamResult, reasoning:
         f"<b>Забанен:</b> {message.from_user.full_name} (@{message.from_user.username or 'n/a'})\n"
         f"<b>User ID:</b> <code>{uid}</code>\n"
         f"<b>Группа:</b> {message.chat.title}\n\n"
-        f"<b>Сообщение:</b>\n<code>{html.escape(message.text or message.caption or '📷 [Фото без подписи]')}</code>\n\n"
+        f"<b>Сообщение:</b>\n<code>{html.escape(_series_text(series))}</code>\n\n"
         f"✅ Забанен в {len(banned) + 1} группах\n"
         f"🗑 Удалено сообщений: {deleted}"
     )
@@ -1521,15 +2961,19 @@ async def handle_forwarded_spam(message: types.Message):
     fwd = get_forward_info(message)
     original_user_id = fwd["user_id"]
     original_username = fwd["username"]
+    # Пересылка сохраняет исходный источник — помечаем его как спамный
+    record_forward_verdict(fwd["origin_key"], "СПАМ", fwd["chat_title"] or "", by_admin=True)
 
     spam_text = message.text or message.caption or ""
     if spam_text:
         # Определяем тип: короткий невинный текст = profile spam, иначе text spam
         spam_type = _classify_spam_type(spam_text)
         db.add_training_example(spam_text, True, 'FORWARDED_SPAM', spam_type)
+        mark_few_shot_dirty()
+        learn_training_example(spam_text, True, spam_type)
         # Сохраняем как "ошибку бота" чтобы счётчик ошибок рос
         try:
-            db.save_message(
+            save_message_record(
                 message.message_id, 0, original_user_id or 0,
                 original_username or '', spam_text, 'НЕ_СПАМ', 'Пропущен ботом'
             )
@@ -1651,6 +3095,10 @@ async def cmd_help(message: types.Message):
         "/stats — статистика\n"
         "/improve — принудительное улучшение промпта\n"
         "/models — какие LLM-модели сейчас используются\n"
+        "/perf — кеши и метрики производительности\n"
+        "/classifier — переобучить и оценить локальный классификатор\n"
+        "/riskfit — подобрать веса и пороги риск-скора\n"
+        "/fewshotbench [N] — сравнить общий и подобранный few-shot\n"
         "/prompt — текущий промпт\n"
         "/history — история версий промпта\n"
         "/rollback N — откатить промпт к версии #N\n"
@@ -1700,10 +3148,43 @@ async def cmd_models(message: types.Message):
         f"🤖 <b>Используются сейчас:</b>",
         f"  • Классификация: <code>{html.escape(LLM_MODEL)}</code>",
         f"  • Улучшение промпта: <code>{html.escape(LLM_IMPROVEMENT_MODEL)}</code>",
+        f"  • Hedge: <code>{html.escape(LLM_HEDGE_MODEL or LLM_MODEL)}</code>",
+        f"  • Каскад (nano): " + (f"<code>{html.escape(LLM_FAST_MODEL)}</code>" if _cascade_active() else "выкл"),
+        "",
+    ]
+    br = _llm_breaker.stats()
+    if br["state"] == "open":
+        lines += [
+            f"⛔ <b>LLM недоступен</b> {br['open_for']:.0f}s — деградированный режим "
+            f"(fingerprint, спам-базы, сигналы риска), проба через {br['next_probe_in']:.0f}s",
+            f"  • Последняя ошибка: <code>{html.escape(br['last_error'])}</code>",
+        ]
+    else:
+        lines.append(
+            f"✅ <b>Circuit breaker:</b> закрыт (ошибок подряд {br['consecutive_failures']}/{LLM_BREAKER_FAILURES})"
+        )
+    lines += [
+        f"  • Срабатываний {br['trips']}, отклонено вызовов {br['rejected']}, проб {br['probes']}",
+        f"  • Без LLM: проверок {_perf_counters['degraded_checks']}, отложено {_perf_counters['degraded_deferred']} "
+        f"(ждут {len(_degraded_queue)}), дайджестов {_perf_counters['degraded_digests']}, "
+        f"перепроверено {_perf_counters['degraded_rechecked']}",
         "",
-        "<b>Проверка кандидатов:</b>",
     ]
-    all_candidates = list(dict.fromkeys(LLM_MODEL_CANDIDATES + LLM_IMPROVEMENT_MODEL_CANDIDATES))
+    if _llm_router is not None:
+        lines.append(f"<b>Эндпоинты</b> (переключений при сбоях: {_llm_router.failovers}):")
+        for ep in _llm_router.stats():
+            state = "✅" if ep["healthy"] else f"⛔ ещё {ep['ejected_for']:.0f}s"
+            lines.append(
+                f"  {state} <code>{html.escape(ep['name'])}</code> вес {ep['weight']:g} | "
+                f"вызовов {ep['calls']}, ошибок {ep['errors']}, выводов {ep['ejections']} | "
+                f"EWMA {ep['latency_ewma']:.2f}s, в полёте {ep['in_flight']}"
+            )
+        lines.append("")
+    lines.append("<b>Проверка кандидатов:</b>")
+    all_candidates = list(dict.fromkeys(
+        LLM_MODEL_CANDIDATES + LLM_IMPROVEMENT_MODEL_CANDIDATES
+        + (LLM_FAST_MODEL_CANDIDATES if LLM_CASCADE_ENABLED else [])
+    ))
     for c in all_candidates:
         ok, err = await _probe_model(c)
         if ok:
@@ -1714,6 +3195,235 @@ async def cmd_models(message: types.Message):
     await message.reply("\n".join(lines), parse_mode='HTML')
 
 
+def _chunk_lines(lines: list[str], limit: int = 3600) -> list[str]:
+    """Склеивает строки отчёта в сообщения не длиннее limit (Telegram режет на 4096).
+    Рвётся только между строками — HTML-теги внутри строки остаются целыми."""
+    chunks, current = [], ""
+    for line in lines:
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+@dp.message(Command("perf"))
+@require_admin
+async def cmd_perf(message: types.Message):
+    """Метрики производительности: кеши, экономия LLM-вызовов."""
+    vc = _verdict_cache.stats()
+    adm = _admission.stats()
+    dd = _update_dedup.stats()
+    lines = [
+        "⚡ <b>Производительность</b>",
+        "",
+        f"<b>Кеш вердиктов:</b> {vc['size']}/{vc['maxsize']}",
+        f"  • Попаданий: {vc['hits']} | Промахов: {vc['misses']} | Hit ratio: {vc['hit_ratio']:.0%}",
+        f"  • Вытеснено: {vc['evictions']}",
+        f"<b>Дедупликация одновременных вызовов:</b> "
+        f"LLM-вызовов {_classify_flight.leaders}, присоединились {_classify_flight.coalesced}",
+        f"<b>Батчинг классификации:</b> {'вкл' if LLM_BATCH_ENABLED else 'выкл'} | "
+        f"батчей {_classification_batcher.batches}, средний размер {_classification_batcher.avg_batch_size:.1f}, "
+        f"добрано поодиночке {_perf_counters['batch_fallback_items']}",
+        f"<b>Репутация источников пересылок:</b> {len(_forward_reputation)} источников",
+        f"  • Банов без LLM: {_perf_counters['forward_reputation_bans']} | "
+        f"Пропущено сигналов (чистый источник): {_perf_counters['forward_reputation_clean_skips']}",
+        f"<b>Предзагрузка при входе:</b> {len(_join_prefetch)} в кеше",
+        f"  • Базы спамеров: готово {_perf_counters['prefetch_hits_spam_db']}, "
+        f"на месте {_perf_counters['prefetch_misses_spam_db']}",
+        f"  • Профиль: готово {_perf_counters['prefetch_hits_profile']}, "
+        f"на месте {_perf_counters['prefetch_misses_profile']}",
+        "<b>Критический путь handle_message</b> (ожидание стадии, p50 / p95):",
+        *[
+            f"  • {stage}: {_stage_latency[stage].percentile(50) * 1000:.0f} / "
+            f"{_stage_latency[stage].percentile(95) * 1000:.0f} мс ({_stage_latency[stage].count}), "
+            f"таймаутов {_perf_counters[f'signal_timeouts_{stage}']}"
+            for stage in ("spam_db", "profile", "photo", "profile_late") if stage in _stage_latency
+        ],
+        f"<b>Конвейер модерации</b> ({'адаптивный порядок' if _moderation_pipeline.adaptive else 'порядок по конфигу' if _moderation_pipeline.order else 'порядок по стоимости'}; "
+        f"запуски, срабатывания, p50, вердикты; * — переставляемые):",
+        *[
+            f"  • {st['name']}{'*' if st['reorderable'] else ''}: {st['runs']}, {st['hit_rate']:.0%}, "
+            f"{st['p50'] * 1000:.0f} мс"
+            + (", " + ", ".join(f"{k} {v}" for k, v in sorted(st['verdicts'].items())) if st['verdicts'] else "")
+            for st in _moderation_pipeline.report()
+        ],
+        f"<b>Серии сообщений:</b> {'окно ' + str(BURST_WINDOW_MS) + ' мс' if BURST_WINDOW_MS else 'выкл'} | "
+        f"серий {_burst_coalescer.coalesced_bursts} из {_burst_coalescer.bursts}, средний размер "
+        f"{_burst_coalescer.avg_burst_size:.1f}, сэкономлено вызовов {_perf_counters['burst_calls_saved']}",
+        f"<b>Повторные апдейты:</b> отброшено {dd['duplicates']} из {dd['checked']} "
+        f"(в памяти {dd['duplicates_memory']}, по таблице {dd['duplicates_persistent']}), "
+        f"окно {dd['window']}/{DEDUP_WINDOW_SIZE}"
+        + (f", упавших обработок {dd['aborted']}" if dd['aborted'] else "")
+        + (f", ошибок таблицы {dd['table_errors']}" if dd['table_errors'] else ""),
+        f"<b>Допуск к LLM:</b> в работе {adm['active']}/{adm['max_active'] or '∞'}, "
+        f"в очереди {adm['queued']}/{adm['max_queue']} (пик {adm['max_queued']}, p95 {adm['depth_p95']:.0f})",
+        f"  • Допущено {adm['admitted']}, ожидание p50/p95 {adm['wait_p50'] * 1000:.0f}/{adm['wait_p95'] * 1000:.0f} мс",
+        f"  • Отказов {adm['shed']}: очередь полна {adm['shed_queue_full']}, таймаут {adm['shed_timeout']}, "
+        f"с историей без ожидания {adm['shed_no_wait']}",
+        f"  • Отложено {_perf_counters['overload_deferred']} (ждут {len(_overload_queue)}, вытеснено {_perf_counters['overload_dropped']}), "
+        f"перепроверено {_perf_counters['overload_rechecked']}, средняя задержка "
+        f"{_perf_counters['overload_delay_ms'] / max(1, _perf_counters['overload_rechecked']) / 1000:.0f}s",
+        f"<b>LLM-вызовы и prefix-кеш провайдера:</b> few-shot поколение "
+        f"{_few_shot_snapshot['generation']}{' (ждёт обновления)' if _few_shot_snapshot['dirty'] else ''}",
+    ]
+    lines.extend(_llm_usage.report_lines() or ["  • Вызовов пока не было"])
+    sch = _llm_scheduler.stats()
+    lines += [
+        f"<b>Каскад nano→основная:</b> {'вкл' if _cascade_active() else 'выкл'}"
+        + (f" (<code>{html.escape(LLM_FAST_MODEL)}</code>)" if LLM_FAST_MODEL else ""),
+        f"  • Сообщений {_perf_counters['cascade_calls']}: решено nano {_perf_counters['cascade_fast_final']} "
+        f"({_perf_counters['cascade_fast_final'] / max(1, _perf_counters['cascade_calls']):.0%}), "
+        f"эскалаций {_perf_counters['cascade_escalations']}, ошибок nano {_perf_counters['cascade_fast_errors']}",
+        f"  • Расхождения: при эскалации {_perf_counters['cascade_disagreements']}/{_perf_counters['cascade_escalations']}, "
+        f"выборочная перепроверка {_perf_counters['cascade_audit_disagreements']}/{_perf_counters['cascade_audits']}",
+        f"<b>Вердикт без reasoning:</b> {'вкл' if LLM_VERDICT_ONLY else 'выкл'} | "
+        f"вызовов {_perf_counters['verdict_only_calls']}, объяснений для отчётов {_llm_usage.calls('explain')}",
+        f"  • Выход на вердикт ~{_llm_usage.avg_completion_tokens('text'):.0f} ток., на объяснение ~{_llm_usage.avg_completion_tokens('explain'):.0f} ток. "
+        f"→ сэкономлено ~{max(0, _perf_counters['verdict_only_calls'] - _llm_usage.calls('explain')) * _llm_usage.avg_completion_tokens('explain'):.0f} ток.",
+        f"  • p50: вердикт {_llm_usage.latency_percentile('text', 50):.2f}s, объяснение {_llm_usage.latency_percentile('explain', 50):.2f}s",
+        f"<b>Бюджет вызовов:</b> simple {_perf_counters['policy_simple']}, normal {_perf_counters['policy_normal']}, "
+        f"complex {_perf_counters['policy_complex']} | повторов из-за лимита {_perf_counters['budget_retries']}, "
+        f"не хватило и после повтора {_perf_counters['budget_exhausted']}",
+        f"  • Урезано длинных сообщений: {_perf_counters['messages_truncated']} "
+        f"(бюджет {LLM_MESSAGE_TOKEN_BUDGET} ток., подсчёт: {'tiktoken' if token_budget.tiktoken else 'эвристика'})",
+        f"<b>Потоковая классификация:</b> {'вкл' if LLM_STREAMING and not LLM_VERDICT_ONLY else 'выкл'} | "
+        f"до вердикта p50 {_stream_time_to_verdict.percentile(50):.2f}s, "
+        f"до конца ответа p50 {_stream_time_to_complete.percentile(50):.2f}s ({_stream_time_to_verdict.count} потоков)",
+        f"<b>Few-shot:</b> {FEW_SHOT_MODE} | индекс {len(_few_shot_index)} примеров, поиск p50 "
+        f"{_few_shot_retrieval_latency.percentile(50) * 1000:.1f} мс / p95 {_few_shot_retrieval_latency.percentile(95) * 1000:.1f} мс",
+        f"<b>Локальный классификатор:</b> {LOCAL_CLASSIFIER_MODE}"
+        + ("" if _local_classifier.ready else " (не откалиброван)")
+        + f" | без LLM {_perf_counters['local_final']}, сверка с LLM "
+        f"{_perf_counters['local_agree']}/{_perf_counters['local_agree'] + _perf_counters['local_disagree']}",
+        f"<b>Риск-скор:</b> {RISK_SCORER_MODE}"
+        + ("" if _risk_scorer.ready else " (не откалиброван)")
+        + f" | LLM-вызовов сэкономлено {_perf_counters['risk_llm_avoided']}, сверка с итогом "
+        f"{_perf_counters['risk_shadow_agree']}/{_perf_counters['risk_shadow_agree'] + _perf_counters['risk_shadow_disagree']}",
+        f"<b>Hedging:</b> {'вкл' if LLM_HEDGE_ENABLED else 'выкл'}, модель "
+        f"<code>{html.escape(LLM_HEDGE_MODEL or LLM_MODEL)}</code>, дедлайн {_hedge_delay():.1f}s",
+        f"  • Hedge-запросов {_perf_counters['hedges']} "
+        f"({_perf_counters['hedges'] / max(1, _perf_counters['hedge_eligible']):.1%} от классификаций), "
+        f"выиграли {_perf_counters['hedge_wins']}, сэкономлено ~{_perf_counters['hedge_saved_ms'] / 1000:.0f}s",
+        f"<b>Планировщик LLM:</b> окно {sch['window']:.1f}, в полёте {sch['in_flight']}, "
+        f"в очереди {sch['queued']} (макс. {sch['max_queued']})",
+        f"  • Ожидание в очереди p50 {sch['wait_p50']:.2f}s / p95 {sch['wait_p95']:.2f}s",
+        f"  • 429: {sch['rate_limited']}, повторов {sch['retries']}"
+        + (f", пауза ещё {sch['paused_for']:.0f}s" if sch['paused_for'] else ""),
+        f"  • Токенов за минуту: {sch['tokens_last_minute']}"
+        + (f" из {LLM_TOKENS_PER_MINUTE}" if LLM_TOKENS_PER_MINUTE else ""),
+        f"  • Классы (резерв живого трафика {LLM_LIVE_RESERVE:.0%}; ждут, выполнено, ожидание p50/p95):",
+        *[
+            f"    – {name}: {c['queued']}, {c['completed']}, {c['wait_p50']:.2f}s / {c['wait_p95']:.2f}s"
+            for name, c in sch['classes'].items() if c['completed'] or c['queued']
+        ],
+    ]
+    for chunk in _chunk_lines(lines):
+        await message.reply(chunk, parse_mode='HTML')
+
+
+@dp.message(Command("classifier"))
+@require_admin
+async def cmd_classifier(message: types.Message):
+    """Переобучение локального классификатора и оценка кросс-валидацией."""
+    await message.reply("🧮 Обучаю локальный классификатор...")
+    # Обучение — чистый CPU на тысячах текстов, идёт в рабочем потоке
+    report = await train_local_classifier()
+    lines = [
+        f"🧮 <b>Локальный классификатор</b> (режим: {LOCAL_CLASSIFIER_MODE})",
+        f"Примеров: {report['examples']} (спам {report['scored_spam']}, не спам {report['scored_ham']}), "
+        f"оценка кросс-валидацией на {report['folds']} частях",
+    ]
+    if report["calibrated"]:
+        lines += [
+            f"Пороги log-odds: не спам ≤ {_local_classifier.ham_threshold:+.2f}, "
+            f"спам ≥ {_local_classifier.spam_threshold:+.2f}",
+            f"<b>На кросс-валидации:</b> решено без LLM {report['coverage']:.0%} "
+            f"(спам {report['auto_spam']}, не спам {report['auto_ham']})",
+            f"  • FPR {report['fpr']:.2%} (цель {report['target_fpr']:.2%}), "
+            f"FNR {report['fnr']:.2%} (цель {report['target_fnr']:.2%}), "
+            f"точность решённых {report['accuracy']:.1%}",
+        ]
+    else:
+        lines.append(
+            f"⚠️ Мало данных для калибровки: нужно ≥{LOCAL_CLASSIFIER_MIN_PER_CLASS} примеров каждого "
+            f"класса — пока всё решает LLM"
+        )
+    lines += [
+        f"<b>В работе:</b> уверенных решений {_perf_counters['local_decided']}, без LLM {_perf_counters['local_final']}",
+        f"  • Сверка с LLM: совпало {_perf_counters['local_agree']}, расхождений {_perf_counters['local_disagree']} "
+        f"(из них локально спам / LLM чисто: {_perf_counters['local_false_spam']})",
+    ]
+    await message.reply("\n".join(lines), parse_mode='HTML')
+
+
+@dp.message(Command("riskfit"))
+@require_admin
+async def cmd_riskfit(message: types.Message):
+    """Подбор весов риск-скора по сохранённым сигналам и калибровка порогов."""
+    await message.reply("🎚 Подбираю веса риск-скора...")
+    report = await asyncio.to_thread(train_risk_scorer)
+    lines = [
+        f"🎚 <b>Риск-скор</b> (режим: {RISK_SCORER_MODE})",
+        f"Примеров: {report['examples']} (спам {report['scored_spam']}, не спам {report['scored_ham']}), "
+        f"пороги — кросс-валидацией на {report['folds']} фолдах",
+    ]
+    if report["calibrated"]:
+        lines += [
+            f"Пороги: пропуск ≤ {_risk_scorer.pass_threshold:+.2f}, бан ≥ {_risk_scorer.ban_threshold:+.2f}",
+            f"<b>На кросс-валидации:</b> решено без LLM {report['coverage']:.0%} "
+            f"(бан {report['auto_spam']}, пропуск {report['auto_ham']})",
+            f"  • FPR {report['fpr']:.2%} (цель {report['target_fpr']:.2%}), "
+            f"FNR {report['fnr']:.2%} (цель {report['target_fnr']:.2%})",
+        ]
+    else:
+        lines.append(
+            f"⚠️ Мало данных для калибровки: нужно ≥{RISK_SCORER_MIN_PER_CLASS} примеров каждого "
+            f"класса — пока всё решает LLM"
+        )
+    weights = ", ".join(
+        f"{risk_scorer.FEATURE_TITLES[f]} {_risk_scorer.weights[f]:+.2f}" for f in risk_scorer.FEATURES
+    )
+    lines += [
+        f"<b>Веса:</b> база {_risk_scorer.bias:+.2f}, {html.escape(weights)}",
+        f"<b>В работе:</b> LLM-вызовов сэкономлено {_perf_counters['risk_llm_avoided']}, "
+        f"сверка с итогом: совпало {_perf_counters['risk_shadow_agree']}, "
+        f"расхождений {_perf_counters['risk_shadow_disagree']}",
+    ]
+    await message.reply("\n".join(lines), parse_mode='HTML')
+
+
+@dp.message(Command("fewshotbench"))
+@require_admin
+async def cmd_fewshotbench(message: types.Message):
+    """Static vs retrieval few-shot: /fewshotbench [N] — N примеров из валидации (по умолчанию 60)."""
+    args = (message.text or "").split()
+    size = int(args[1]) if len(args) > 1 and args[1].isdigit() else 60
+    dataset = db.get_validation_dataset(limit=1000, exclude_reasoning=_NO_LLM_REASONS)
+    if len(dataset) < 10:
+        await message.reply("❌ Мало размеченных сообщений для сравнения (нужно ≥10)")
+        return
+    sample = random.Random(0).sample(dataset, min(size, len(dataset)))
+    examples = [(text, is_spam) for text, is_spam, _source in sample]
+    await message.reply(f"🧪 Сравниваю режимы few-shot на {len(examples)} примерах ({2 * len(examples)} LLM-вызовов)...")
+    report = await benchmark_few_shot(db.get_current_prompt(), examples)
+    st, rt = report["static"], report["retrieval"]
+    lines = [
+        f"🧪 <b>Few-shot: static vs retrieval</b> (сейчас: {FEW_SHOT_MODE})",
+        f"Индекс: {report['index_size']} примеров, поиск p50 {report['search_p50_ms']:.1f} мс / "
+        f"p95 {report['search_p95_ms']:.1f} мс",
+        f"<b>static:</b> точность {st['accuracy']:.1%} ({st['correct']}/{st['total']}), "
+        f"примеры ~{report['static_tokens']} ток. в system prompt",
+        f"<b>retrieval:</b> точность {rt['accuracy']:.1%} ({rt['correct']}/{rt['total']}), "
+        f"k={FEW_SHOT_RETRIEVAL_K}, ~{report['retrieval_tokens']:.0f} ток. на сообщение",
+        "Режим переключается переменной FEW_SHOT_MODE.",
+    ]
+    await message.reply("\n".join(lines), parse_mode='HTML')
+
+
 @dp.message(Command("prompt"))
 @require_admin
 async def cmd_prompt(message: types.Message):
@@ -1832,7 +3542,15 @@ async def handle_service_messages(message: types.Message):
         if member.is_bot:
             continue
         try:
-            in_db, db_name = await check_spam_databases(member.id)
+            uid = member.id
+            task = prefetch_signal("spam_db", uid, lambda: check_spam_databases(uid))
+            try:
+                in_db, db_name = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Задачу вытеснили из кеша предзагрузки — пропускаем участника
+                if not task.cancelled():
+                    raise
+                continue
             if in_db:
                 await bot.ban_chat_member(chat_id=message.chat.id, user_id=member.id)
                 banned, _ = await ban_user_in_all_groups(member.id, exclude_chat_id=message.chat.id)
@@ -1842,6 +3560,10 @@ async def handle_service_messages(message: types.Message):
                     f"(база {db_name}) — {html.escape(message.chat.title or '')}, "
                     f"забанен в {len(banned) + 1} группах"
                 )
+            else:
+                # Профиль (bio, личный канал, его описание, LLM-вердикт) — в фоне,
+                # чтобы первое сообщение не ждало get_chat и LLM
+                prefetch_signal("profile", uid, lambda: check_user_profile(uid))
         except Exception as e:
             logger.warning(f"Ошибка проверки нового участника {member.id}: {e}")
 
@@ -1852,6 +3574,441 @@ async def handle_service_messages(message: types.Message):
         logger.debug(f"Не удалось удалить сервисное сообщение: {e}")
 
 
+# ──────────────────────────────────────────────
+# Конвейер модерации: новые и отредактированные сообщения
+# проходят одни и те же стадии (pipeline.py)
+# ──────────────────────────────────────────────
+
+@dataclass
+class ModerationContext:
+    message: types.Message
+    text: str
+    user_msg_count: int
+    is_edit: bool = False
+    edit_context: str = ""  # «раньше текст был …» — в контекст LLM для правок
+    fwd: dict | None = None
+    origin_rep: str | None = None
+    risk_signals: list = field(default_factory=list)  # [(описание, 'strong'|'weak'), ...]
+    in_spam_db: bool = False
+    db_name: str = ""
+    photo_url: str | None = None
+    degraded: bool = False
+    shed: bool = False  # не допущен к LLM из-за перегрузки
+    context_note: str = ""
+    burst: dict | None = None  # общая для серии сообщений (см. BurstCoalescer)
+    features: dict = field(default_factory=dict)  # признаки риск-скора (risk_scorer.FEATURES)
+    risk_decision: bool | None = None  # решение риск-скора (в т.ч. в shadow-режиме)
+    profile_in_context: bool = False
+    model_verdict: bool = False  # вердикт LLM-стадии дала модель, а не запасной путь
+    verdict: tuple | None = None
+    decided_by: str | None = None
+    _signals_started: float = 0.0
+    _spam_db_task: asyncio.Task | None = None
+    _profile_task: asyncio.Task | None = None
+    _photo_task: asyncio.Task | None = None
+
+    @property
+    def uid(self) -> int:
+        return self.message.from_user.id
+
+    @property
+    def username(self) -> str:
+        return self.message.from_user.username or self.message.from_user.full_name
+
+    @property
+    def preview(self) -> str:
+        return self.text[:80].replace('\n', ' ')
+
+    @property
+    def signals_deadline(self) -> float:
+        return self._signals_started + SIGNAL_TIMEOUT_SECONDS
+
+    def start_signals(self, profile: bool = True):
+        """Независимые запросы (спам-базы, профиль, фото) стартуют разом, один раз.
+
+        До первой сетевой стадии не стартуют вовсе: если сообщение решила
+        дешёвая стадия, запросы не нужны.
+        """
+        if self._signals_started:
+            return
+        self._signals_started = time.monotonic()
+        uid = self.uid
+        self._spam_db_task = start_signal("spam_db", uid, lambda: check_spam_databases(uid))
+        if profile and self.user_msg_count <= 2:
+            self._profile_task = start_signal("profile", uid, lambda: check_user_profile(uid))
+        if self.message.photo:
+            self._photo_task = asyncio.create_task(_photo_url(self.message))
+
+
+async def _stage_fingerprint(ctx: ModerationContext):
+    # Точное совпадение с подтверждённым спамом (кампании репостят текст дословно)
+    if ctx.text and len(ctx.text) >= 25 and db.is_known_spam_text(ctx.text):
+        logger.info(f"🎯 FINGERPRINT-BAN @{ctx.username} | {ctx.message.chat.title} | «{ctx.preview}»")
+        return SpamResult.SPAM, "Точное совпадение с подтверждённым спамом (fingerprint)"
+    return None
+
+
+async def _stage_forward_reputation(ctx: ModerationContext):
+    # Пересылка из источника, уже признанного спамным
+    ctx.origin_rep = forward_reputation(ctx.fwd["origin_key"])
+    if ctx.origin_rep != "bad":
+        return None
+    _perf_counters["forward_reputation_bans"] += 1
+    logger.info(f"📨 FORWARD-REPUTATION-BAN @{ctx.username} ({ctx.fwd['origin_key']}) | {ctx.message.chat.title} | «{ctx.preview}»")
+    _forward_origin_by_message.set((ctx.message.chat.id, ctx.message.message_id), ctx.fwd["origin_key"])
+    return SpamResult.SPAM, f"Пересылка из известного спам-источника: {ctx.fwd['description']}"
+
+
+async def _stage_spam_db(ctx: ModerationContext):
+    ctx.start_signals()
+    ctx.in_spam_db, ctx.db_name = await await_signal("spam_db", ctx._spam_db_task, ctx.signals_deadline, (False, ""))
+    # Спам-база + нет истории → бан без LLM (правка — уже не первое сообщение)
+    if ctx.in_spam_db and ctx.user_msg_count == 0 and not ctx.is_edit:
+        logger.info(f"🚫 DB-BAN @{ctx.username} ({ctx.db_name}, msgs=0) | {ctx.message.chat.title} | «{ctx.preview}»")
+        return SpamResult.SPAM, f"Пользователь в базе спамеров {ctx.db_name}, нет истории в группе"
+    return None
+
+
+async def _stage_risk_signals(ctx: ModerationContext):
+    """Сбор сигналов риска в ctx.risk_signals; вердикта не выносит."""
+    ctx.start_signals()
+    message = ctx.message
+    if ctx.in_spam_db:
+        ctx.risk_signals.append((f"в базе спамеров {ctx.db_name}", 'strong'))
+        ctx.features["spam_db"] = 1
+
+    # Профиль нового пользователя (bio + личный канал): в контекст LLM — если
+    # успел к PROFILE_CONTEXT_WAIT_SECONDS, иначе позже, только в эскалацию
+    if ctx._profile_task is not None:
+        profile_signal = await await_signal(
+            "profile", ctx._profile_task,
+            min(ctx.signals_deadline, ctx._signals_started + PROFILE_CONTEXT_WAIT_SECONDS), "",
+        )
+        ctx.profile_in_context = ctx._profile_task.done()
+        if profile_signal:
+            ctx.risk_signals.append((profile_signal, 'weak'))
+            ctx.features["profile"] = 1
+            logger.info(f"👤 Profile check @{ctx.username}: {profile_signal[:100]}")
+
+    # Пересланное сообщение от нового пользователя (кроме проверенно чистых источников)
+    if ctx.fwd and ctx.user_msg_count <= 2:
+        forward_source = ctx.fwd["description"]
+        if ctx.origin_rep == "clean":
+            _perf_counters["forward_reputation_clean_skips"] += 1
+            forward_source = ""
+        if forward_source:
+            ctx.risk_signals.append((forward_source, 'weak'))
+            ctx.features["forward"] = 1
+            logger.info(f"📨 Forward from new user @{ctx.username}: {forward_source}")
+
+    # Опасный документ от нового пользователя — сильный сигнал
+    # (HTML/exe/apk/zip от незнакомого аккаунта почти всегда вредонос)
+    if message.document and ctx.user_msg_count <= 2:
+        suspicious_exts = ('.html', '.htm', '.exe', '.apk', '.zip', '.rar', '.bat', '.scr', '.js')
+        fname = (message.document.file_name or '').lower()
+        if any(fname.endswith(ext) for ext in suspicious_exts):
+            doc_signal = f"Опасный документ '{message.document.file_name}' от нового пользователя"
+            ctx.risk_signals.append((doc_signal, 'strong'))
+            ctx.features["dangerous_document"] = 1
+            logger.info(f"📎 Suspicious document from @{ctx.username}: {doc_signal}")
+
+    # URL фото (запрос к Telegram ушёл вместе с остальными)
+    if ctx._photo_task is not None:
+        ctx.photo_url = await await_signal("photo", ctx._photo_task, ctx.signals_deadline, None)
+        if ctx.photo_url:
+            logger.info(f"📷 Photo from @{ctx.username} | {message.chat.title} | caption: «{ctx.preview}»")
+    return None
+
+
+def _risk_features(ctx: ModerationContext) -> dict:
+    """Признаки риск-скора: сигналы риска + простые свойства сообщения."""
+    features = dict(ctx.features)
+    features["no_history"] = int(ctx.user_msg_count == 0)
+    features["link"] = int(bool(_URL_RE.search(ctx.text)))
+    features["mention"] = int(bool(_MENTION_RE.search(ctx.text)))
+    features["photo"] = int(bool(ctx.message.photo))
+    return features
+
+
+async def _stage_risk_score(ctx: ModerationContext):
+    # Уверенное решение по сигналам — до LLM; в shadow-режиме только запоминаем
+    features = _risk_features(ctx)
+    decision, _ = _risk_scorer.decide(features)
+    if decision is not None and RISK_SCORER_MODE == "on" and ctx._profile_task is not None \
+            and not ctx.profile_in_context:
+        # Решение без LLM окончательное — профиль, не успевший к этой стадии,
+        # дожидаемся (до общего дедлайна сигналов) и решаем с ним. Он попадает
+        # и в контекст LLM, если решать всё же придётся ей
+        await _stage_late_signals(ctx)
+        ctx.profile_in_context = True
+        features = _risk_features(ctx)
+        decision, _ = _risk_scorer.decide(features)
+    ctx.risk_decision = decision
+    if decision is None:
+        return None
+    audit = _risk_scorer.audit(features)
+    logger.info(f"🎚 RISK {'BAN' if decision else 'PASS'} ({RISK_SCORER_MODE}) @{ctx.username}: {audit}")
+    if RISK_SCORER_MODE != "on":
+        return None
+    _perf_counters["risk_llm_avoided"] += 1
+    return (SpamResult.SPAM if decision else SpamResult.NOT_SPAM), f"Решено без LLM, {audit}"
+
+
+def _record_risk_outcome(ctx: ModerationContext, result: SpamResult, stage: str):
+    """Сверка shadow-решения риск-скора и сохранение признаков для /riskfit."""
+    if ctx.risk_decision is not None and stage != "risk_score":
+        # Как решил бы режим on: он дожидается профиля, здесь профиль уже есть
+        decision = _risk_scorer.decide(_risk_features(ctx))[0]
+        if decision is not None:
+            agree = result == (SpamResult.SPAM if decision else SpamResult.NOT_SPAM)
+            _perf_counters["risk_shadow_agree" if agree else "risk_shadow_disagree"] += 1
+    # Вердикты правил (fingerprint, спам-база) не сохраняем; вердикты LLM-стадии
+    # без ответа модели (перегрузка, сбой, rate limit, локальный классификатор)
+    # сохраняются как "fallback" — меткой они станут только с решением админа
+    if stage in ("risk_score", "llm", "escalation"):
+        by = stage if stage == "risk_score" or ctx.model_verdict else "fallback"
+        try:
+            db.set_risk_features(ctx.message.message_id, ctx.message.chat.id,
+                                 json_module.dumps({"f": _risk_features(ctx), "by": by}))
+        except Exception as e:
+            logger.debug(f"Не удалось сохранить признаки риска: {e}")
+
+
+# Стадии, чей вердикт (без решения админа) годится в метку для обучения
+_MODEL_STAGES = ("llm", "escalation")
+
+
+def _risk_record(raw) -> dict:
+    """Разобрать messages.risk_features: {"f": признаки, "by": стадия}."""
+    try:
+        data = json_module.loads(raw)
+    except (TypeError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _risk_training_rows() -> list:
+    """[(features, is_spam), ...]: решения админа + вердикты, вынесенные LLM.
+
+    Решения самого риск-скора без подтверждения админом не учитываются —
+    иначе модель учится на своих же ответах.
+    """
+    rows = []
+    for raw, is_spam, by_admin in db.get_risk_dataset(exclude_reasoning=_NO_LLM_REASONS):
+        data = _risk_record(raw)
+        if data and (by_admin or data.get("by") in _MODEL_STAGES):
+            rows.append((data.get("f") or {}, is_spam))
+    return rows
+
+
+def train_risk_scorer() -> dict:
+    """Подобрать веса и пороги риск-скора по истории и сохранить их в meta."""
+    global _risk_scorer
+    scorer = risk_scorer.fit(
+        _risk_training_rows(), target_fpr=RISK_SCORER_TARGET_FPR, target_fnr=RISK_SCORER_TARGET_FNR,
+        min_per_class=RISK_SCORER_MIN_PER_CLASS,
+    )
+    _risk_scorer = scorer
+    db.set_meta("risk_scorer", scorer.to_json())
+    report = scorer.report
+    if report["calibrated"]:
+        logger.info(
+            f"Риск-скор: {report['examples']} примеров, покрытие {report['coverage']:.0%}, "
+            f"FPR {report['fpr']:.2%}, FNR {report['fnr']:.2%}"
+        )
+    else:
+        logger.info(f"Риск-скор: мало данных для калибровки ({report['examples']} примеров)")
+    return report
+
+
+def load_risk_scorer():
+    global _risk_scorer
+    raw = db.get_meta("risk_scorer")
+    if raw:
+        _risk_scorer = RiskScorer.from_json(raw)
+
+
+async def _classify_contexts(ctxs: list) -> tuple[SpamResult, str]:
+    """Одна LLM-проверка сообщения или серии сообщений одного пользователя.
+
+    Допуск к LLM — один на серию; не допущенной серии политика перегрузки
+    применяется к каждому сообщению.
+    """
+    lead = ctxs[0]
+    # Под нагрузкой пользователь с историей в очередь не встаёт — его проверка
+    # откладывается; новые ждут допуска не дольше ADMISSION_MAX_WAIT_SECONDS
+    if not await _admission.acquire(max_wait=0 if lead.user_msg_count > 0 else None):
+        for c in ctxs[1:]:
+            _overload_verdict(c)  # ctx.shed — каждому сообщению серии
+        return _overload_verdict(lead)
+    try:
+        if len(ctxs) == 1:
+            return await check_message_with_llm(
+                lead.text, lead.uid, lead.user_msg_count, lead.in_spam_db, lead.photo_url, lead.context_note
+            )
+        notes = list(dict.fromkeys(c.context_note for c in ctxs if c.context_note))
+        result, reasoning = await check_message_with_llm(
+            "\n".join(c.text for c in ctxs), lead.uid, min(c.user_msg_count for c in ctxs),
+            any(c.in_spam_db for c in ctxs), None, "; ".join(notes),
+        )
+    finally:
+        await _admission.release()
+    _perf_counters["burst_calls_saved"] += len(ctxs) - 1
+    logger.info(f"🧩 BURST @{lead.username}: {len(ctxs)} сообщ. одним вызовом → {result.value}")
+    if reasoning == DEGRADED_REASON:
+        return result, reasoning
+    return result, f"[серия из {len(ctxs)} сообщений] {reasoning}"
+
+
+async def _classify_burst(key, ctxs: list) -> tuple[SpamResult, str]:
+    return await _classify_contexts(ctxs)
+
+
+# Серии быстрых сообщений одного пользователя в чате — одним вызовом
+_burst_coalescer = BurstCoalescer(
+    _classify_burst, window=BURST_WINDOW_MS / 1000, max_wait=BURST_MAX_WAIT_MS / 1000,
+    max_items=BURST_MAX_MESSAGES,
+)
+
+
+def _burst_applies(ctx: ModerationContext) -> bool:
+    # Только новые текстовые сообщения: у фото свой Vision-вызов, пересылки —
+    # самостоятельные сообщения, правка относится к одному сообщению
+    return BURST_WINDOW_MS > 0 and not ctx.is_edit and not ctx.fwd and not ctx.message.photo
+
+
+def _burst_claim(ctx: ModerationContext, action: str) -> bool:
+    """Выполнять ли этому сообщению action ("ban", "review"): в серии — только одному,
+    и он действует за всю серию (см. _burst_messages)."""
+    if ctx.burst is None:
+        return True
+    if action in ctx.burst["claimed"]:
+        return False
+    ctx.burst["claimed"].add(action)
+    return True
+
+
+def _burst_messages(ctx: ModerationContext) -> list:
+    """Все сообщения серии по порядку — из коалесцера, а не из БД: остальные
+    части обрабатываются параллельно и могут быть ещё не сохранены."""
+    if ctx.burst is None:
+        return [ctx.message]
+    return [c.message for c in ctx.burst["items"]]
+
+
+async def _stage_llm(ctx: ModerationContext):
+    # Сигналы передаются как информационный контекст; для правки — ещё и прежний текст
+    ctx.context_note = "; ".join([s for s, _ in ctx.risk_signals] + ([ctx.edit_context] if ctx.edit_context else []))
+    if _burst_applies(ctx):
+        (result, reasoning), ctx.burst = await _burst_coalescer.submit((ctx.message.chat.id, ctx.uid), ctx)
+    else:
+        result, reasoning = await _classify_contexts([ctx])
+    ctx.model_verdict = _is_model_verdict(reasoning)
+    if ctx.shed:
+        return result, reasoning
+    ctx.degraded = reasoning == DEGRADED_REASON
+    # Репутация источника копится по «сырому» вердикту LLM — до эскалации,
+    # в которую уже входит сам факт пересылки
+    if ctx.fwd and ctx.fwd["origin_key"]:
+        record_forward_verdict(ctx.fwd["origin_key"], result.value, ctx.fwd["chat_title"] or "")
+        _forward_origin_by_message.set((ctx.message.chat.id, ctx.message.message_id), ctx.fwd["origin_key"])
+    return result, reasoning
+
+
+async def _stage_edit_context(ctx: ModerationContext):
+    """Правка: спам-база и фото — только контекст для LLM, сигналов риска нет."""
+    ctx.start_signals(profile=False)
+    ctx.in_spam_db, ctx.db_name = await await_signal("spam_db", ctx._spam_db_task, ctx.signals_deadline, (False, ""))
+    if ctx._photo_task is not None:
+        ctx.photo_url = await await_signal("photo", ctx._photo_task, ctx.signals_deadline, None)
+    return None
+
+
+async def _stage_late_signals(ctx: ModerationContext):
+    # Профиль, не успевший к LLM, всё равно участвует в эскалации
+    profile_signal = await await_signal("profile_late", ctx._profile_task, ctx.signals_deadline, "")
+    if profile_signal:
+        ctx.risk_signals.append((profile_signal, 'weak'))
+        ctx.features["profile"] = 1
+        logger.info(f"👤 Profile check (после LLM) @{ctx.username}: {profile_signal[:100]}")
+    return None
+
+
+async def _stage_escalation(ctx: ModerationContext):
+    # Эскалация по совокупности сигналов (MAYBE+strong→SPAM и т.д.)
+    result, reasoning = ctx.verdict
+    return apply_risk_escalation(result, reasoning, ctx.risk_signals)
+
+
+# Стоимость — ожидаемая задержка стадии в мс, пока нет замеров.
+# reorderable — дешёвые стадии до LLM, которые не зависят друг от друга:
+# их порядок задаёт PIPELINE_ORDER или адаптивный режим. Остальные идут
+# строго в объявленном порядке (LLM ждёт сигналы, эскалация — LLM).
+_moderation_pipeline = Pipeline(
+    [
+        Stage("fingerprint", _stage_fingerprint, cost_ms=1, reorderable=True),
+        Stage("forward_reputation", _stage_forward_reputation, cost_ms=0.1, reorderable=True,
+              applies=lambda ctx: ctx.fwd is not None),
+        Stage("spam_db", _stage_spam_db, cost_ms=300, reorderable=True),
+        Stage("risk_signals", _stage_risk_signals, cost_ms=300),
+        Stage("risk_score", _stage_risk_score, cost_ms=0.1,
+              applies=lambda ctx: RISK_SCORER_MODE in ("shadow", "on") and _risk_scorer.ready),
+        Stage("llm", _stage_llm, cost_ms=1500, short_circuit=False),
+        Stage("late_signals", _stage_late_signals, cost_ms=0,
+              applies=lambda ctx: ctx._profile_task is not None and not ctx.profile_in_context),
+        Stage("escalation", _stage_escalation, cost_ms=0, short_circuit=False),
+    ],
+    label=lambda verdict: verdict[0].value,
+    order=PIPELINE_ORDER,
+    adaptive=PIPELINE_ADAPTIVE,
+    adaptive_min_runs=PIPELINE_ADAPTIVE_MIN_RUNS,
+)
+
+# Правка перепроверяется как раньше — только LLM, с прежним текстом и
+# спам-базой в контексте. Fingerprint, сигналы риска и эскалация к правкам
+# не применяются: иначе каждая правка пользователя из спам-базы — новое
+# ревью админу
+_edit_pipeline = Pipeline(
+    [
+        Stage("edit_context", _stage_edit_context, cost_ms=300),
+        Stage("llm", _stage_llm, cost_ms=1500, short_circuit=False),
+    ],
+    label=lambda verdict: verdict[0].value,
+)
+
+
+# ──────────────────────────────────────────────
+# Дедупликация апдейтов
+# ──────────────────────────────────────────────
+
+async def dedup_middleware(handler, event: types.Update, data: dict):
+    # Повтор (перезапуск polling, сетевой ретрай) — отбрасываем до LLM и БД
+    keys = await _update_dedup.begin(event)
+    if keys is None:
+        logger.info(f"♻️ Повторный апдейт {event.update_id} пропущен")
+        return None
+    try:
+        result = await handler(event, data)
+    except BaseException:
+        # Обработка не завершилась — повторная доставка должна пройти
+        _update_dedup.abort(keys)
+        raise
+    await _update_dedup.done(keys)
+    return result
+
+
+dp.update.outer_middleware(dedup_middleware)
+
+
+async def dedup_prune_loop(interval: float = 3600):
+    while True:
+        try:
+            await asyncio.to_thread(db.prune_processed_updates, DEDUP_RETENTION_HOURS)
+        except Exception as e:
+            logger.error(f"Ошибка очистки processed_updates: {e}")
+        await asyncio.sleep(interval)
+
+
 # ──────────────────────────────────────────────
 # Основной обработчик сообщений
 # ──────────────────────────────────────────────
@@ -1883,7 +4040,7 @@ async def handle_message(message: types.Message):
     if meaningful_count >= TRUSTED_USER_MESSAGES and not is_forward:
         logger.info(f"✅ TRUSTED @{username} (msgs={user_msg_count}) | {message.chat.title} | «{text_preview}»")
         try:
-            db.save_message(message.message_id, cid, uid, message.from_user.username or '', msg_text, "НЕ_СПАМ")
+            save_message_record(message.message_id, cid, uid, message.from_user.username or '', msg_text, "НЕ_СПАМ")
         except Exception:
             pass
         return
@@ -1897,92 +4054,35 @@ async def handle_message(message: types.Message):
     if not msg_text and not has_photo and not has_document:
         return
 
-    # FINGERPRINT: точное совпадение с подтверждённым спамом → мгновенный бан
-    # без затрат на LLM (спам-кампании репостят текст дословно)
-    if msg_text and len(msg_text) >= 25 and db.is_known_spam_text(msg_text):
-        logger.info(f"🎯 FINGERPRINT-BAN @{username} | {message.chat.title} | «{text_preview}»")
-        try:
-            db.save_message(message.message_id, cid, uid, message.from_user.username or '', msg_text, "СПАМ",
-                            "Точное совпадение с подтверждённым спамом")
-        except Exception:
-            pass
-        await ban_and_report(message, SpamResult.SPAM, "Точное совпадение с подтверждённым спамом (fingerprint)")
-        return
-
-    in_spam_db, db_name = await check_spam_databases(uid)
-    is_cas_banned = in_spam_db  # для контекста LLM
-
-    # ── Сбор сигналов риска: [(описание, 'strong'|'weak'), ...] ──
-    risk_signals = []
-
-    # Спам-база + нет истории → автобан без LLM
-    if in_spam_db and user_msg_count == 0:
-        logger.info(f"🚫 DB-BAN @{username} ({db_name}, msgs=0) | {message.chat.title} | «{text_preview}»")
-        try:
-            db.save_message(message.message_id, cid, uid, message.from_user.username or '', msg_text, "СПАМ")
-        except Exception:
-            pass
-        await ban_and_report(message, SpamResult.SPAM, f"Пользователь в базе спамеров {db_name}, нет истории в группе")
-        return
-    if in_spam_db:
-        risk_signals.append((f"в базе спамеров {db_name}", 'strong'))
-
-    # Профиль нового пользователя (bio + личный канал)
-    if user_msg_count <= 2:
-        profile_signal = await check_user_profile(uid)
-        if profile_signal:
-            risk_signals.append((profile_signal, 'weak'))
-            logger.info(f"👤 Profile check @{username}: {profile_signal[:100]}")
-
-    # Пересланное сообщение от нового пользователя
-    if is_forward and user_msg_count <= 2:
-        forward_source = get_forward_info(message)["description"]
-        if forward_source:
-            risk_signals.append((forward_source, 'weak'))
-            logger.info(f"📨 Forward from new user @{username}: {forward_source}")
-
-    # Опасный документ от нового пользователя — сильный сигнал
-    # (HTML/exe/apk/zip от незнакомого аккаунта почти всегда вредонос)
-    if has_document and user_msg_count <= 2:
-        suspicious_exts = ('.html', '.htm', '.exe', '.apk', '.zip', '.rar', '.bat', '.scr', '.js')
-        fname = (message.document.file_name or '').lower()
-        if any(fname.endswith(ext) for ext in suspicious_exts):
-            doc_signal = f"Опасный документ '{message.document.file_name}' от нового пользователя"
-            risk_signals.append((doc_signal, 'strong'))
-            logger.info(f"📎 Suspicious document from @{username}: {doc_signal}")
-
-    # Получаем URL фото если есть
-    photo_url = None
-    if has_photo:
-        try:
-            # Берём самое большое фото (последнее в массиве)
-            photo = message.photo[-1]
-            file_info = await bot.get_file(photo.file_id)
-            photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-            logger.info(f"📷 Photo from @{username} | {message.chat.title} | caption: «{text_preview}»")
-        except Exception as e:
-            logger.error(f"Ошибка получения фото: {e}")
-
-    # LLM-классификация: сигналы передаются как информационный контекст
-    context_note = "; ".join(s for s, _ in risk_signals)
-    result, reasoning = await check_message_with_llm(msg_text, uid, user_msg_count, is_cas_banned, photo_url, context_note)
-
-    # Эскалация по совокупности сигналов (MAYBE+strong→SPAM и т.д.)
-    result, reasoning = apply_risk_escalation(result, reasoning, risk_signals)
+    ctx = ModerationContext(message, msg_text, user_msg_count,
+                            fwd=get_forward_info(message) if is_forward else None)
+    (result, reasoning), stage = await _moderation_pipeline.run(ctx)
 
     emoji = {"СПАМ": "🔴", "ВОЗМОЖНО_СПАМ": "🟡", "НЕ_СПАМ": "🟢"}[result.value]
-    source = "Vision" if photo_url else "LLM"
-    logger.info(f"{emoji} {source}→{result.value} @{username} (msgs={user_msg_count}, cas={is_cas_banned}, signals={len(risk_signals)}) | {message.chat.title} | «{text_preview}» | reason: {reasoning[:100]}")
+    source = "Vision" if ctx.photo_url else "LLM" if stage in ("llm", "escalation") else stage
+    logger.info(f"{emoji} {source}→{result.value} @{username} (msgs={user_msg_count}, cas={ctx.in_spam_db}, signals={len(ctx.risk_signals)}) | {message.chat.title} | «{text_preview}» | reason: {reasoning[:100]}")
 
     try:
-        db.save_message(message.message_id, cid, uid, message.from_user.username or '', msg_text, result.value, reasoning)
+        save_message_record(message.message_id, cid, uid, message.from_user.username or '', msg_text,
+                            _stored_verdict(ctx, result), reasoning)
     except Exception as e:
         logger.error(f"Ошибка сохранения: {e}")
-
-    if result == SpamResult.SPAM:
-        await ban_and_report(message, result, reasoning)
+    _record_risk_outcome(ctx, result, stage)
+
+    if result == SpamResult.SPAM and not _burst_claim(ctx, "ban"):
+        pass  # автора серии банит одно сообщение, оно же удаляет все части серии
+    elif result == SpamResult.SPAM:
+        await ban_and_report(message, result, reasoning, series=_burst_messages(ctx))
+    elif result == SpamResult.MAYBE_SPAM and ctx.degraded and not ctx.risk_signals:
+        # LLM недоступен, сигналов риска нет — в дайджест, а не ревью на каждое сообщение
+        defer_degraded_review(message, msg_text, user_msg_count, ctx.photo_url)
+    elif ctx.shed and not ctx.risk_signals:
+        # Перегрузка, сигналов нет — LLM проверит позже
+        defer_overload_check(ctx)
+    elif result == SpamResult.MAYBE_SPAM and not _burst_claim(ctx, "review"):
+        pass  # серия уже на ревью целиком; кнопка «СПАМ» удалит все сообщения автора
     elif result == SpamResult.MAYBE_SPAM:
-        await send_to_admin(message, result, reasoning)
+        await send_to_admin(message, result, reasoning, series=_burst_messages(ctx))
 
 
 # ──────────────────────────────────────────────
@@ -2019,7 +4119,7 @@ async def handle_edited_message(message: types.Message):
         return
 
     # Получаем предыдущий вердикт из БД
-    existing = db.get_message_by_id(message.message_id)
+    existing = get_message_record(message.message_id, cid)
     previous_result = None
     previous_text = None
     if existing:
@@ -2036,18 +4136,6 @@ async def handle_edited_message(message: types.Message):
         f"«{text_preview}» (prev={previous_result})"
     )
 
-    # Получаем фото-URL если есть
-    photo_url = None
-    if message.photo:
-        try:
-            photo = message.photo[-1]
-            file_info = await bot.get_file(photo.file_id)
-            photo_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-        except Exception:
-            pass
-
-    is_cas_banned = await check_cas_ban(uid)
-
     # Классифицируем новый текст БЕЗ предвзятости.
     # Если предыдущее решение было НЕ_СПАМ, добавим контекст для прозрачности:
     # это поможет LLM осознать паттерн edit-to-spam, но без жёсткой инструкции
@@ -2059,23 +4147,23 @@ async def handle_edited_message(message: types.Message):
             f"Оценивай только намерение нового текста."
         )
 
-    result, reasoning = await check_message_with_llm(
-        msg_text, uid, user_msg_count, is_cas_banned, photo_url, edit_context
-    )
+    ctx = ModerationContext(message, msg_text, user_msg_count, is_edit=True, edit_context=edit_context)
+    (result, reasoning), stage = await _edit_pipeline.run(ctx)
 
     # Обновляем запись в БД новым результатом
     try:
         edited_reasoning = (reasoning or "") + " [edited]"
+        stored = _stored_verdict(ctx, result)
         if existing:
-            db.update_message_after_edit(message.message_id, msg_text, result.value, edited_reasoning)
+            update_message_record_after_edit(message.message_id, cid, uid, msg_text, stored, edited_reasoning)
         else:
-            db.save_message(message.message_id, cid, uid, message.from_user.username or '',
-                            msg_text, result.value, edited_reasoning)
+            save_message_record(message.message_id, cid, uid, message.from_user.username or '',
+                            msg_text, stored, edited_reasoning)
     except Exception as e:
         logger.error(f"Ошибка обновления отредактированного сообщения: {e}")
 
     emoji = {"СПАМ": "🔴", "ВОЗМОЖНО_СПАМ": "🟡", "НЕ_СПАМ": "🟢"}[result.value]
-    logger.info(f"{emoji} EDIT→{result.value} @{username} | prev={previous_result} | reason: {reasoning[:100]}")
+    logger.info(f"{emoji} EDIT→{result.value} @{username} | prev={previous_result} | stage={stage} | reason: {reasoning[:100]}")
 
     # Реакция зависит от перехода
     was_clean = previous_result in (None, "НЕ_СПАМ")
@@ -2089,6 +4177,11 @@ async def handle_edited_message(message: types.Message):
     elif became_spam:
         # Был подозрительный, теперь СПАМ — тоже бан
         await ban_and_report(message, result, f"[EDIT] {reasoning}")
+    elif became_maybe and was_clean and ctx.degraded and not ctx.risk_signals:
+        # LLM недоступен — новый текст перепроверим после восстановления
+        defer_degraded_review(message, msg_text, user_msg_count, ctx.photo_url, edit_context, ctx.in_spam_db)
+    elif ctx.shed and not ctx.risk_signals and was_clean:
+        defer_overload_check(ctx)
     elif became_maybe and was_clean:
         # Появилось что-то подозрительное в безобидном — на ревью
         await send_to_admin(message, result, f"[EDIT] Было НЕ_СПАМ, стало подозрительно. {reasoning}")
@@ -2099,21 +4192,47 @@ async def handle_edited_message(message: types.Message):
 # Callback: фидбек (СПАМ / НЕ СПАМ) → автообучение
 # ──────────────────────────────────────────────
 
+def _admin_spam_type(message_id: int, chat_id: int, reasoning: str) -> str:
+    """'context' — спам по профилю/пересылке, а не по тексту (в few-shot не идёт).
+
+    Берём сигналы риска, сохранённые при проверке; по тексту reasoning —
+    только для старых записей без сигналов.
+    """
+    try:
+        raw = db.get_risk_features(message_id, chat_id) if chat_id else None
+    except Exception:
+        raw = None
+    if raw:
+        try:
+            features = json_module.loads(raw).get("f") or {}
+        except (TypeError, ValueError, AttributeError):
+            features = {}
+        return 'context' if features.get("profile") or features.get("forward") else 'text'
+    r_lower = (reasoning or '').lower()
+    if any(kw in r_lower for kw in ['профил', 'profile', 'канал', 'channel', 'bio', 'переслано']):
+        return 'context'
+    return 'text'
+
+
 @dp.callback_query(F.data.startswith("spam_") | F.data.startswith("not_spam_"))
 @require_admin
 async def handle_admin_feedback(callback: types.CallbackQuery):
     try:
+        # {action}_{message_id}_{chat_id}; старые кнопки — без chat_id
         if callback.data.startswith("not_spam_"):
-            action, msg_id = "not_spam", int(callback.data[9:])
+            action, payload = "not_spam", callback.data[9:]
         else:
-            action, msg_id = "spam", int(callback.data[5:])
+            action, payload = "spam", callback.data[5:]
+        msg_part, _, chat_part = payload.partition("_")
+        msg_id = int(msg_part)
+        chat_hint = int(chat_part) if chat_part else None
         if msg_id <= 0:
             raise ValueError
     except (ValueError, TypeError):
         await callback.answer("❌ Некорректные данные")
         return
 
-    row = db.get_message_by_id(msg_id)
+    row = get_message_record(msg_id, chat_hint)
     if not row:
         await callback.answer("❌ Не найдено в БД")
         return
@@ -2123,13 +4242,11 @@ async def handle_admin_feedback(callback: types.CallbackQuery):
     is_spam = action == "spam"
 
     db.update_admin_decision(msg_id, decision)
-    # Определяем тип спама: если reasoning упоминает профиль/канал — это context spam
-    spam_type = 'text'
-    if is_spam and reasoning:
-        r_lower = (reasoning or '').lower()
-        if any(kw in r_lower for kw in ['профил', 'profile', 'канал', 'channel', 'bio', 'переслано']):
-            spam_type = 'context'
+    record_forward_verdict(_forward_origin_by_message.get((chat_id, msg_id)), decision, by_admin=True)
+    spam_type = _admin_spam_type(msg_id, chat_id, reasoning) if is_spam else 'text'
     db.add_training_example(message_text, is_spam, 'ADMIN_FEEDBACK', spam_type)
+    mark_few_shot_dirty()
+    learn_training_example(message_text, is_spam, spam_type)
 
     ban_info = ""
     if action == "spam" and user_id:
@@ -2188,9 +4305,12 @@ async def handle_unban(callback: types.CallbackQuery):
 
         await _finalize_admin_message(callback.message, "\n\n🟢 <b>РАЗБАНЕН</b>")
 
-        row = db.get_message_by_id(orig_msg_id)
+        record_forward_verdict(_forward_origin_by_message.get((chat_id, orig_msg_id)), "НЕ_СПАМ", by_admin=True)
+        row = get_message_record(orig_msg_id, chat_id)
         if row:
             db.add_training_example(row[0], False, 'UNBAN_CORRECTION')
+            mark_few_shot_dirty()
+            learn_training_example(row[0], False)
             await maybe_trigger_improvement("false_positive", row[0])
 
     except Exception as e:
@@ -2203,7 +4323,7 @@ async def handle_unban(callback: types.CallbackQuery):
 # ──────────────────────────────────────────────
 
 async def main():
-    global openai_client, bot, _http_client
+    global openai_client, bot, _http_client, _llm_router
 
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN не задан")
@@ -2218,9 +4338,25 @@ async def main():
     # DeepSeek, Mistral и т.д. + LLM_API_KEY для их ключа.
     _base_url = os.getenv("LLM_BASE_URL") or None
     _api_key = os.getenv("LLM_API_KEY") or OPENAI_API_KEY
-    openai_client = AsyncOpenAI(api_key=_api_key, base_url=_base_url)
+    # Повторы на 429 делает _llm_scheduler (с общей паузой Retry-After для всех вызовов),
+    # поэтому собственные ретраи клиента выключены
+    openai_client = AsyncOpenAI(api_key=_api_key, base_url=_base_url, max_retries=0)
     if _base_url:
         logger.info(f"LLM провайдер: {_base_url}")
+    try:
+        endpoints = parse_endpoints(LLM_ENDPOINTS)
+    except ValueError as e:
+        logger.error(f"LLM_ENDPOINTS не разобран, работаем с одним клиентом: {e}")
+        endpoints = []
+    if endpoints:
+        _llm_router = LLMRouter(
+            [Endpoint(ep["name"], AsyncOpenAI(api_key=ep["api_key"], base_url=ep["base_url"], max_retries=0),
+                      weight=ep["weight"], model=ep["model"], models=ep["models"]) for ep in endpoints],
+            failure_threshold=LLM_ENDPOINT_FAILURE_THRESHOLD,
+            base_cooldown=LLM_ENDPOINT_COOLDOWN_SECONDS,
+            primary_model=lambda: LLM_MODEL,
+        )
+        logger.info(f"LLM-роутер: {', '.join(ep['name'] for ep in endpoints)}")
     _http_client = httpx.AsyncClient()
 
     db.init_database()
@@ -2231,6 +4367,10 @@ async def main():
         BotCommand(command="stats", description="Статистика (админ)"),
         BotCommand(command="improve", description="Улучшить промпт (админ)"),
         BotCommand(command="models", description="Проверить доступные LLM модели (админ)"),
+        BotCommand(command="perf", description="Метрики производительности (админ)"),
+        BotCommand(command="classifier", description="Локальный классификатор (админ)"),
+        BotCommand(command="riskfit", description="Риск-скор по сигналам (админ)"),
+        BotCommand(command="fewshotbench", description="Сравнить режимы few-shot (админ)"),
         BotCommand(command="prompt", description="Текущий промпт (админ)"),
         BotCommand(command="history", description="История промптов (админ)"),
         BotCommand(command="rollback", description="Откат промпта (админ)"),
@@ -2287,6 +4427,10 @@ async def main():
             report_lines.append(f"  • Улучшение промпта: <code>{detection['improvement']}</code>")
         else:
             report_lines.append("  • ❌ Не найдена рабочая модель улучшения!")
+        if detection["hedge"]:
+            report_lines.append(f"  • Hedge: <code>{detection['hedge']}</code>")
+        if detection["fast"]:
+            report_lines.append(f"  • Каскад, nano-ступень: <code>{detection['fast']}</code>")
         # Пропущенные кандидаты — только в логи; админу это не нужно,
         # если рабочие модели нашлись (см. /models для деталей)
         if detection["errors"]:
@@ -2295,9 +4439,29 @@ async def main():
     except Exception as e:
         logger.warning(f"Не удалось отправить startup-отчёт: {e}")
 
+    try:
+        await asyncio.to_thread(build_few_shot_index)
+    except Exception as e:
+        logger.error(f"Не удалось построить индекс few-shot примеров: {e}")
+    if LOCAL_CLASSIFIER_MODE in ("shadow", "on"):
+        try:
+            await train_local_classifier()
+        except Exception as e:
+            logger.error(f"Не удалось обучить локальный классификатор: {e}")
+    try:
+        load_risk_scorer()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить риск-скор: {e}")
+
     # Запускаем еженедельный аудит в фоне
     asyncio.create_task(_weekly_improve_loop())
     logger.info("📅 Еженедельный аудит запланирован")
+    # Пробы провайдера и дайджест, пока LLM недоступен
+    asyncio.create_task(degraded_mode_loop())
+    # Отложенные под нагрузкой LLM-проверки
+    asyncio.create_task(overload_recheck_loop())
+    if DEDUP_PERSISTENT:
+        asyncio.create_task(dedup_prune_loop())
 
     try:
         await dp.start_polling(bot)
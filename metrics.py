@@ -0,0 +1,142 @@
+"""
+Метрики производительности LLM-вызовов: задержки, токены, prefix-cache.
+
+Всё в памяти процесса, без внешних зависимостей — для /perf.
+"""
+from collections import defaultdict, deque
+
+
+class LatencyWindow:
+    """Скользящее окно последних замеров задержки (секунды) + общие счётчики."""
+
+    def __init__(self, maxlen: int = 500):
+        self._samples: deque = deque(maxlen=maxlen)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    @property
+    def avg(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def samples(self) -> list:
+        return list(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """p в [0, 100] по последним замерам; 0.0, если замеров нет."""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+def _int_attr(obj, name: str) -> int:
+    value = getattr(obj, name, None) if obj is not None else None
+    return value if isinstance(value, int) else 0
+
+
+def extract_usage(response) -> tuple[int, int, int]:
+    """(prompt_tokens, cached_tokens, completion_tokens) из ответа chat.completions.
+
+    Провайдеры без usage / без prompt_tokens_details дают нули.
+    """
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None) if usage is not None else None
+    return (
+        _int_attr(usage, "prompt_tokens"),
+        _int_attr(details, "cached_tokens"),
+        _int_attr(usage, "completion_tokens"),
+    )
+
+
+def total_tokens(response) -> int:
+    """prompt + completion токены ответа (0, если usage нет)."""
+    prompt_tokens, _, completion_tokens = extract_usage(response)
+    return prompt_tokens + completion_tokens
+
+
+class _KindStats:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.cached_calls = 0
+        self.estimated_prompt_tokens = 0
+        self.latency_cached = LatencyWindow()
+        self.latency_uncached = LatencyWindow()
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """Доля входных токенов, обслуженных из prefix-кеша провайдера."""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+
+class LLMUsageStats:
+    """Токены и задержки по типам вызовов (text, vision, profile, ...).
+
+    Вызов считается «кешированным», если провайдер вернул cached_tokens > 0 —
+    задержки таких и остальных вызовов копятся раздельно.
+    """
+
+    def __init__(self):
+        self.by_kind: dict[str, _KindStats] = defaultdict(_KindStats)
+
+    def record(self, kind: str, latency: float, prompt_tokens: int = 0,
+               cached_tokens: int = 0, completion_tokens: int = 0, estimated_prompt_tokens: int = 0):
+        st = self.by_kind[kind]
+        st.calls += 1
+        st.estimated_prompt_tokens += estimated_prompt_tokens
+        st.prompt_tokens += prompt_tokens
+        st.cached_tokens += cached_tokens
+        st.completion_tokens += completion_tokens
+        if cached_tokens > 0:
+            st.cached_calls += 1
+            st.latency_cached.add(latency)
+        else:
+            st.latency_uncached.add(latency)
+
+    def calls(self, kind: str) -> int:
+        st = self.by_kind.get(kind)
+        return st.calls if st else 0
+
+    def avg_completion_tokens(self, kind: str) -> float:
+        st = self.by_kind.get(kind)
+        return st.completion_tokens / st.calls if st and st.calls else 0.0
+
+    def latency_percentile(self, kind: str, p: float) -> float:
+        """Перцентиль задержки по всем вызовам типа (с кешем и без)."""
+        st = self.by_kind.get(kind)
+        if not st:
+            return 0.0
+        merged = LatencyWindow(maxlen=None)
+        for v in st.latency_cached.samples() + st.latency_uncached.samples():
+            merged.add(v)
+        return merged.percentile(p)
+
+    def report_lines(self) -> list[str]:
+        lines = []
+        for kind in sorted(self.by_kind):
+            st = self.by_kind[kind]
+            lines.append(
+                f"  • {kind}: {st.calls} вызовов, вход {st.prompt_tokens} ток. "
+                f"(из кеша {st.cached_tokens}, {st.cache_hit_ratio:.0%}), выход {st.completion_tokens}"
+            )
+            if st.estimated_prompt_tokens and st.prompt_tokens:
+                lines.append(
+                    f"     локальная оценка входа {st.estimated_prompt_tokens} ток. "
+                    f"({st.estimated_prompt_tokens / st.prompt_tokens - 1:+.0%} к факту)"
+                )
+            lines.append(
+                f"     задержка p50: с кешем {st.latency_cached.percentile(50):.2f}s ({st.cached_calls}) "
+                f"/ без кеша {st.latency_uncached.percentile(50):.2f}s ({st.calls - st.cached_calls})"
+            )
+        return lines
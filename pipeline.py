@@ -0,0 +1,118 @@
+"""
+Конвейер модерации: последовательность стадий с объявленной стоимостью.
+
+Стадия — async-функция от контекста сообщения. Она возвращает вердикт или
+None (решения нет, идём дальше). Вердикт стадии с short_circuit=True
+останавливает конвейер. Вердикт стадии с short_circuit=False (LLM,
+эскалация) записывается в ctx.verdict, и конвейер продолжается: следующие
+стадии могут его уточнить.
+
+Порядок. Дешёвые независимые стадии (reorderable) идут первыми, и их порядок
+настраивается: явным списком имён или адаптивно. В адаптивном режиме стадии
+сортируются по экономии на единицу стоимости, то есть по доле срабатываний,
+делённой на среднюю задержку стадии. Это классический порядок для цепочки
+фильтров с ранним выходом. Остальные стадии зависят друг от друга и идут в
+объявленном порядке.
+
+Статистика по каждой стадии: запуски, срабатывания, задержка,
+распределение вердиктов.
+"""
+import logging
+import time
+from collections import Counter
+
+from metrics import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    def __init__(self, name: str, fn, cost_ms: float, reorderable: bool = False,
+                 short_circuit: bool = True, applies=None):
+        self.name = name
+        self.fn = fn
+        self.cost_ms = cost_ms  # ожидаемая задержка — единица стоимости до накопления замеров
+        self.reorderable = reorderable
+        self.short_circuit = short_circuit
+        self.applies = applies  # ctx → bool; None — стадия применима всегда
+
+
+class StageStats:
+    def __init__(self):
+        self.runs = 0
+        self.hits = 0  # вердиктов, остановивших конвейер
+        self.latency = LatencyWindow()
+        self.verdicts: Counter = Counter()
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.runs if self.runs else 0.0
+
+
+class Pipeline:
+    def __init__(self, stages: list[Stage], label=str, order: list[str] = None,
+                 adaptive: bool = False, adaptive_min_runs: int = 200):
+        self.stages = stages
+        self.label = label  # вердикт → строка для распределения
+        self.order = [name for name in (order or []) if any(s.name == name for s in stages)]
+        self.adaptive = adaptive
+        self.adaptive_min_runs = adaptive_min_runs
+        self.stats: dict[str, StageStats] = {s.name: StageStats() for s in stages}
+
+    def _unit_cost(self, stage: Stage) -> float:
+        st = self.stats[stage.name]
+        measured = st.latency.avg * 1000 if st.runs >= self.adaptive_min_runs else 0.0
+        return max(measured or stage.cost_ms, 0.01)
+
+    def ordered(self) -> list[Stage]:
+        cheap = [s for s in self.stages if s.reorderable]
+        rest = [s for s in self.stages if not s.reorderable]
+        if self.adaptive:
+            # Стадии без достаточной статистики — вперёд (дешёвая разведка),
+            # остальные — по срабатываниям на миллисекунду
+            def savings(s):
+                st = self.stats[s.name]
+                if st.runs < self.adaptive_min_runs:
+                    return (1, -s.cost_ms)
+                return (0, st.hit_rate / self._unit_cost(s))
+            cheap.sort(key=savings, reverse=True)
+        elif self.order:
+            # Явный порядок; не перечисленные стадии — после, в объявленном порядке
+            rank = {name: i for i, name in enumerate(self.order)}
+            cheap.sort(key=lambda s: rank.get(s.name, len(rank)))
+        else:
+            cheap.sort(key=lambda s: s.cost_ms)
+        return cheap + rest
+
+    async def run(self, ctx):
+        """Прогнать ctx по стадиям. Возвращает (вердикт, имя решившей стадии)."""
+        ctx.verdict, ctx.decided_by = None, None
+        for stage in self.ordered():
+            if stage.applies is not None and not stage.applies(ctx):
+                continue
+            st = self.stats[stage.name]
+            started = time.monotonic()
+            try:
+                verdict = await stage.fn(ctx)
+            finally:
+                st.runs += 1
+                st.latency.add(time.monotonic() - started)
+            if verdict is None:
+                continue
+            st.verdicts[self.label(verdict)] += 1
+            ctx.verdict, ctx.decided_by = verdict, stage.name
+            if stage.short_circuit:
+                st.hits += 1
+                break
+        return ctx.verdict, ctx.decided_by
+
+    def report(self) -> list[dict]:
+        return [{
+            "name": s.name,
+            "cost_ms": self._unit_cost(s),
+            "reorderable": s.reorderable,
+            "runs": self.stats[s.name].runs,
+            "hit_rate": self.stats[s.name].hit_rate,
+            "p50": self.stats[s.name].latency.percentile(50),
+            "verdicts": dict(self.stats[s.name].verdicts),
+        } for s in self.ordered()]
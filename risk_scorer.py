@@ -0,0 +1,153 @@
+"""
+Риск-скор по сигналам: логистическая регрессия на бинарных признаках
+(спам-база, опасный документ, подозрительный профиль, пересылка, ...).
+
+Веса подбираются офлайн (/riskfit) по истории: сигналы каждого сообщения
+сохраняются в messages.risk_features, метка — решение админа или итоговый
+вердикт бота. Пороги калибруются по оценкам кросс-валидации так же, как у
+local_classifier (каждый пример оценён моделью, не видевшей его фолд): ban — доля чистых сообщений со скором выше него не больше
+target_fpr; pass — доля спама ниже него не больше target_fnr. Между порогами
+решает LLM.
+
+Скор объясним: это сумма bias и весов сработавших признаков, audit()
+перечисляет вклад каждого.
+"""
+import json
+import math
+
+from local_classifier import calibrate, evaluate
+
+FEATURES = ("spam_db", "dangerous_document", "profile", "forward", "no_history", "link", "mention", "photo")
+FEATURE_TITLES = {
+    "spam_db": "спам-база",
+    "dangerous_document": "опасный документ",
+    "profile": "профиль",
+    "forward": "пересылка",
+    "no_history": "нет истории",
+    "link": "ссылка",
+    "mention": "@упоминание",
+    "photo": "фото",
+}
+
+
+def _sigmoid(x: float) -> float:
+    if x >= 0:
+        return 1 / (1 + math.exp(-x))
+    z = math.exp(x)
+    return z / (1 + z)
+
+
+def fit_weights(rows: list, l2: float = 0.1, epochs: int = 300, lr: float = 0.5) -> tuple[dict, float]:
+    """Логистическая регрессия градиентным спуском по [(features, is_spam), ...].
+
+    Признаков единицы, примеров тысячи — полный градиент на каждой эпохе
+    считается за миллисекунды, NumPy не нужен.
+    """
+    weights = {f: 0.0 for f in FEATURES}
+    bias = 0.0
+    n = len(rows)
+    if not n:
+        return weights, bias
+    active = [([f for f in FEATURES if feats.get(f)], float(is_spam)) for feats, is_spam in rows]
+    for _ in range(epochs):
+        grad = dict.fromkeys(FEATURES, 0.0)
+        grad_bias = 0.0
+        for on, y in active:
+            err = _sigmoid(bias + sum(weights[f] for f in on)) - y
+            grad_bias += err
+            for f in on:
+                grad[f] += err
+        bias -= lr * grad_bias / n
+        for f in FEATURES:
+            weights[f] -= lr * (grad[f] / n + l2 * weights[f] / n)
+    return weights, bias
+
+
+class RiskScorer:
+    """Веса + калиброванные пороги. Пока не откалиброван — decide() → None."""
+
+    def __init__(self, weights: dict = None, bias: float = 0.0,
+                 ban_threshold: float = math.inf, pass_threshold: float = -math.inf, report: dict = None):
+        self.weights = {f: 0.0 for f in FEATURES}
+        self.weights.update(weights or {})
+        self.bias = bias
+        self.ban_threshold = ban_threshold
+        self.pass_threshold = pass_threshold
+        self.report = report or {}
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.report.get("calibrated"))
+
+    def score(self, features: dict) -> float:
+        """log-odds спама."""
+        return self.bias + sum(self.weights[f] for f in FEATURES if features.get(f))
+
+    def contributions(self, features: dict) -> list[tuple[str, float]]:
+        return sorted(((f, self.weights[f]) for f in FEATURES if features.get(f)), key=lambda c: -abs(c[1]))
+
+    def decide(self, features: dict) -> tuple[bool | None, float]:
+        """(True — бан, False — пропуск, None — решает LLM; скор)."""
+        if not self.ready:
+            return None, 0.0
+        score = self.score(features)
+        if score >= self.ban_threshold:
+            return True, score
+        if score <= self.pass_threshold:
+            return False, score
+        return None, score
+
+    def audit(self, features: dict) -> str:
+        """Объяснение скора: порог, база и вклад каждого сработавшего сигнала."""
+        parts = [f"база {self.bias:+.2f}"] + [
+            f"{FEATURE_TITLES[f]} {w:+.2f}" for f, w in self.contributions(features)
+        ]
+        return (
+            f"риск-скор {self.score(features):+.2f} (бан ≥ {self.ban_threshold:+.2f}, "
+            f"пропуск ≤ {self.pass_threshold:+.2f}): {', '.join(parts)}"
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "weights": self.weights, "bias": self.bias,
+            # inf в JSON не представим — None
+            "ban_threshold": self.ban_threshold if math.isfinite(self.ban_threshold) else None,
+            "pass_threshold": self.pass_threshold if math.isfinite(self.pass_threshold) else None,
+            "report": self.report,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "RiskScorer":
+        data = json.loads(raw)
+        ban, pass_ = data.get("ban_threshold"), data.get("pass_threshold")
+        return cls(
+            data.get("weights"), data.get("bias", 0.0),
+            math.inf if ban is None else ban, -math.inf if pass_ is None else pass_,
+            data.get("report"),
+        )
+
+
+def fit(rows: list, target_fpr: float = 0.005, target_fnr: float = 0.02,
+        folds: int = 5, min_per_class: int = 30) -> RiskScorer:
+    """Обучить по [(features, is_spam), ...]: пороги — по оценкам кросс-валидации, веса — на всех."""
+    folds = max(2, folds)
+    scored = []
+    for k in range(folds):
+        part = [r for i, r in enumerate(rows) if i % folds == k]
+        if not part:
+            continue
+        weights, bias = fit_weights([r for i, r in enumerate(rows) if i % folds != k])
+        probe = RiskScorer(weights, bias)
+        scored += [(probe.score(feats), bool(is_spam)) for feats, is_spam in part]
+    n_spam = sum(1 for _, y in scored if y)
+    n_ham = len(scored) - n_spam
+
+    report = {"examples": len(rows), "scored_spam": n_spam, "scored_ham": n_ham, "folds": folds,
+              "target_fpr": target_fpr, "target_fnr": target_fnr, "calibrated": False}
+    pass_thr, ban_thr = -math.inf, math.inf
+    if n_spam >= min_per_class and n_ham >= min_per_class:
+        pass_thr, ban_thr = calibrate(scored, target_fpr, target_fnr)
+        report.update(evaluate(scored, pass_thr, ban_thr), calibrated=True)
+
+    weights, bias = fit_weights(rows)
+    return RiskScorer(weights, bias, ban_thr, pass_thr, report)
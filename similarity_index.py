@@ -0,0 +1,107 @@
+"""
+Локальный индекс похожих обучающих примеров для few-shot.
+
+Вектор сообщения — TF-IDF по хешированным символьным n-граммам (те же
+признаки, что у local_classifier), косинусная близость через инвертированный
+индекс: запрос трогает только документы с общими n-граммами. Самые частые
+n-граммы (предлоги, окончания) в поиске пропускаются — вклад у них ничтожный,
+а списки документов длинные.
+
+Нормы документов считаются при добавлении по текущим IDF и пересчитываются,
+когда индекс вырос вдвое, — между пересчётами косинус приближённый, для
+выбора k ближайших этого достаточно.
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from local_classifier import features
+
+
+class SimilarityIndex:
+    def __init__(self, max_df: float = 0.2):
+        self.max_df = max_df
+        self._texts: list[str] = []
+        self._labels: list[bool] = []
+        self._features: list[frozenset] = []
+        self._norms: list[float] = []
+        self._postings: dict[int, list[int]] = defaultdict(list)
+        self._by_text: dict[str, int] = {}
+        self._rebuilt_at = 0
+        # Растёт при каждом изменении примеров: входит в ключ кеша вердиктов,
+        # чтобы новый пример менял и ответы, закешированные в режиме retrieval
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def _idf(self, feature: int) -> float:
+        return math.log((len(self._texts) + 1) / (len(self._postings.get(feature, ())) + 1)) + 1
+
+    def _norm(self, feats) -> float:
+        return math.sqrt(sum(self._idf(f) ** 2 for f in feats)) or 1.0
+
+    def add(self, text: str, is_spam: bool):
+        """Добавить пример; повтор того же текста только обновляет метку (исправление админа)."""
+        if not text:
+            return
+        doc_id = self._by_text.get(text)
+        if doc_id is not None:
+            if self._labels[doc_id] != bool(is_spam):
+                self._labels[doc_id] = bool(is_spam)
+                self.generation += 1
+            return
+        self.generation += 1
+        feats = frozenset(features(text))
+        doc_id = len(self._texts)
+        self._by_text[text] = doc_id
+        self._texts.append(text)
+        self._labels.append(bool(is_spam))
+        self._features.append(feats)
+        for f in feats:
+            self._postings[f].append(doc_id)
+        self._norms.append(self._norm(feats))
+        if len(self._texts) >= 2 * max(self._rebuilt_at, 32):
+            self._rebuild_norms()
+
+    def build(self, examples):
+        """Заполнить индекс [(text, is_spam), ...] и один раз пересчитать нормы."""
+        for text, is_spam in examples:
+            self.add(text, is_spam)
+        self._rebuild_norms()
+
+    def _rebuild_norms(self):
+        self._norms = [self._norm(feats) for feats in self._features]
+        self._rebuilt_at = len(self._texts)
+
+    def search(self, text: str, k: int = 6, min_score: float = 0.1) -> list[tuple[str, bool, float]]:
+        """k ближайших [(text, is_spam, cosine), ...] по убыванию близости.
+
+        Пример с тем же текстом не возвращается: на оценке промпта он иначе
+        подсказывает модели правильный ответ, а в проде точные копии спама
+        и так ловит fingerprint.
+        """
+        if not text or not self._texts:
+            return []
+        n_docs = len(self._texts)
+        query = features(text)
+        scores: dict[int, float] = defaultdict(float)
+        q_norm_sq = 0.0
+        for f in query:
+            postings = self._postings.get(f)
+            if not postings:
+                continue
+            weight = self._idf(f) ** 2
+            q_norm_sq += weight
+            if n_docs >= 50 and len(postings) > self.max_df * n_docs:
+                continue
+            for doc_id in postings:
+                scores[doc_id] += weight
+        if not scores:
+            return []
+        q_norm = math.sqrt(q_norm_sq)
+        self_id = self._by_text.get(text)
+        best = heapq.nlargest(
+            k, ((s / (q_norm * self._norms[d]), d) for d, s in scores.items() if d != self_id)
+        )
+        return [(self._texts[d], self._labels[d], score) for score, d in best if score >= min_score]
@@ -0,0 +1,62 @@
+"""Тесты для admission.py — ограниченная очередь и отказы под нагрузкой."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController
+
+
+@pytest.mark.asyncio
+class TestAdmissionController:
+    async def test_admits_up_to_max_active(self):
+        ac = AdmissionController(max_active=2, max_queue=4, max_wait=1)
+        assert await ac.acquire() and await ac.acquire()
+        assert ac.active == 2 and ac.overloaded
+
+    async def test_no_wait_is_shed_when_busy(self):
+        ac = AdmissionController(max_active=1, max_queue=4, max_wait=1)
+        assert await ac.acquire()
+        assert not await ac.acquire(max_wait=0)
+        assert ac.shed_no_wait == 1 and ac.queued == 0
+
+    async def test_queue_full_is_shed_immediately(self):
+        ac = AdmissionController(max_active=1, max_queue=1, max_wait=5)
+        await ac.acquire()
+        waiter = asyncio.create_task(ac.acquire())
+        await asyncio.sleep(0)
+        assert ac.queued == 1
+        assert not await ac.acquire()
+        assert ac.shed_queue_full == 1
+        await ac.release()
+        assert await waiter
+        assert ac.active == 1 and ac.queued == 0
+
+    async def test_wait_is_bounded(self):
+        ac = AdmissionController(max_active=1, max_queue=4, max_wait=0.05)
+        await ac.acquire()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert not await ac.acquire()
+        assert loop.time() - started < 0.5
+        assert ac.shed_timeout == 1 and ac.queued == 0
+
+    async def test_waiters_do_not_jump_queue(self):
+        ac = AdmissionController(max_active=1, max_queue=4, max_wait=1)
+        await ac.acquire()
+        waiter = asyncio.create_task(ac.acquire())
+        await asyncio.sleep(0)
+        await ac.release()
+        # Слот освободился, но в очереди уже кто-то есть — новый без ожидания не проходит
+        assert not await ac.acquire(max_wait=0)
+        assert await waiter
+
+    async def test_unlimited(self):
+        ac = AdmissionController(max_active=0)
+        for _ in range(100):
+            assert await ac.acquire()
+        assert not ac.overloaded
+        assert ac.stats()["admitted"] == 100
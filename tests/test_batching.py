@@ -0,0 +1,142 @@
+"""Тесты для batching.py — micro-batching запросов."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import BurstCoalescer, MicroBatcher
+
+
+@pytest.mark.asyncio
+class TestMicroBatcher:
+    async def test_collects_within_wait_window(self):
+        seen = []
+
+        async def run_batch(key, items):
+            seen.append((key, list(items)))
+            return [i * 10 for i in items]
+
+        b = MicroBatcher(run_batch, max_size=10, max_wait=0.02)
+        results = await asyncio.gather(*[b.submit("p", i) for i in range(4)])
+        assert results == [0, 10, 20, 30]
+        assert seen == [("p", [0, 1, 2, 3])]
+        assert b.avg_batch_size == 4
+
+    async def test_flushes_at_max_size(self):
+        sizes = []
+
+        async def run_batch(key, items):
+            sizes.append(len(items))
+            return items
+
+        b = MicroBatcher(run_batch, max_size=2, max_wait=10)
+        results = await asyncio.wait_for(asyncio.gather(*[b.submit("p", i) for i in range(4)]), 1)
+        assert results == [0, 1, 2, 3]
+        assert sizes == [2, 2]
+
+    async def test_groups_not_mixed(self):
+        seen = []
+
+        async def run_batch(key, items):
+            seen.append(key)
+            return items
+
+        b = MicroBatcher(run_batch, max_size=10, max_wait=0.01)
+        await asyncio.gather(b.submit("a", 1), b.submit("b", 2), b.submit("a", 3))
+        assert sorted(seen) == ["a", "b"]
+
+    async def test_per_item_exception(self):
+        async def run_batch(key, items):
+            return [ValueError("bad") if i == 1 else i for i in items]
+
+        b = MicroBatcher(run_batch, max_size=10, max_wait=0.01)
+        results = await asyncio.gather(b.submit("p", 0), b.submit("p", 1), return_exceptions=True)
+        assert results[0] == 0
+        assert isinstance(results[1], ValueError)
+
+    async def test_batch_failure_propagates(self):
+        async def run_batch(key, items):
+            raise RuntimeError("provider down")
+
+        b = MicroBatcher(run_batch, max_size=10, max_wait=0.01)
+        with pytest.raises(RuntimeError):
+            await b.submit("p", 0)
+
+
+@pytest.mark.asyncio
+class TestBurstCoalescer:
+    async def test_burst_shares_one_call(self):
+        calls = []
+
+        async def run(key, items):
+            calls.append((key, list(items)))
+            return " ".join(items)
+
+        b = BurstCoalescer(run, window=0.02, max_wait=1)
+
+        async def later(delay, text):
+            await asyncio.sleep(delay)
+            return await b.submit("u1", text)
+
+        results = await asyncio.gather(later(0, "пиши"), later(0.01, "в личку"), later(0.015, "заработок"))
+        assert calls == [("u1", ["пиши", "в личку", "заработок"])]
+        assert all(r[0] == "пиши в личку заработок" for r in results)
+        burst = results[0][1]
+        assert burst["size"] == 3 and all(r[1] is burst for r in results)
+        assert burst["items"] == ["пиши", "в личку", "заработок"]
+        assert b.coalesced_bursts == 1 and b.avg_burst_size == 3
+
+    async def test_quiet_gap_splits_bursts(self):
+        sizes = []
+
+        async def run(key, items):
+            sizes.append(len(items))
+            return "ok"
+
+        b = BurstCoalescer(run, window=0.01, max_wait=1)
+        await b.submit("u1", "a")
+        await b.submit("u1", "b")
+        assert sizes == [1, 1]
+
+    async def test_max_wait_bounds_latency(self):
+        sizes = []
+
+        async def run(key, items):
+            sizes.append(len(items))
+            return "ok"
+
+        b = BurstCoalescer(run, window=0.05, max_wait=0.08, max_items=100)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = asyncio.create_task(b.submit("u1", 0))
+        # Сообщения каждые 30 мс продлевали бы окно бесконечно
+        for i in range(1, 6):
+            await asyncio.sleep(0.03)
+            if first.done():
+                break
+            asyncio.create_task(b.submit("u1", i))
+        await first
+        assert loop.time() - started < 0.2
+        assert sizes[0] < 6
+
+    async def test_max_items_flushes_immediately(self):
+        async def run(key, items):
+            return len(items)
+
+        b = BurstCoalescer(run, window=10, max_wait=10, max_items=2)
+        results = await asyncio.wait_for(asyncio.gather(b.submit("u", 1), b.submit("u", 2)), 1)
+        assert [r[0] for r in results] == [2, 2]
+
+    async def test_keys_not_mixed_and_errors_propagate(self):
+        async def run(key, items):
+            if key == "bad":
+                raise RuntimeError("llm down")
+            return key
+
+        b = BurstCoalescer(run, window=0.01, max_wait=1)
+        ok, bad = await asyncio.gather(b.submit("good", 1), b.submit("bad", 2), return_exceptions=True)
+        assert ok[0] == "good"
+        assert isinstance(bad, RuntimeError)
@@ -0,0 +1,133 @@
+"""Тесты для cache.py — LRU/TTL кеш и singleflight."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import SingleFlight, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    def test_get_set(self):
+        c = TTLCache(maxsize=10)
+        c.set("a", 1)
+        assert c.get("a") == 1
+        assert c.get("b") is None
+        assert c.hits == 1
+        assert c.misses == 1
+
+    def test_lru_eviction(self):
+        c = TTLCache(maxsize=2)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get("a")  # a становится самым свежим
+        c.set("c", 3)
+        assert "a" in c
+        assert "b" not in c
+        assert c.evictions == 1
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        c = TTLCache(maxsize=10, ttl=60, clock=clock)
+        c.set("a", 1)
+        clock.now += 59
+        assert c.get("a") == 1
+        clock.now += 2
+        assert c.get("a") is None
+        assert len(c) == 0
+
+    def test_per_entry_ttl(self):
+        clock = FakeClock()
+        c = TTLCache(maxsize=10, ttl=60, clock=clock)
+        c.set("short", 1, ttl=5)
+        c.set("forever", 2, ttl=None)
+        clock.now += 3600
+        assert c.get("short") is None
+        assert c.get("forever") == 2
+
+    def test_on_evict(self):
+        clock = FakeClock()
+        evicted = []
+        c = TTLCache(maxsize=2, ttl=60, clock=clock, on_evict=lambda k, v: evicted.append((k, v)))
+        c.set("a", 1)
+        c.set("b", 2)
+        c.set("c", 3)
+        assert evicted == [("a", 1)]
+        clock.now += 61
+        c.get("b")
+        assert evicted == [("a", 1), ("b", 2)]
+        c.pop("c")
+        assert len(evicted) == 2  # pop — не вытеснение
+
+    def test_hit_ratio(self):
+        c = TTLCache(maxsize=10)
+        assert c.hit_ratio == 0.0
+        c.set("a", 1)
+        c.get("a")
+        c.get("a")
+        c.get("x")
+        assert c.stats()["hit_ratio"] == 2 / 3
+
+
+@pytest.mark.asyncio
+class TestSingleFlight:
+    async def test_concurrent_calls_coalesced(self):
+        sf = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "verdict"
+
+        results = await asyncio.gather(*[sf.do("k", work) for _ in range(5)])
+        assert results == ["verdict"] * 5
+        assert calls == 1
+        assert sf.coalesced == 4
+        assert sf.in_flight == 0
+
+    async def test_different_keys_not_coalesced(self):
+        sf = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            return 1
+
+        await asyncio.gather(sf.do("a", work), sf.do("b", work))
+        assert sf.leaders == 2
+        assert sf.coalesced == 0
+
+    async def test_exception_propagates_to_waiters(self):
+        sf = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("llm down")
+
+        results = await asyncio.gather(sf.do("k", work), sf.do("k", work), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+    async def test_sequential_calls_not_cached(self):
+        """После завершения ключ освобождается — следующий вызов идёт заново."""
+        sf = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        assert await sf.do("k", work) == 1
+        assert await sf.do("k", work) == 2
@@ -0,0 +1,77 @@
+"""Тесты для circuit_breaker.py — открытие, пробы, закрытие."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from circuit_breaker import CLOSED, OPEN, CircuitBreaker
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _breaker(clock, **kwargs):
+    return CircuitBreaker(failure_threshold=3, open_seconds=30, max_open_seconds=100, clock=clock, **kwargs)
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self):
+        br = _breaker(_Clock())
+        for _ in range(2):
+            br.record_failure(TimeoutError())
+        assert br.allow()
+        br.record_failure(TimeoutError())
+        assert br.state == OPEN and not br.allow()
+        assert br.trips == 1 and br.rejected == 1
+
+    def test_success_resets_counter(self):
+        br = _breaker(_Clock())
+        br.record_failure(TimeoutError())
+        br.record_failure(TimeoutError())
+        br.record_success()
+        br.record_failure(TimeoutError())
+        assert br.state == CLOSED
+
+    def test_probe_due_after_pause_and_closes_on_success(self):
+        clock = _Clock()
+        br = _breaker(clock)
+        for _ in range(3):
+            br.record_failure(TimeoutError())
+        assert not br.probe_due()
+        clock.now = 30
+        assert br.probe_due()
+        br.record_success(probe=True)
+        assert br.state == CLOSED and br.allow()
+
+    def test_straggler_success_does_not_close(self):
+        br = _breaker(_Clock())
+        for _ in range(3):
+            br.record_failure(TimeoutError())
+        br.record_success()  # вызов, начатый до открытия
+        assert br.state == OPEN
+
+    def test_failed_probe_doubles_pause_up_to_max(self):
+        clock = _Clock()
+        br = _breaker(clock)
+        for _ in range(3):
+            br.record_failure(TimeoutError())
+        clock.now = 30
+        br.record_failure(TimeoutError())  # проба
+        assert br.retry_at == 90
+        clock.now = 90
+        br.record_failure(TimeoutError())
+        assert br.retry_at == 190  # 120 → max 100
+
+    def test_stragglers_do_not_extend_pause(self):
+        clock = _Clock()
+        br = _breaker(clock)
+        for _ in range(3):
+            br.record_failure(TimeoutError())
+        clock.now = 5
+        br.record_failure(TimeoutError())  # вызов, начатый до открытия
+        assert br.retry_at == 30
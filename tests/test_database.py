@@ -195,6 +195,80 @@ class TestMessages:
         assert reviewed == 1
         assert training == 1
 
+    def test_validation_dataset_excludes_own_verdicts(self):
+        """Вердикты локального классификатора без решения админа не идут в обучение."""
+        db.save_message(801, -1001, 90, "u", "локально спам", "СПАМ", "Локальный классификатор: спам")
+        db.save_message(802, -1001, 91, "u", "локально чисто", "НЕ_СПАМ", "Локальный классификатор: не спам")
+        db.save_message(803, -1001, 92, "u", "решил LLM", "НЕ_СПАМ", None)
+        db.update_admin_decision(802, "СПАМ")
+        texts = {t for t, _, _ in db.get_validation_dataset(exclude_reasoning="Локальный классификатор:")}
+        assert texts == {"локально чисто", "решил LLM"}
+        assert len(db.get_validation_dataset()) == 3
+
+    def test_validation_dataset_excludes_verdicts_without_llm(self):
+        """Вердикты перегрузки и деградации (без LLM) — не метки, пока их не подтвердил админ."""
+        exclude = ("LLM недоступен", "Перегрузка:")
+        db.save_message(811, -1001, 93, "u", "перегрузка", "СПАМ", "[сильный сигнал] Перегрузка: без LLM")
+        db.save_message(812, -1001, 94, "u", "сбой провайдера", "СПАМ", "LLM недоступен (circuit breaker)")
+        db.save_message(813, -1001, 95, "u", "подтверждено", "СПАМ", "Перегрузка: без LLM")
+        db.save_message(814, -1001, 96, "u", "решил LLM", "НЕ_СПАМ", "обычное сообщение")
+        db.update_admin_decision(813, "СПАМ")
+        texts = {t for t, _, _ in db.get_validation_dataset(exclude_reasoning=exclude)}
+        assert texts == {"подтверждено", "решил LLM"}
+        stats = db.count_validation_dataset(exclude_reasoning=exclude)
+        assert stats["admin_spam"] == 1 and stats["bot_spam_no_admin"] == 0
+        assert stats["bot_not_spam_no_admin"] == 1
+
+    def test_labeled_messages(self):
+        """Тексты с меткой: бот — только с признаками (кто решил), админ — всегда."""
+        db.save_message(721, -1001, 85, "u", "с признаками", "СПАМ")
+        db.save_message(722, -1001, 86, "u", "без признаков", "НЕ_СПАМ")
+        db.save_message(723, -1001, 87, "u", "решение админа", "ВОЗМОЖНО_СПАМ")
+        db.set_risk_features(721, -1001, '{"by": "llm"}')
+        db.update_admin_decision(723, "НЕ_СПАМ")
+        rows = sorted(db.get_labeled_messages())
+        assert rows == [
+            ("решение админа", None, False, True),
+            ("с признаками", '{"by": "llm"}', True, False),
+        ]
+
+    def test_risk_dataset(self):
+        """Признаки риска: метка — решение админа, иначе вердикт; MAYBE без решения пропускается."""
+        db.save_message(701, -1001, 80, "u", "a", "СПАМ")
+        db.save_message(702, -1001, 81, "u", "b", "НЕ_СПАМ")
+        db.save_message(703, -1001, 82, "u", "c", "ВОЗМОЖНО_СПАМ")
+        db.save_message(704, -1001, 83, "u", "d", "ВОЗМОЖНО_СПАМ")
+        db.save_message(705, -1001, 84, "u", "e", "СПАМ")  # без признаков
+        for mid in (701, 702, 703, 704):
+            db.set_risk_features(mid, -1001, f'{{"id": {mid}}}')
+        db.update_admin_decision(702, "СПАМ")
+        db.update_admin_decision(704, "НЕ_СПАМ")
+
+        rows = sorted(db.get_risk_dataset())
+        assert rows == [
+            ('{"id": 701}', True, False),
+            ('{"id": 702}', True, True),
+            ('{"id": 704}', False, True),
+        ]
+
+
+class TestProcessedUpdates:
+    def test_mark_once(self):
+        assert not db.is_update_processed("m:-100:1:0")
+        db.mark_update_processed("m:-100:1:0")
+        db.mark_update_processed("m:-100:1:0")  # повторная отметка — не ошибка
+        assert db.is_update_processed("m:-100:1:0")
+        assert not db.is_update_processed("m:-100:1:1700000000")
+
+    def test_prune(self):
+        db.mark_update_processed("u:1")
+        db.execute_query("UPDATE processed_updates SET processed_at = ?",
+                         (datetime.now() - timedelta(hours=72),))
+        db.mark_update_processed("u:2")
+        db.prune_processed_updates(48)
+        assert not db.is_update_processed("u:1")
+        assert db.is_update_processed("u:2")
+
 
 class TestBotState:
     def test_set_and_get_state(self):
@@ -0,0 +1,95 @@
+"""Тесты для dedup.py — ключи апдейтов, окно в памяти, отметки в таблице."""
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import UpdateDeduplicator, update_keys
+
+
+def _update(update_id, message_id=1, chat_id=-100, edit_date=None, edited=False):
+    message = SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id, edit_date=edit_date)
+    return SimpleNamespace(
+        update_id=update_id,
+        message=None if edited else message,
+        edited_message=message if edited else None,
+    )
+
+
+class TestUpdateKeys:
+    def test_message_and_edit(self):
+        assert update_keys(_update(7, message_id=5)) == ("u:7", "m:-100:5:0")
+        edit = _update(8, message_id=5, edit_date=datetime.fromtimestamp(1700000000), edited=True)
+        assert update_keys(edit) == ("u:8", "m:-100:5:1700000000")
+
+    def test_non_message_update(self):
+        update = SimpleNamespace(update_id=9, message=None, edited_message=None)
+        assert update_keys(update) == ("u:9", None)
+
+
+def _table():
+    """Таблица processed_updates в памяти: (is_processed, mark_processed, строки)."""
+    rows = set()
+    return rows.__contains__, rows.add, rows
+
+
+@pytest.mark.asyncio
+class TestUpdateDeduplicator:
+    async def test_redelivery_dropped_in_memory(self):
+        is_processed, mark, rows = _table()
+        dedup = UpdateDeduplicator(is_processed=is_processed, mark_processed=mark)
+        keys = await dedup.begin(_update(1))
+        assert keys == ["u:1", "m:-100:1:0"]
+        # Параллельный повтор, пока обработчик ещё работает
+        assert await dedup.begin(_update(1)) is None
+        await dedup.done(keys)
+        # Та же запись под новым update_id — тоже повтор
+        assert await dedup.begin(_update(2)) is None
+        assert rows == {"m:-100:1:0"}
+        assert dedup.stats()["duplicates_memory"] == 2
+
+    async def test_each_edit_is_new_event(self):
+        dedup = UpdateDeduplicator()
+        assert await dedup.begin(_update(1))
+        assert await dedup.begin(_update(2, edit_date=100, edited=True))
+        assert await dedup.begin(_update(3, edit_date=200, edited=True))
+        assert await dedup.begin(_update(4, edit_date=200, edited=True)) is None
+
+    async def test_processed_update_survives_restart(self):
+        is_processed, mark, rows = _table()
+        dedup = UpdateDeduplicator(is_processed=is_processed, mark_processed=mark)
+        await dedup.done(await dedup.begin(_update(1)))
+        restarted = UpdateDeduplicator(is_processed=is_processed, mark_processed=mark)
+        assert await restarted.begin(_update(1)) is None
+        assert restarted.duplicates_persistent == 1
+
+    async def test_interrupted_update_processed_after_restart(self):
+        is_processed, mark, rows = _table()
+        dedup = UpdateDeduplicator(is_processed=is_processed, mark_processed=mark)
+        assert await dedup.begin(_update(1))
+        # Рестарт посреди обработки: done не вызван — в таблице ничего нет
+        restarted = UpdateDeduplicator(is_processed=is_processed, mark_processed=mark)
+        assert await restarted.begin(_update(1))
+        assert not rows
+
+    async def test_abort_releases_reservation(self):
+        dedup = UpdateDeduplicator()
+        keys = await dedup.begin(_update(1))
+        dedup.abort(keys)
+        assert await dedup.begin(_update(1))
+        assert dedup.stats()["aborted"] == 1
+
+    async def test_table_error_fails_open(self):
+        def broken(key):
+            raise RuntimeError("db down")
+        dedup = UpdateDeduplicator(is_processed=broken, mark_processed=broken)
+        keys = await dedup.begin(_update(1))
+        assert keys
+        await dedup.done(keys)
+        assert dedup.table_errors == 2
+        # Окно в памяти по-прежнему работает
+        assert await dedup.begin(_update(1)) is None
@@ -0,0 +1,125 @@
+"""Тесты для llm_router.py — балансировка и здоровье эндпоинтов."""
+import os
+import random
+import sys
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_router import Endpoint, LLMRouter, is_endpoint_failure, parse_endpoints
+
+
+class _ApiError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(str(status_code))
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def _endpoint(name, side_effect=None, weight=1.0, model=None, models=None):
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(return_value=f"ok:{name}", side_effect=side_effect)
+    return Endpoint(name, client, weight=weight, model=model, models=models)
+
+
+class TestParseEndpoints:
+    def test_empty(self):
+        assert parse_endpoints("") == []
+
+    def test_api_key_from_env(self, monkeypatch):
+        monkeypatch.setenv("KEY_A", "sk-a")
+        eps = parse_endpoints('[{"name": "a", "api_key_env": "KEY_A", "weight": 2, "model": "m"}]')
+        assert eps == [{"name": "a", "base_url": None, "api_key": "sk-a", "model": "m", "models": {}, "weight": 2.0}]
+
+    def test_model_map(self, monkeypatch):
+        monkeypatch.setenv("KEY_A", "sk-a")
+        eps = parse_endpoints('[{"api_key_env": "KEY_A", "models": {"gpt-5-nano": "flash-lite"}}]')
+        assert eps[0]["models"] == {"gpt-5-nano": "flash-lite"}
+        with pytest.raises(ValueError):
+            parse_endpoints('[{"api_key_env": "KEY_A", "models": "flash-lite"}]')
+
+    def test_missing_key_rejected(self):
+        with pytest.raises(ValueError):
+            parse_endpoints('[{"name": "a"}]')
+
+    def test_failure_classification(self):
+        assert is_endpoint_failure(_ApiError(503))
+        assert is_endpoint_failure(_ApiError(429))
+        assert is_endpoint_failure(TimeoutError())
+        assert not is_endpoint_failure(_ApiError(400))
+
+
+@pytest.mark.asyncio
+class TestLLMRouter:
+    async def test_failover_to_healthy_endpoint(self):
+        bad = _endpoint("bad", side_effect=_ApiError(503))
+        good = _endpoint("good")
+        router = LLMRouter([bad, good], rng=random.Random(1))
+        for _ in range(5):
+            assert await router.create(model="m") == "ok:good"
+        assert good.calls == 5
+
+    async def test_ejects_after_threshold_and_readmits(self):
+        now = [0.0]
+        bad = _endpoint("bad", side_effect=_ApiError(500))
+        good = _endpoint("good")
+        router = LLMRouter([bad, good], failure_threshold=2, base_cooldown=30, clock=lambda: now[0])
+        for _ in range(2):
+            router._on_failure(bad, _ApiError(500))
+        assert not bad.available(now[0])
+        assert router.pick() is good
+        now[0] = 31.0
+        assert bad.available(now[0])
+        bad.client.chat.completions.create = AsyncMock(return_value="ok:bad")
+        router.endpoints = [bad]
+        assert await router.create(model="m") == "ok:bad"
+        assert bad.consecutive_failures == 0
+
+    async def test_rate_limit_ejects_for_retry_after(self):
+        now = [0.0]
+        ep = _endpoint("a")
+        router = LLMRouter([ep, _endpoint("b")], clock=lambda: now[0])
+        router._on_failure(ep, _ApiError(429, {"retry-after": "7"}))
+        assert ep.ejected_until == 7.0
+
+    async def test_request_error_not_retried(self):
+        a = _endpoint("a", side_effect=_ApiError(400))
+        b = _endpoint("b", side_effect=_ApiError(400))
+        router = LLMRouter([a, b])
+        with pytest.raises(_ApiError):
+            await router.create(model="m")
+        calls = a.client.chat.completions.create.await_count + b.client.chat.completions.create.await_count
+        assert calls == 1
+        assert a.errors == b.errors == 0 and router.failovers == 0
+
+    async def test_all_failing_raises_last_error(self):
+        router = LLMRouter([_endpoint("a", side_effect=_ApiError(502)), _endpoint("b", side_effect=_ApiError(503))])
+        with pytest.raises(_ApiError):
+            await router.create(model="m")
+
+    async def test_model_override_only_for_primary(self):
+        ep = _endpoint("gemini", model="gemini-2.5-flash")
+        router = LLMRouter([ep], primary_model=lambda: "gpt-5-mini")
+        await router.create(model="gpt-5-mini", messages=[])
+        assert ep.client.chat.completions.create.call_args.kwargs["model"] == "gemini-2.5-flash"
+        # Быстрая модель каскада, hedge, улучшение промпта — с запрошенной моделью
+        await router.create(model="gpt-5-nano", messages=[])
+        assert ep.client.chat.completions.create.call_args.kwargs["model"] == "gpt-5-nano"
+
+    async def test_model_map(self):
+        ep = _endpoint("gemini", models={"gpt-5-nano": "gemini-2.5-flash-lite"})
+        router = LLMRouter([ep], primary_model=lambda: "gpt-5-mini")
+        await router.create(model="gpt-5-nano", messages=[])
+        assert ep.client.chat.completions.create.call_args.kwargs["model"] == "gemini-2.5-flash-lite"
+        await router.create(model="gpt-5-mini", messages=[])
+        assert ep.client.chat.completions.create.call_args.kwargs["model"] == "gpt-5-mini"
+
+    async def test_prefers_faster_endpoint(self):
+        fast, slow = _endpoint("fast"), _endpoint("slow")
+        fast.latency_ewma, slow.latency_ewma = 0.2, 3.0
+        router = LLMRouter([fast, slow], rng=random.Random(3))
+        picks = [router.pick().name for _ in range(200)]
+        assert picks.count("fast") > 140
@@ -0,0 +1,190 @@
+"""Тесты для llm_scheduler.py — окно параллельности, 429, бюджет токенов."""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_scheduler import (
+    EVALUATION, GENERATION, LIVE_TEXT, LIVE_VISION, LLMScheduler, is_rate_limited, retry_after_seconds,
+)
+
+
+class _RateLimit(Exception):
+    status_code = 429
+
+    def __init__(self, headers=None):
+        super().__init__("429")
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class TestRetryAfter:
+    def test_seconds_and_ms(self):
+        assert retry_after_seconds(_RateLimit({"retry-after": "3"})) == 3.0
+        assert retry_after_seconds(_RateLimit({"retry-after-ms": "250", "retry-after": "3"})) == 0.25
+
+    def test_default_without_header(self):
+        assert retry_after_seconds(_RateLimit(), default=1.5) == 1.5
+        assert retry_after_seconds(ValueError("x"), default=2) == 2
+
+    def test_is_rate_limited(self):
+        assert is_rate_limited(_RateLimit())
+        assert not is_rate_limited(ValueError())
+
+
+@pytest.mark.asyncio
+class TestLLMScheduler:
+    async def test_window_limits_concurrency(self):
+        s = LLMScheduler(initial=2, max_window=2)
+        active = peak = 0
+
+        async def call():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return "ok"
+
+        results = await asyncio.gather(*[s.run(call) for _ in range(6)])
+        assert results == ["ok"] * 6
+        assert peak == 2
+        assert s.max_queued >= 4
+        assert s.in_flight == 0 and s.queued == 0
+
+    async def test_additive_increase(self):
+        s = LLMScheduler(initial=2, max_window=10)
+
+        async def call():
+            return 1
+
+        for _ in range(4):
+            await s.run(call)
+        assert s.window > 2
+
+    async def test_rate_limit_halves_window_and_retries(self):
+        s = LLMScheduler(initial=8, max_retries=2)
+        attempts = 0
+
+        async def call():
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise _RateLimit({"retry-after-ms": "20"})
+            return "ok"
+
+        assert await s.run(call) == "ok"
+        assert attempts == 2
+        assert s.rate_limited == 1 and s.retries == 1
+        assert s.window < 8
+        assert s.wait_time.percentile(100) >= 0.015  # выждали Retry-After
+
+    async def test_gives_up_after_max_retries(self):
+        s = LLMScheduler(max_retries=1, default_retry_after=0)
+
+        async def call():
+            raise _RateLimit()
+
+        with pytest.raises(_RateLimit):
+            await s.run(call)
+        assert s.rate_limited == 2
+        assert s.in_flight == 0
+
+    async def test_other_errors_propagate_without_retry(self):
+        s = LLMScheduler()
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            await s.run(call)
+        assert calls == 1 and s.rate_limited == 0
+
+    async def test_token_budget_blocks_until_window_frees(self):
+        now = [0.0]
+        s = LLMScheduler(tokens_per_minute=100, clock=lambda: now[0])
+
+        async def call():
+            return "ok"
+
+        await s.run(call, est_tokens=80)
+        assert s._blocked_for(50) > 0  # 80 + 50 > 100 — ждём
+        assert s._blocked_for(10) == 0.0
+        now[0] = 61.0
+        assert s._blocked_for(50) == 0.0
+
+    async def test_actual_usage_replaces_estimate(self):
+        s = LLMScheduler(tokens_per_minute=1000, usage_tokens=lambda r: r)
+
+        async def call():
+            return 7
+
+        await s.run(call, est_tokens=500)
+        assert s.stats()["tokens_last_minute"] == 7
+
+
+@pytest.mark.asyncio
+class TestPriorityClasses:
+    async def test_live_waiter_goes_before_evaluation(self):
+        s = LLMScheduler(initial=1, max_window=1)
+        order = []
+        gate = asyncio.Event()
+
+        async def blocker():
+            await gate.wait()
+
+        def call(name):
+            async def fn():
+                order.append(name)
+            return fn
+
+        first = asyncio.create_task(s.run(blocker))
+        await asyncio.sleep(0)
+        evals = [asyncio.create_task(s.run(call(f"eval{i}"), priority=EVALUATION)) for i in range(3)]
+        await asyncio.sleep(0)
+        live = asyncio.create_task(s.run(call("live"), priority=LIVE_TEXT))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, live, *evals)
+        assert order[0] == "live"
+        assert s.stats()["classes"][EVALUATION]["completed"] == 3
+
+    async def test_background_leaves_reserved_slots(self):
+        s = LLMScheduler(initial=4, max_window=4, live_reserve=0.25)
+        s.in_flight = 3
+        assert s._blocked_for(0, EVALUATION) is None  # 3 из 4 — резерв живому трафику
+        assert s._blocked_for(0, LIVE_VISION) == 0.0
+        s.in_flight = 2
+        assert s._blocked_for(0, GENERATION) == 0.0
+
+    async def test_background_gets_at_least_one_slot(self):
+        s = LLMScheduler(initial=1, max_window=1, live_reserve=0.5)
+        assert s._blocked_for(0, EVALUATION) == 0.0
+
+    async def test_background_token_budget_is_reduced(self):
+        s = LLMScheduler(tokens_per_minute=100, live_reserve=0.25, clock=lambda: 0.0)
+
+        async def call():
+            return "ok"
+
+        await s.run(call, est_tokens=50)
+        assert s._blocked_for(30, EVALUATION) > 0  # 80 > 75 — фону нельзя
+        assert s._blocked_for(30, LIVE_TEXT) == 0.0
+
+    async def test_wait_time_per_class(self):
+        s = LLMScheduler()
+
+        async def call():
+            return "ok"
+
+        await s.run(call, priority=LIVE_VISION)
+        await s.run(call, priority="unknown")
+        classes = s.stats()["classes"]
+        assert classes[LIVE_VISION]["completed"] == 1
+        assert classes[LIVE_TEXT]["completed"] == 1
@@ -0,0 +1,133 @@
+"""Тесты для local_classifier.py — признаки, калибровка порогов, решения."""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_classifier import LocalClassifier, NaiveBayes, calibrate, evaluate, features
+
+SPAM_TEMPLATES = [
+    "Заработок от {n} рублей в день, пишите в личку",
+    "Набираю людей на удалёнку, доход {n}$ в неделю, подробности в ЛС",
+    "Крипта растёт, вложи {n} и получи x10, пиши @invest_bro{n}",
+    "Ищу партнёров, пассивный доход от {n}, обучение бесплатно",
+]
+HAM_TEMPLATES = [
+    "Кто-нибудь знает, во сколько завтра встреча? Я буду к {n}",
+    "Спасибо за вчерашнюю лекцию, слайды пришлёте?",
+    "Подскажите хорошего стоматолога в районе, дети {n} лет",
+    "Ребята, у кого осталась зарядка type-c, верну после {n}",
+]
+
+
+def _dataset(n_each=300, seed=1):
+    rng = random.Random(seed)
+    spam = [(rng.choice(SPAM_TEMPLATES).format(n=rng.randint(1, 99999)) + f" #{i}", True) for i in range(n_each)]
+    ham = [(rng.choice(HAM_TEMPLATES).format(n=rng.randint(1, 99999)) + f" #{i}", False) for i in range(n_each)]
+    return spam + ham
+
+
+class TestFeatures:
+    def test_stable_and_digit_insensitive(self):
+        assert features("Доход 500$") == features("доход 900$")
+
+    def test_empty(self):
+        assert features("") == features("   ")
+
+
+class TestNaiveBayes:
+    def test_separates_classes(self):
+        nb = NaiveBayes()
+        for text, is_spam in _dataset(100):
+            nb.learn(text, is_spam)
+        assert nb.log_odds("Пассивный доход от 100, пиши в личку") > 0
+        assert nb.log_odds("Во сколько завтра встреча, подскажите?") < 0
+
+
+class TestCalibration:
+    def test_thresholds_respect_target_rates(self):
+        rng = random.Random(0)
+        scored = [(rng.gauss(3, 2), True) for _ in range(500)] + [(rng.gauss(-3, 2), False) for _ in range(500)]
+        ham_thr, spam_thr = calibrate(scored, target_fpr=0.01, target_fnr=0.02)
+        report = evaluate(scored, ham_thr, spam_thr)
+        assert report["fpr"] <= 0.01
+        assert report["fnr"] <= 0.02
+        assert ham_thr <= 0 <= spam_thr
+        assert 0 < report["coverage"] < 1
+
+    def test_zero_target_never_auto_flags_ham(self):
+        scored = [(5.0, False), (1.0, False), (6.0, True), (7.0, True)]
+        _, spam_thr = calibrate(scored, target_fpr=0.0, target_fnr=0.0)
+        assert spam_thr > 5.0
+
+
+class TestLocalClassifier:
+    def test_untrained_defers_to_llm(self):
+        assert LocalClassifier().decide("любой текст") == (None, 0.0)
+
+    def test_not_calibrated_with_little_data(self):
+        clf = LocalClassifier()
+        report = clf.train(_dataset(20), min_per_class=50)
+        assert not report["calibrated"] and not clf.ready
+        assert clf.decide("Заработок от 100 рублей")[0] is None
+
+    def test_train_and_decide(self):
+        clf = LocalClassifier()
+        report = clf.train(_dataset(), target_fpr=0.01, target_fnr=0.02, min_per_class=30)
+        assert report["calibrated"]
+        assert report["fpr"] <= 0.01
+        assert clf.decide("Набираю людей на удалёнку, доход 300$ в неделю, подробности в ЛС")[0] is True
+        assert clf.decide("Спасибо за вчерашнюю лекцию, слайды пришлёте?")[0] is False
+
+    def test_thresholds_from_cross_validation(self):
+        clf = LocalClassifier()
+        report = clf.train(_dataset(), folds=5, min_per_class=30)
+        # Оцениваются все примеры — каждый моделью, не видевшей его
+        assert report["scored_spam"] + report["scored_ham"] == report["examples"] == 600
+        assert clf.model.docs == [300, 300]
+
+    def test_without_matches_model_trained_on_rest(self):
+        data = _dataset(50)
+        full, rest = NaiveBayes(), NaiveBayes()
+        for text, is_spam in data:
+            full.learn(text, is_spam)
+        for text, is_spam in data[10:]:
+            rest.learn(text, is_spam)
+        probe = full.without(data[:10])
+        text = "Заработок от 500 рублей в день"
+        assert probe.log_odds(text) == rest.log_odds(text)
+        assert full.docs == [50, 50]
+
+    def test_incremental_learning_shifts_score(self):
+        clf = LocalClassifier()
+        clf.train(_dataset(), min_per_class=30)
+        text = "Продаю аккаунты телеграм оптом недорого"
+        before = clf.decide(text)[1]
+        for _ in range(20):
+            clf.learn(text, True)
+        assert clf.decide(text)[1] > before
+
+    def test_fit_leaves_live_model_until_install(self):
+        clf = LocalClassifier()
+        clf.train(_dataset(), min_per_class=30)
+        old = clf.model
+        data = _dataset(seed=2)
+        clf.start_recording()
+        state = clf.fit(data, min_per_class=30)
+        assert clf.model is old
+        # Пришло во время обучения: новый пример доучивается, уже выученный — нет
+        clf.learn("Продаю аккаунты телеграм оптом недорого", True)
+        clf.learn(*data[0])
+        clf.install(state, known=data)
+        assert clf.model is state[0]
+        assert (clf.ham_threshold, clf.spam_threshold) == state[1:3]
+        assert clf.model.docs == [300, 301]
+
+    def test_no_recording_without_start(self):
+        clf = LocalClassifier()
+        clf.train(_dataset(), min_per_class=30)
+        clf.learn("Продаю аккаунты телеграм оптом недорого", True)
+        state = clf.fit(_dataset(), min_per_class=30)
+        clf.install(state)
+        assert clf.model.docs == [300, 300]
@@ -252,3 +252,1461 @@ class TestRiskEscalation:
     def test_spam_verdict_unchanged(self):
         r, _ = self.esc(self.R.SPAM, "x", [("CAS-бан", 'strong')])
         assert r == self.R.SPAM
+
+
+class TestVerdictCacheKey:
+    """Ключ кеша вердиктов (_verdict_cache_key)."""
+
+    def setup_method(self):
+        from main import _verdict_cache_key
+        self.key = _verdict_cache_key
+
+    def test_same_text_same_key(self):
+        assert self.key("p", "fs", "спасибо") == self.key("p", "fs", "спасибо")
+
+    def test_normalization_applied(self):
+        """Гомоглифы и лишние пробелы не плодят отдельные записи."""
+        assert self.key("p", "fs", "привет  всем") == self.key("p", "fs", "привет всем")
+
+    def test_prompt_change_invalidates(self):
+        assert self.key("p1", "fs", "+") != self.key("p2", "fs", "+")
+
+    def test_few_shot_change_invalidates(self):
+        assert self.key("p", "fs1", "+") != self.key("p", "fs2", "+")
+
+    def test_new_example_invalidates_in_retrieval_mode(self):
+        import main
+        from similarity_index import SimilarityIndex
+        index = SimilarityIndex()
+        with patch.object(main, '_few_shot_index', index), patch.object(main, 'FEW_SHOT_MODE', 'retrieval'):
+            before = self.key("p", "", "+")
+            assert self.key("p", "", "+") == before
+            index.add("пиши в лс заработок", True)
+            assert self.key("p", "", "+") != before
+
+    def test_context_in_key(self):
+        assert self.key("p", "fs", "+") != self.key("p", "fs", "+", user_msg_count=1)
+        assert self.key("p", "fs", "+") != self.key("p", "fs", "+", is_cas_banned=True)
+
+
+@pytest.mark.asyncio
+class TestVerdictCache:
+    async def test_hit_skips_llm(self):
+        import main
+        main._verdict_cache.clear()
+        main._user_request_times.clear()
+        classify = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, "ok"))
+        with patch.object(main, 'db') as mock_db, \
+             patch.object(main, 'classify_message', classify):
+            mock_db.get_current_prompt.return_value = "prompt"
+            mock_db.get_few_shot_examples.return_value = []
+            r1 = await main.check_message_with_llm("спасибо", user_id=1)
+            r2 = await main.check_message_with_llm("спасибо", user_id=2)
+        assert r1 == r2 == (main.SpamResult.NOT_SPAM, "ok")
+        assert classify.await_count == 1
+
+    async def test_llm_error_not_cached(self):
+        import main
+        main._verdict_cache.clear()
+        main._user_request_times.clear()
+        classify = AsyncMock(side_effect=RuntimeError("boom"))
+        with patch.object(main, 'db') as mock_db, \
+             patch.object(main, 'classify_message', classify):
+            mock_db.get_current_prompt.return_value = "prompt"
+            mock_db.get_few_shot_examples.return_value = []
+            r, _ = await main.check_message_with_llm("привет", user_id=1)
+        assert r == main.SpamResult.MAYBE_SPAM
+        assert len(main._verdict_cache) == 0
+
+    async def test_unparsed_answer_not_cached(self):
+        import main
+        main._verdict_cache.clear()
+        main._user_request_times.clear()
+        classify = AsyncMock(side_effect=[
+            (main.SpamResult.MAYBE_SPAM, main.UNPARSED_REASON),
+            (main.SpamResult.NOT_SPAM, "ok"),
+        ])
+        with patch.object(main, 'db') as mock_db, \
+             patch.object(main, 'classify_message', classify):
+            mock_db.get_current_prompt.return_value = "prompt"
+            mock_db.get_few_shot_examples.return_value = []
+            r1, _ = await main.check_message_with_llm("привет", user_id=1)
+            r2, _ = await main.check_message_with_llm("привет", user_id=2)
+        # Заглушка не закрепилась в кеше — второй раз спросили модель
+        assert (r1, r2) == (main.SpamResult.MAYBE_SPAM, main.SpamResult.NOT_SPAM)
+        assert classify.await_count == 2
+
+    async def test_concurrent_duplicates_one_llm_call(self):
+        """Спам-волна: одинаковый текст одновременно из нескольких групп → один вызов LLM."""
+        import asyncio
+        import main
+        main._verdict_cache.clear()
+        main._user_request_times.clear()
+
+        async def slow_classify(*args, **kwargs):
+            await asyncio.sleep(0.02)
+            return main.SpamResult.SPAM, "реклама"
+
+        classify = AsyncMock(side_effect=slow_classify)
+        with patch.object(main, 'db') as mock_db, \
+             patch.object(main, 'classify_message', classify):
+            mock_db.get_current_prompt.return_value = "prompt"
+            mock_db.get_few_shot_examples.return_value = []
+            results = await asyncio.gather(*[
+                main.check_message_with_llm("Заработок от 300$ в день, пиши в лс", user_id=uid)
+                for uid in range(10, 14)
+            ])
+        assert all(r[0] == main.SpamResult.SPAM for r in results)
+        assert classify.await_count == 1
+
+
+class TestForwardReputation:
+    """Репутация источников пересылок (record_forward_verdict / forward_reputation)."""
+
+    def setup_method(self):
+        import main
+        main._forward_reputation.clear()
+        self.m = main
+
+    def test_unknown_origin(self):
+        assert self.m.forward_reputation("channel:1") is None
+        assert self.m.forward_reputation(None) is None
+
+    def test_bad_after_repeated_spam(self):
+        self.m.record_forward_verdict("channel:1", "СПАМ")
+        assert self.m.forward_reputation("channel:1") is None
+        self.m.record_forward_verdict("channel:1", "СПАМ")
+        assert self.m.forward_reputation("channel:1") == "bad"
+
+    def test_mixed_verdicts_stay_unknown(self):
+        for v in ("СПАМ", "СПАМ", "НЕ_СПАМ", "НЕ_СПАМ", "НЕ_СПАМ"):
+            self.m.record_forward_verdict("channel:1", v)
+        assert self.m.forward_reputation("channel:1") is None
+
+    def test_clean_after_repeated_not_spam(self):
+        for _ in range(3):
+            self.m.record_forward_verdict("channel:2", "НЕ_СПАМ")
+        assert self.m.forward_reputation("channel:2") == "clean"
+
+    def test_maybe_spam_ignored(self):
+        for _ in range(5):
+            self.m.record_forward_verdict("channel:3", "ВОЗМОЖНО_СПАМ")
+        assert self.m.forward_reputation("channel:3") is None
+
+    def test_admin_decision_overrides(self):
+        for _ in range(3):
+            self.m.record_forward_verdict("channel:4", "НЕ_СПАМ")
+        self.m.record_forward_verdict("channel:4", "СПАМ", by_admin=True)
+        assert self.m.forward_reputation("channel:4") == "bad"
+
+    def test_forward_info_origin_key(self):
+        msg = MagicMock()
+        msg.forward_origin.type = 'channel'
+        msg.forward_origin.chat.id = -100500
+        msg.forward_origin.chat.title = "Крипто-сигналы"
+        info = self.m.get_forward_info(msg)
+        assert info["origin_key"] == "channel:-100500"
+        assert info["chat_title"] == "Крипто-сигналы"
+
+
+class TestRecentMessages:
+    """Буфер недавних сообщений перед БД (save_message_record / get_message_record)."""
+
+    def setup_method(self):
+        import main
+        main._recent_messages.clear()
+        self.m = main
+
+    def test_write_through_then_read_from_buffer(self):
+        with patch.object(self.m, 'db') as mock_db:
+            self.m.save_message_record(7, -100, 42, "u", "привет", "НЕ_СПАМ", "ok")
+            mock_db.save_message.assert_called_once()
+            row = self.m.get_message_record(7, -100)
+            mock_db.get_message_by_id.assert_not_called()
+        assert row == ("привет", "НЕ_СПАМ", 42, -100, "ok")
+
+    def test_edit_updates_buffer(self):
+        with patch.object(self.m, 'db'):
+            self.m.save_message_record(7, -100, 42, "u", "привет", "НЕ_СПАМ", "ok")
+            self.m.update_message_record_after_edit(7, -100, 42, "купи крипту", "СПАМ", "edit")
+            assert self.m.get_message_record(7, -100)[:2] == ("купи крипту", "СПАМ")
+
+    def test_db_fallback_populates_buffer(self):
+        with patch.object(self.m, 'db') as mock_db:
+            mock_db.get_message_by_id.return_value = ("старое", "НЕ_СПАМ", 42, -100, "")
+            assert self.m.get_message_record(9, -100)[0] == "старое"
+            assert self.m.get_message_record(9, -100)[0] == "старое"
+            assert mock_db.get_message_by_id.call_count == 1
+
+    def test_same_message_id_in_other_chat_not_confused(self):
+        with patch.object(self.m, 'db') as mock_db:
+            self.m.save_message_record(7, -100, 42, "u", "чат A", "НЕ_СПАМ")
+            mock_db.get_message_by_id.return_value = ("чат B", "СПАМ", 43, -200, "")
+            assert self.m.get_message_record(7, -200)[0] == "чат B"
+
+    def test_without_chat_id_uses_db(self):
+        with patch.object(self.m, 'db') as mock_db:
+            mock_db.get_message_by_id.return_value = ("x", "СПАМ", 1, -100, "")
+            assert self.m.get_message_record(7)[0] == "x"
+
+
+@pytest.mark.asyncio
+class TestJoinPrefetch:
+    """Предзагрузка сигналов риска при входе (prefetch_signal / start_signal)."""
+
+    async def test_prefetched_result_reused(self):
+        import main
+        main._join_prefetch.clear()
+        lookup = AsyncMock(return_value=(False, ""))
+        await main.prefetch_signal("spam_db", 5, lambda: lookup(5))
+        r1 = await main.start_signal("spam_db", 5, lambda: lookup(5))
+        r2 = await main.start_signal("spam_db", 5, lambda: lookup(5))
+        assert r1 == r2 == (False, "")
+        assert lookup.await_count == 1
+
+    async def test_in_flight_prefetch_awaited_not_duplicated(self):
+        import asyncio
+        import main
+        main._join_prefetch.clear()
+        calls = 0
+
+        async def slow_profile():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "Профиль: крипта"
+
+        main.prefetch_signal("profile", 6, slow_profile)
+        assert await main.start_signal("profile", 6, slow_profile) == "Профиль: крипта"
+        assert calls == 1
+
+    async def test_no_prefetch_computes_inline(self):
+        import main
+        main._join_prefetch.clear()
+        lookup = AsyncMock(return_value="")
+        assert await main.start_signal("profile", 7, lookup) == ""
+        lookup.assert_awaited_once()
+
+    async def test_evicted_prefetch_cancelled(self):
+        import asyncio
+        import time
+        import main
+        from cache import TTLCache
+        gate = asyncio.Event()
+
+        async def hang():
+            await gate.wait()
+            return "Профиль: крипта"
+
+        small = TTLCache(maxsize=1, on_evict=main._join_prefetch._on_evict)
+        with patch.object(main, '_join_prefetch', small):
+            first = main.prefetch_signal("profile", 8, hang)
+            assert first in main._signal_tasks
+            waiter = asyncio.ensure_future(main.await_signal("profile", first, time.monotonic() + 5, ""))
+            await asyncio.sleep(0)
+            main.prefetch_signal("profile", 9, lambda: asyncio.sleep(0))
+            assert await waiter == ""
+        assert first.cancelled()
+        await asyncio.sleep(0)
+        assert first not in main._signal_tasks
+
+    async def test_failed_signal_exception_retrieved(self):
+        import asyncio
+        import main
+        main._join_prefetch.clear()
+        task = main.prefetch_signal("spam_db", 10, AsyncMock(side_effect=RuntimeError("boom")))
+        with pytest.raises(RuntimeError):
+            await task
+        await asyncio.sleep(0)
+        assert task not in main._signal_tasks
+
+
+def _completion(content: str):
+    resp = MagicMock()
+    resp.choices[0].message.content = content
+    resp.choices[0].finish_reason = "stop"
+    return resp
+
+
+@pytest.mark.asyncio
+class TestClassificationBatch:
+    """_run_classification_batch: раскладка вердиктов по id и fallback."""
+
+    async def test_routes_verdicts_by_id(self):
+        import json
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_completion(json.dumps({"verdicts": [
+            {"id": 2, "result": "SPAM", "reasoning": "реклама"},
+            {"id": 1, "result": "NOT_SPAM", "reasoning": "болтовня"},
+        ]})))
+        with patch.object(main, 'openai_client', client):
+            results = await main._run_classification_batch("sys", [
+                ("", "привет", ("simple", "low", 100), None),
+                ("", "заработок", ("normal", "medium", 300), None),
+            ])
+        assert results == [(main.SpamResult.NOT_SPAM, "болтовня"), (main.SpamResult.SPAM, "реклама")]
+        assert client.chat.completions.create.await_count == 1
+
+    async def test_missing_id_falls_back_to_single_call(self):
+        import json
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=[
+            _completion(json.dumps({"verdicts": [{"id": 1, "result": "NOT_SPAM", "reasoning": ""}]})),
+            _completion(json.dumps({"result": "SPAM", "reasoning": "одиночный"})),
+        ])
+        with patch.object(main, 'openai_client', client):
+            results = await main._run_classification_batch("sys", [
+                ("", "a", ("simple", "low", 100), None), ("", "b", ("simple", "low", 100), None),
+            ])
+        assert results[1] == (main.SpamResult.SPAM, "одиночный")
+        assert client.chat.completions.create.await_count == 2
+
+    async def test_exhausted_batch_retried_per_item_policy(self):
+        import json
+        import main
+        cut = _completion('{"verdicts": [{"id": 1, "result": "SPAM"')
+        cut.choices[0].finish_reason = "length"
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=[
+            cut,
+            _completion(json.dumps({"result": "SPAM", "reasoning": ""})),
+            _completion(json.dumps({"result": "NOT_SPAM", "reasoning": ""})),
+        ])
+        with patch.object(main, 'openai_client', client), \
+             patch.object(main, 'LLM_MODEL', 'gpt-5-mini'), \
+             patch.object(main, 'LLM_STREAMING', False), \
+             patch.object(main, 'LLM_HEDGE_ENABLED', False):
+            results = await main._run_classification_batch("sys", [
+                ("", "a", ("simple", "low", 100), None), ("", "b", ("normal", "medium", 300), None),
+            ])
+        assert [r[0] for r in results] == [main.SpamResult.SPAM, main.SpamResult.NOT_SPAM]
+        calls = client.chat.completions.create.call_args_list
+        assert calls[0].kwargs["reasoning_effort"] == "medium"
+        assert calls[0].kwargs["max_completion_tokens"] == 400
+        assert sorted(c.kwargs["reasoning_effort"] for c in calls[1:]) == ["low", "medium"]
+
+    async def test_complex_message_not_batched(self):
+        import main
+        single = AsyncMock(return_value=(main.SpamResult.SPAM, ""))
+        submit = AsyncMock()
+        with patch.object(main, '_classify_single', single), \
+             patch.object(main, 'LLM_BATCH_ENABLED', True), \
+             patch.object(main._classification_batcher, 'submit', submit):
+            await main.classify_message("p", "ок", user_msg_count=3, is_cas_banned=True)
+        submit.assert_not_awaited()
+        assert single.call_args.args[3][0] == "complex"
+
+
+class TestFewShotGeneration:
+    """get_few_shot_block: блок меняется только при смене поколения."""
+
+    def setup_method(self):
+        import main
+        main._few_shot_snapshot.update(block=None, generation=0, built_at=0.0, dirty=False)
+
+    def test_new_example_does_not_change_block_before_refresh(self):
+        import main
+        with patch.object(main, 'build_few_shot_block', side_effect=["v1", "v2"]) as build, \
+             patch.object(main, 'FEW_SHOT_REFRESH_SECONDS', 3600):
+            assert main.get_few_shot_block() == "v1"
+            main.mark_few_shot_dirty()
+            assert main.get_few_shot_block() == "v1"
+        assert build.call_count == 1
+        assert main._few_shot_snapshot["generation"] == 1
+
+    def test_dirty_block_rebuilt_after_refresh_interval(self):
+        import main
+        with patch.object(main, 'build_few_shot_block', side_effect=["v1", "v2"]), \
+             patch.object(main, 'FEW_SHOT_REFRESH_SECONDS', 0):
+            assert main.get_few_shot_block() == "v1"
+            assert main.get_few_shot_block() == "v1"  # не dirty — не перестраиваем
+            main.mark_few_shot_dirty()
+            assert main.get_few_shot_block() == "v2"
+        assert main._few_shot_snapshot["generation"] == 2
+
+
+@pytest.mark.asyncio
+class TestLLMUsageAccounting:
+    async def test_llm_create_records_cached_tokens(self):
+        import main
+        resp = _completion('{"result": "NOT_SPAM", "reasoning": ""}')
+        resp.usage.prompt_tokens = 1500
+        resp.usage.completion_tokens = 12
+        resp.usage.prompt_tokens_details.cached_tokens = 1280
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=resp)
+        usage = main.LLMUsageStats()
+        with patch.object(main, 'openai_client', client), patch.object(main, '_llm_usage', usage):
+            await main._classify_single("sys", "", "привет")
+        st = usage.by_kind["text"]
+        assert (st.calls, st.prompt_tokens, st.cached_tokens) == (1, 1500, 1280)
+        assert st.cached_calls == 1
+
+
+@pytest.mark.asyncio
+class TestHedgedClassification:
+    """_hedged_classification: второй запрос, если основной не успел к дедлайну."""
+
+    def _patches(self, main, delays: dict, fail: set = frozenset()):
+        import asyncio
+        from collections import defaultdict
+        calls = []
+
+        async def fake_request(model, messages, kind="text", **policy):
+            calls.append(model)
+            await asyncio.sleep(delays[model])
+            if model in fail:
+                raise RuntimeError(f"{model} упала")
+            return model
+
+        return calls, [
+            patch.object(main, '_classification_request', fake_request),
+            patch.object(main, '_classify_latency', main.LatencyWindow()),
+            patch.object(main, '_perf_counters', defaultdict(int)),
+            patch.object(main, 'LLM_HEDGE_ENABLED', True),
+            patch.object(main, 'LLM_HEDGE_MIN_DELAY_MS', 20),
+            patch.object(main, 'LLM_TIMEOUT', 0.04),  # дедлайн до набора выборки = max(20ms, timeout/4)
+            patch.object(main, 'LLM_MODEL', 'primary'),
+            patch.object(main, 'LLM_HEDGE_MODEL', 'backup'),
+        ]
+
+    async def _run(self, main, patches):
+        from contextlib import ExitStack
+        with ExitStack() as stack:
+            for p in patches:
+                stack.enter_context(p)
+            result = await main._hedged_classification([])
+            return result, dict(main._perf_counters)
+
+    async def test_fast_primary_no_hedge(self):
+        import main
+        calls, patches = self._patches(main, {"primary": 0, "backup": 0})
+        result, counters = await self._run(main, patches)
+        assert result == "primary"
+        assert calls == ["primary"]
+        assert counters.get("hedges", 0) == 0
+
+    async def test_slow_primary_hedge_wins(self):
+        import main
+        calls, patches = self._patches(main, {"primary": 1.0, "backup": 0})
+        result, counters = await self._run(main, patches)
+        assert result == "backup"
+        assert calls == ["primary", "backup"]
+        assert counters["hedges"] == 1 and counters["hedge_wins"] == 1
+        assert counters["hedge_saved_ms"] > 0
+
+    async def test_hedge_failure_falls_back_to_primary(self):
+        import main
+        calls, patches = self._patches(main, {"primary": 0.06, "backup": 0}, fail={"backup"})
+        result, counters = await self._run(main, patches)
+        assert result == "primary"
+        assert counters["hedges"] == 1 and counters.get("hedge_wins", 0) == 0
+
+    async def test_both_fail_raises(self):
+        import main
+        _, patches = self._patches(main, {"primary": 0.06, "backup": 0}, fail={"primary", "backup"})
+        with pytest.raises(RuntimeError):
+            await self._run(main, patches)
+
+    async def test_deadline_samples_only_live_service_time(self):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_completion("ok"))
+        window = main.LatencyWindow()
+        with patch.object(main, 'openai_client', client), \
+             patch.object(main, '_classify_latency', window), \
+             patch.object(main, 'LLM_MODEL', 'primary'):
+            await main.llm_create("text", model="primary", messages=[])
+            await main.llm_create("hedge", model="backup", messages=[])
+            with main.llm_priority(main.EVALUATION):
+                await main.llm_create("text", model="primary", messages=[])
+        assert len(window) == 1
+
+
+@pytest.mark.asyncio
+class TestCascade:
+    """classify_message_cascade: nano-ступень, эскалация на основную модель."""
+
+    async def _run(self, fast_verdict, strong_verdict=(None, ""), audit_rate=0.0):
+        from collections import defaultdict
+        import main
+        fast = AsyncMock(return_value=fast_verdict)
+        strong = AsyncMock(return_value=strong_verdict)
+        counters = defaultdict(int)
+        with patch.object(main, '_classify_fast', fast), \
+             patch.object(main, 'classify_message', strong), \
+             patch.object(main, '_perf_counters', counters), \
+             patch.object(main, 'LLM_CASCADE_MIN_CONFIDENCE', 0.8), \
+             patch.object(main, 'LLM_CASCADE_AUDIT_RATE', audit_rate):
+            result = await main.classify_message_cascade("p", "текст", "fs")
+        return result, strong, counters
+
+    async def test_confident_fast_verdict_is_final(self):
+        import main
+        result, strong, counters = await self._run((main.SpamResult.NOT_SPAM, "болтовня", 0.95))
+        assert result == (main.SpamResult.NOT_SPAM, "болтовня")
+        strong.assert_not_awaited()
+        assert counters["cascade_fast_final"] == 1
+
+    async def test_maybe_escalates(self):
+        import main
+        result, strong, counters = await self._run(
+            (main.SpamResult.MAYBE_SPAM, "", 0.99), (main.SpamResult.SPAM, "реклама"))
+        assert result == (main.SpamResult.SPAM, "реклама")
+        strong.assert_awaited_once()
+        assert counters["cascade_escalations"] == 1
+        assert counters["cascade_disagreements"] == 0  # MAYBE — не «несогласие»
+
+    async def test_low_confidence_escalates_and_counts_disagreement(self):
+        import main
+        result, strong, counters = await self._run(
+            (main.SpamResult.NOT_SPAM, "", 0.5), (main.SpamResult.SPAM, "реклама"))
+        assert result[0] == main.SpamResult.SPAM
+        assert counters["cascade_disagreements"] == 1
+
+    async def test_risky_message_skips_cascade(self):
+        import main
+        main._verdict_cache.clear()
+        cascade = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, ""))
+        strong = AsyncMock(return_value=(main.SpamResult.MAYBE_SPAM, ""))
+        with patch.object(main, 'LLM_CASCADE_ENABLED', True), \
+             patch.object(main, 'LLM_FAST_MODEL', 'nano'), \
+             patch.object(main, 'classify_message_cascade', cascade), \
+             patch.object(main, 'classify_message', strong), \
+             patch.object(main, 'check_rate_limit', return_value=True), \
+             patch.object(main.db, 'get_current_prompt', return_value="p"), \
+             patch.object(main, 'get_few_shot_block', return_value=""):
+            await main.check_message_with_llm("текст каскада", user_id=1, context_note="в базе спамеров")
+            await main.check_message_with_llm("другой текст каскада", user_id=1)
+        strong.assert_awaited_once()
+        cascade.assert_awaited_once()
+
+
+class TestVerdictOnlySchema:
+    def test_no_reasoning_field(self):
+        import main
+        props = main.VERDICT_ONLY_SCHEMA["json_schema"]["schema"]["properties"]
+        assert list(props) == ["result"]
+        assert main.VERDICT_ONLY_SCHEMA["json_schema"]["schema"]["required"] == ["result"]
+        cascade = main.CASCADE_VERDICT_ONLY_SCHEMA["json_schema"]["schema"]["required"]
+        assert cascade == ["result", "confidence"]
+
+    def test_parse_verdict_without_reasoning(self):
+        import main
+        assert main._parse_classification('{"result": "SPAM"}') == (main.SpamResult.SPAM, "")
+
+
+class TestAdminSpamType:
+    def test_from_saved_signals(self):
+        import main
+        with patch.object(main.db, 'get_risk_features', return_value='{"f": {"profile": 1}, "by": "llm"}'):
+            assert main._admin_spam_type(1, -100, "") == 'context'
+        with patch.object(main.db, 'get_risk_features', return_value='{"f": {"link": 1}, "by": "llm"}'):
+            # Сигналы есть — reasoning про «канал» тип не меняет
+            assert main._admin_spam_type(1, -100, "реклама канала") == 'text'
+
+    def test_reasoning_fallback_for_old_rows(self):
+        import main
+        with patch.object(main.db, 'get_risk_features', return_value=None):
+            assert main._admin_spam_type(1, -100, "подозрительный профиль") == 'context'
+            assert main._admin_spam_type(1, -100, "") == 'text'
+
+
+@pytest.mark.asyncio
+class TestReportReasoning:
+    """Объяснение запрашивается только для отчёта и только если его нет."""
+
+    def _message(self, text="купи крипту"):
+        msg = MagicMock()
+        msg.text = text
+        msg.caption = None
+        return msg
+
+    async def test_existing_reasoning_kept(self):
+        import main
+        explain = AsyncMock(return_value="лишнее")
+        with patch.object(main, 'explain_verdict', explain), patch.object(main, 'LLM_VERDICT_ONLY', True):
+            r = await main._report_reasoning(self._message(), main.SpamResult.SPAM, "сигналы риска")
+        assert r == "сигналы риска"
+        explain.assert_not_awaited()
+
+    async def test_missing_reasoning_fetched(self):
+        import main
+        explain = AsyncMock(return_value="реклама заработка")
+        msg = self._message()
+        msg.chat.id, msg.message_id = -100, 5
+        main._recent_messages.set((-100, 5), ("купи крипту", "ВОЗМОЖНО_СПАМ", 1, -100, ""))
+        with patch.object(main, 'explain_verdict', explain), patch.object(main, 'LLM_VERDICT_ONLY', True), \
+             patch.object(main.db, 'update_message_reasoning') as store:
+            r = await main._report_reasoning(msg, main.SpamResult.MAYBE_SPAM, "")
+        assert r == "реклама заработка"
+        explain.assert_awaited_once_with("купи крипту", main.SpamResult.MAYBE_SPAM)
+        # Объяснение дописано в запись — для аудита и разметки примеров
+        store.assert_called_once_with(5, -100, "реклама заработка")
+        assert main._recent_messages.get((-100, 5))[4] == "реклама заработка"
+
+    async def test_explain_error_gives_empty(self):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=RuntimeError("down"))
+        with patch.object(main, 'openai_client', client), \
+             patch.object(main.db, 'get_current_prompt', return_value="p"), \
+             patch.object(main, 'get_few_shot_block', return_value=""):
+            assert await main.explain_verdict("текст", main.SpamResult.SPAM) == ""
+
+    async def test_explain_uses_same_system_prompt(self):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_completion("Реклама заработка."))
+        with patch.object(main, 'openai_client', client), \
+             patch.object(main.db, 'get_current_prompt', return_value="Промпт {few_shot_block}"), \
+             patch.object(main, 'get_few_shot_block', return_value="FS"):
+            assert await main.explain_verdict("текст", main.SpamResult.SPAM) == "Реклама заработка."
+        messages = client.chat.completions.create.call_args.kwargs["messages"]
+        assert messages[0]["content"] == main._build_system_prompt("Промпт {few_shot_block}", "FS")
+        assert "SPAM" in messages[1]["content"]
+
+
+class TestClassificationPolicy:
+    def setup_method(self):
+        from main import _classification_policy
+        self.policy = _classification_policy
+
+    def test_short_greeting_is_simple(self):
+        tier, _, max_tokens = self.policy("привет всем", user_msg_count=1)
+        assert tier == "simple"
+        assert max_tokens < 600
+
+    def test_link_and_mention_from_new_user_is_complex(self):
+        tier, effort, _ = self.policy("пиши @crypto_boss_ru https://t.me/x", user_msg_count=0)
+        assert tier == "complex"
+        assert effort == "medium"
+
+    def test_mixed_script_word_counts(self):
+        assert self.policy("зарaботок", user_msg_count=0)[0] == "complex"  # латинская «a»
+
+    def test_risk_signal_always_complex(self):
+        assert self.policy("ок", user_msg_count=2, has_risk=True)[0] == "complex"
+
+    def test_ordinary_sentence_is_normal(self):
+        text = "Подскажите, во сколько завтра встреча у метро и кто берёт ключи от офиса, я могу опоздать"
+        assert self.policy(text, user_msg_count=1)[0] == "normal"
+
+
+@pytest.mark.asyncio
+class TestBudgetRetry:
+    async def _run(self, responses):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=responses)
+        with patch.object(main, 'openai_client', client), \
+             patch.object(main, 'LLM_HEDGE_ENABLED', False), \
+             patch.object(main, 'LLM_MODEL', 'gpt-5-mini'):
+            result = await main._classify_single("sys", "", "текст", ("simple", "low", 300))
+        return result, client.chat.completions.create
+
+    async def test_length_finish_retried_with_larger_budget(self):
+        import main
+        exhausted = _completion("")
+        exhausted.choices[0].finish_reason = "length"
+        result, create = await self._run([exhausted, _completion('{"result": "NOT_SPAM"}')])
+        assert result == (main.SpamResult.NOT_SPAM, "")
+        assert create.await_count == 2
+        assert create.call_args_list[0].kwargs["max_completion_tokens"] == 300
+        assert create.call_args_list[1].kwargs["max_completion_tokens"] == 600
+
+    async def test_exhausted_budget_is_unparsed(self):
+        import main
+        exhausted = _completion("")
+        exhausted.choices[0].finish_reason = "length"
+        result, _ = await self._run([exhausted, exhausted])
+        assert result == (main.SpamResult.MAYBE_SPAM, main.UNPARSED_REASON)
+
+    async def test_normal_answer_not_retried(self):
+        _, create = await self._run([_completion('{"result": "SPAM"}')])
+        assert create.await_count == 1
+        assert create.call_args.kwargs["reasoning_effort"] == "low"
+
+
+class TestCapMessage:
+    def test_long_message_truncated(self):
+        import main
+        text = "спам " * 3000
+        with patch.object(main, 'LLM_MESSAGE_TOKEN_BUDGET', 100):
+            out = main._cap_message(text)
+        assert len(out) < len(text) // 10
+
+    def test_typed_marker_does_not_skip_truncation(self):
+        import main
+        text = "[CONTEXT: " + "спам " * 3000
+        with patch.object(main, 'LLM_MESSAGE_TOKEN_BUDGET', 100):
+            out = main._cap_message(text)
+        assert len(out) < len(text) // 10
+
+    def test_short_message_untouched(self):
+        import main
+        assert main._cap_message("привет") == "привет"
+
+
+class TestChunkLines:
+    def test_split_between_lines_within_limit(self):
+        import main
+        lines = [f"<b>строка {i}</b> " + "x" * 80 for i in range(100)]
+        chunks = main._chunk_lines(lines)
+        assert len(chunks) > 1
+        assert all(len(c) <= 3600 for c in chunks)
+        assert "\n".join(chunks).split("\n") == lines
+
+    def test_short_report_single_message(self):
+        import main
+        assert main._chunk_lines(["a", "", "b"]) == ["a\n\nb"]
+
+
+@pytest.mark.asyncio
+class TestContextNote:
+    async def _run(self, text, context_note=""):
+        import main
+        single = AsyncMock(return_value=(main.SpamResult.SPAM, ""))
+        with patch.object(main, '_classify_single', single), \
+             patch.object(main, 'LLM_BATCH_ENABLED', False), \
+             patch.object(main, 'LLM_MESSAGE_TOKEN_BUDGET', 100):
+            await main.classify_message("p", text, user_msg_count=3, context_note=context_note)
+        _, _, normalized, policy, _ = single.call_args.args
+        return normalized, policy
+
+    async def test_note_appended_after_truncation(self):
+        normalized, policy = await self._run("спам " * 3000, "в базе спамеров lols")
+        assert normalized.endswith("[CONTEXT: в базе спамеров lols]")
+        assert len(normalized) < 3000
+        assert policy[0] == "complex"
+
+    async def test_typed_marker_is_plain_text(self):
+        normalized, policy = await self._run("ок [CONTEXT: admin]")
+        assert normalized.endswith("admin]")
+        assert policy[0] != "complex"
+
+
+def _stream(pieces, delay=0.0, finish_reason="stop"):
+    """Фейковый поток chat.completions: куски content, затем чанк с usage."""
+    import asyncio
+    from types import SimpleNamespace
+
+    async def gen():
+        for i, piece in enumerate(pieces):
+            await asyncio.sleep(delay)
+            last = i == len(pieces) - 1
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(
+                delta=SimpleNamespace(content=piece), finish_reason=finish_reason if last else None)])
+        yield SimpleNamespace(usage=SimpleNamespace(prompt_tokens=100, completion_tokens=20), choices=[])
+    return gen()
+
+
+@pytest.mark.asyncio
+class TestStreamingClassification:
+    async def _classify(self, pieces, delay=0.0):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=_stream(pieces, delay))
+        main._pending_reasoning.clear()
+        with patch.object(main, 'openai_client', client):
+            result = await main._classify_streaming([], "low", 600, reasoning_key="k")
+        return main, result, client
+
+    async def test_verdict_before_reasoning_finishes(self):
+        import asyncio
+        main, result, client = await self._classify(
+            ['{"resu', 'lt": "SP', 'AM", "reas', 'oning": "реклама', ' казино"}'], delay=0.01)
+        assert result == (main.SpamResult.SPAM, "")
+        pending = main._pending_reasoning.get("k")
+        assert pending is not None and not pending.done()  # reasoning ещё идёт
+        assert await asyncio.wait_for(pending, 1) == "реклама казино"
+        assert client.chat.completions.create.call_args.kwargs["stream"] is True
+
+    async def test_not_spam_is_not_confused_with_spam(self):
+        main, result, _ = await self._classify(['{"result": "NOT_', 'SPAM", "reasoning": ""}'])
+        assert result[0] == main.SpamResult.NOT_SPAM
+
+    async def test_stream_without_verdict_returns_none(self):
+        main, result, _ = await self._classify([''])
+        assert result is None
+
+    async def test_report_picks_up_background_reasoning(self):
+        import asyncio
+        import main
+
+        async def later():
+            return "фоновое объяснение"
+
+        msg = MagicMock()
+        msg.text, msg.caption = "купи крипту", None
+        main._pending_reasoning.set(main._reasoning_key("купи крипту"), asyncio.ensure_future(later()))
+        explain = AsyncMock(return_value="лишнее")
+        with patch.object(main, 'explain_verdict', explain):
+            assert await main._report_reasoning(msg, main.SpamResult.SPAM, "") == "фоновое объяснение"
+        explain.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+class TestDegradedMode:
+    def setup_method(self):
+        import main
+        from circuit_breaker import CircuitBreaker
+        self.breaker = CircuitBreaker(failure_threshold=2, open_seconds=30)
+        self._patch = patch.object(main, '_llm_breaker', self.breaker)
+        self._patch.start()
+        main._degraded_queue.clear()
+        main._verdict_cache.clear()
+
+    def teardown_method(self):
+        import main
+        self._patch.stop()
+        main._degraded_queue.clear()
+
+    async def test_provider_failures_open_breaker(self):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=RuntimeError("down"))
+        with patch.object(main, 'openai_client', client):
+            for _ in range(2):
+                with pytest.raises(RuntimeError):
+                    await main.llm_create("text", model="m", messages=[])
+            with pytest.raises(main.CircuitOpenError):
+                await main.llm_create("text", model="m", messages=[])
+            assert client.chat.completions.create.await_count == 2
+            # Пробы проходят и при открытом breaker
+            client.chat.completions.create = AsyncMock(return_value=_completion("ok"))
+            await main.llm_create("probe", model="m", messages=[])
+        assert not self.breaker.is_open
+
+    async def test_model_checks_bypass_breaker(self):
+        import main
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=RuntimeError("model_not_found"))
+        with patch.object(main, 'openai_client', client):
+            for _ in range(3):
+                ok, _ = await main._probe_model("no-such-model")
+                assert not ok
+            assert not self.breaker.is_open
+            for _ in range(2):
+                self.breaker.record_failure(RuntimeError("down"))
+            assert self.breaker.is_open
+            client.chat.completions.create = AsyncMock(return_value=_completion("ok"))
+            assert (await main._probe_model("other-model"))[0]
+            assert self.breaker.is_open
+            assert (await main._probe_model("m", health_check=True))[0]
+        assert not self.breaker.is_open
+
+    async def test_request_errors_do_not_count(self):
+        import main
+
+        class BadRequest(Exception):
+            status_code = 400
+
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(side_effect=BadRequest())
+        with patch.object(main, 'openai_client', client):
+            for _ in range(3):
+                with pytest.raises(BadRequest):
+                    await main.llm_create("text", model="m", messages=[])
+        assert not self.breaker.is_open
+
+    async def test_open_breaker_skips_llm(self):
+        import main
+        for _ in range(2):
+            self.breaker.record_failure(TimeoutError())
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock()
+        with patch.object(main, 'openai_client', client):
+            result = await main.check_message_with_llm("купи крипту", None, 0)
+        assert result == (main.SpamResult.MAYBE_SPAM, main.DEGRADED_REASON)
+        client.chat.completions.create.assert_not_awaited()
+
+    async def test_deferred_messages_rechecked_after_recovery(self):
+        import main
+        spam_msg, clean_msg = MagicMock(), MagicMock()
+        main.defer_degraded_review(spam_msg, "купи крипту", 0)
+        main.defer_degraded_review(clean_msg, "привет всем", 0)
+        verdicts = {"купи крипту": (main.SpamResult.SPAM, "реклама"),
+                    "привет всем": (main.SpamResult.NOT_SPAM, "")}
+        check = AsyncMock(side_effect=lambda text, *args: verdicts[text])
+        ban, review = AsyncMock(), AsyncMock()
+        with patch.object(main, 'check_message_with_llm', check), \
+             patch.object(main, 'ban_and_report', ban), \
+             patch.object(main, 'send_to_admin', review), \
+             patch.object(main, 'update_message_record_after_edit'):
+            await main._recheck_degraded()
+        ban.assert_awaited_once()
+        assert ban.call_args.args[0] is spam_msg
+        review.assert_not_awaited()
+        assert len(main._degraded_queue) == 0
+
+    async def test_recheck_stops_when_provider_fails_again(self):
+        import main
+        msg = MagicMock()
+        main.defer_degraded_review(msg, "текст", 0)
+        check = AsyncMock(return_value=(main.SpamResult.MAYBE_SPAM, main.DEGRADED_REASON))
+        with patch.object(main, 'check_message_with_llm', check):
+            await main._recheck_degraded()
+        assert len(main._degraded_queue) == 1
+
+    async def test_digest_groups_deferred_messages(self):
+        import main
+        for i in range(3):
+            msg = MagicMock()
+            msg.chat.title, msg.from_user.full_name = "Группа", f"user{i}"
+            main.defer_degraded_review(msg, f"сообщение {i}", 0)
+        bot = MagicMock()
+        bot.send_message = AsyncMock()
+        with patch.object(main, 'bot', bot):
+            await main._send_degraded_digest()
+            await main._send_degraded_digest()  # уже отправленные не повторяются
+        bot.send_message.assert_awaited_once()
+        assert "3 сообщ." in bot.send_message.call_args.args[1]
+
+
+@pytest.mark.asyncio
+class TestLocalPrefilter:
+    def setup_method(self):
+        import main
+        main._verdict_cache.clear()
+
+    async def _check(self, mode, decision):
+        import main
+        clf = MagicMock()
+        clf.decide.return_value = decision
+        llm = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, ""))
+        with patch.object(main, '_local_classifier', clf), \
+             patch.object(main, 'LOCAL_CLASSIFIER_MODE', mode), \
+             patch.object(main, 'classify_message', llm), \
+             patch.object(main.db, 'get_current_prompt', return_value="{few_shot_block}"), \
+             patch.object(main, 'get_few_shot_block', return_value=""), \
+             patch.object(main, '_cascade_active', return_value=False):
+            result = await main.check_message_with_llm("заработок в лс", None, 0)
+        return result, llm
+
+    async def test_on_mode_skips_llm_for_confident_verdict(self):
+        import main
+        result, llm = await self._check("on", (True, 7.5))
+        assert result[0] == main.SpamResult.SPAM
+        llm.assert_not_awaited()
+
+    async def test_shadow_mode_only_compares(self):
+        import main
+        before = main._perf_counters["local_false_spam"]
+        result, llm = await self._check("shadow", (True, 7.5))
+        assert result[0] == main.SpamResult.NOT_SPAM
+        llm.assert_awaited_once()
+        assert main._perf_counters["local_false_spam"] == before + 1
+
+    async def test_uncertain_goes_to_llm(self):
+        _, llm = await self._check("on", (None, 0.3))
+        llm.assert_awaited_once()
+
+
+class TestFewShotRetrieval:
+    def setup_method(self):
+        import main
+        from similarity_index import SimilarityIndex
+        self.index = SimilarityIndex()
+        self.index.build([("заработок от 5000 в день, пиши в личку", True),
+                          ("во сколько завтра встреча у офиса?", False)])
+        self._patches = [patch.object(main, '_few_shot_index', self.index),
+                         patch.object(main, 'FEW_SHOT_MODE', 'retrieval')]
+        for p in self._patches:
+            p.start()
+
+    def teardown_method(self):
+        for p in self._patches:
+            p.stop()
+
+    def test_system_block_empty_and_examples_in_user_turn(self):
+        import main
+        assert main.get_few_shot_block() == ""
+        xml = main._build_context_xml(3, False, main._similar_for("Заработок от 9000 в день, пиши в личку"))
+        assert xml.startswith("<similar_examples>")
+        assert "→ СПАМ" in xml
+        assert "user_messages_in_group: 3" in xml
+
+    def test_static_mode_has_no_examples(self):
+        import main
+        token = main._few_shot_mode_override.set("static")
+        try:
+            assert main._similar_for("заработок") is None
+        finally:
+            main._few_shot_mode_override.reset(token)
+
+    def test_profile_spam_not_indexed(self):
+        import main
+        main.learn_training_example("Круто", True, spam_type="context")
+        main.learn_training_example("Обычный вопрос про расписание", False)
+        assert len(self.index) == 3
+
+
+@pytest.mark.asyncio
+class TestFewShotBenchmark:
+    async def test_evaluates_both_modes(self):
+        import main
+        seen_modes = []
+
+        async def fake_evaluate(prompt, examples):
+            seen_modes.append(main._few_shot_retrieval())
+            return 0.5, 1, 2, []
+
+        with patch.object(main, 'evaluate_prompt', fake_evaluate), \
+             patch.object(main, 'build_few_shot_block', return_value="Примеры:\n- «x» → СПАМ\n"):
+            report = await main.benchmark_few_shot("p", [("заработок в лс", True), ("привет", False)])
+        assert seen_modes == [False, True]
+        assert report["static"]["accuracy"] == report["retrieval"]["accuracy"] == 0.5
+        assert "static_tokens" in report and "search_p95_ms" in report
+        assert main._few_shot_mode_override.get() is None
+
+
+@pytest.mark.asyncio
+class TestSignalCollection:
+    async def test_timeout_returns_default_and_keeps_task(self):
+        import asyncio
+        import time
+        import main
+
+        async def slow():
+            await asyncio.sleep(0.1)
+            return "Профиль: казино"
+
+        task = asyncio.create_task(slow())
+        assert await main.await_signal("profile", task, time.monotonic() + 0.01, "") == ""
+        assert not task.cancelled()
+        assert await task == "Профиль: казино"
+
+    async def test_failed_signal_returns_default(self):
+        import asyncio
+        import time
+        import main
+
+        async def broken():
+            raise RuntimeError("CAS лежит")
+
+        task = asyncio.create_task(broken())
+        assert await main.await_signal("spam_db", task, time.monotonic() + 1, (False, "")) == (False, "")
+
+    async def test_wait_recorded_per_stage(self):
+        import asyncio
+        import time
+        import main
+        before = main._stage_latency["photo"].count
+        task = asyncio.create_task(asyncio.sleep(0, result="url"))
+        assert await main.await_signal("photo", task, time.monotonic() + 1, None) == "url"
+        assert main._stage_latency["photo"].count == before + 1
+
+
+@pytest.mark.asyncio
+class TestModerationPipeline:
+    def _message(self, text, photo=None):
+        msg = MagicMock()
+        msg.text, msg.caption, msg.photo, msg.document = text, None, photo, None
+        msg.from_user.id, msg.from_user.username = 777, "someone"
+        msg.chat.id, msg.chat.title, msg.message_id = -100, "Группа", 1
+        return msg
+
+    async def test_fingerprint_decides_without_network_signals(self):
+        import main
+        ctx = main.ModerationContext(self._message("x" * 40), "x" * 40, 0)
+        spam_db = AsyncMock(return_value=(False, ""))
+        with patch.object(main.db, 'is_known_spam_text', return_value=True), \
+             patch.object(main, 'check_spam_databases', spam_db):
+            (result, _), stage = await main._moderation_pipeline.run(ctx)
+        assert result == main.SpamResult.SPAM and stage == "fingerprint"
+        spam_db.assert_not_awaited()
+
+    async def test_spam_db_ban_only_for_new_messages(self):
+        import main
+        llm = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, "ok"))
+        with patch.object(main.db, 'is_known_spam_text', return_value=False), \
+             patch.object(main, 'check_spam_databases', AsyncMock(return_value=(True, "CAS"))), \
+             patch.object(main, 'check_user_profile', AsyncMock(return_value="")), \
+             patch.object(main, 'check_message_with_llm', llm):
+            ctx = main.ModerationContext(self._message("новое сообщение", None), "новое сообщение", 0)
+            main._join_prefetch.clear()
+            (result, _), stage = await main._moderation_pipeline.run(ctx)
+            assert result == main.SpamResult.SPAM and stage == "spam_db"
+            llm.assert_not_awaited()
+
+
+    async def test_edit_only_reclassified(self):
+        import main
+        llm = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, "ok"))
+        profile = AsyncMock(return_value="Профиль: крипта")
+        with patch.object(main.db, 'is_known_spam_text', return_value=True), \
+             patch.object(main, 'check_spam_databases', AsyncMock(return_value=(True, "CAS"))), \
+             patch.object(main, 'check_user_profile', profile), \
+             patch.object(main, 'check_message_with_llm', llm):
+            ctx = main.ModerationContext(self._message("x" * 40, None), "x" * 40, 0, is_edit=True,
+                                         edit_context="Раньше текст был: «привет»")
+            main._join_prefetch.clear()
+            (result, _), stage = await main._edit_pipeline.run(ctx)
+        # Ни fingerprint, ни эскалации по спам-базе: вердикт LLM как есть
+        assert result == main.SpamResult.NOT_SPAM and stage == "llm"
+        assert ctx.risk_signals == []
+        profile.assert_not_awaited()
+        # Спам-база и прежний текст — контекст LLM
+        assert llm.await_args.args[3] is True
+        assert llm.await_args.args[5] == "Раньше текст был: «привет»"
+
+
+@pytest.mark.asyncio
+class TestOverloadPolicy:
+    def setup_method(self):
+        import main
+        from admission import AdmissionController
+        self.admission = AdmissionController(max_active=1, max_queue=4, max_wait=0.01)
+        self._patch = patch.object(main, '_admission', self.admission)
+        self._patch.start()
+        self._burst_patch = patch.object(main, 'BURST_WINDOW_MS', 0)
+        self._burst_patch.start()
+        main._overload_queue.clear()
+        main._join_prefetch.clear()
+
+    def teardown_method(self):
+        import main
+        self._patch.stop()
+        self._burst_patch.stop()
+        main._overload_queue.clear()
+
+    def _ctx(self, text, user_msg_count):
+        import main
+        msg = MagicMock()
+        msg.text, msg.caption, msg.photo, msg.document = text, None, None, None
+        msg.from_user.id, msg.from_user.username = 555, "someone"
+        msg.chat.id, msg.chat.title, msg.message_id = -100, "Группа", 7
+        return main.ModerationContext(msg, text, user_msg_count)
+
+    async def _run(self, ctx, in_spam_db=False):
+        import main
+        llm = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, "ok"))
+        with patch.object(main.db, 'is_known_spam_text', return_value=False), \
+             patch.object(main, 'check_spam_databases', AsyncMock(return_value=(in_spam_db, "CAS"))), \
+             patch.object(main, 'check_user_profile', AsyncMock(return_value="")), \
+             patch.object(main, 'check_message_with_llm', llm):
+            verdict, _ = await main._moderation_pipeline.run(ctx)
+        return verdict, llm
+
+    async def test_history_user_deferred_without_waiting(self):
+        import main
+        await self.admission.acquire()  # LLM-стадия занята
+        ctx = self._ctx("обычный вопрос про группу", 1)
+        (result, reasoning), llm = await self._run(ctx)
+        assert result == main.SpamResult.NOT_SPAM and reasoning == main.OVERLOAD_REASON
+        assert ctx.shed and self.admission.shed_no_wait == 1
+        llm.assert_not_awaited()
+
+    async def test_shed_not_spam_is_not_stored_as_verdict(self):
+        import main
+        await self.admission.acquire()
+        ctx = self._ctx("обычный вопрос про группу", 1)
+        (result, _), _ = await self._run(ctx)
+        # «Не спам» без LLM — не метка: NULL до перепроверки
+        assert result == main.SpamResult.NOT_SPAM
+        assert main._stored_verdict(ctx, result) is None
+        assert main._stored_verdict(self._ctx("вопрос", 1), result) == "НЕ_СПАМ"
+
+    async def test_new_user_decided_by_signals(self):
+        import main
+        await self.admission.acquire()
+        # Новый пользователь в спам-базе: ждёт допуска, не дожидается, банится по сигналу
+        ctx = self._ctx("заработок без вложений", 0)
+        ctx.is_edit = True  # правка: DB-BAN без LLM не срабатывает, решает эскалация
+        (result, _), llm = await self._run(ctx, in_spam_db=True)
+        assert result == main.SpamResult.SPAM
+        assert self.admission.shed_timeout == 1
+        llm.assert_not_awaited()
+
+    async def test_deferred_check_runs_when_load_drops(self):
+        import main
+        await self.admission.acquire()
+        ctx = self._ctx("купи крипту у меня", 2)
+        await self._run(ctx)
+        main.defer_overload_check(ctx)
+        await main._recheck_overloaded()
+        assert len(main._overload_queue) == 1  # ещё перегрузка — ждём
+
+        await self.admission.release()
+        llm = AsyncMock(return_value=(main.SpamResult.SPAM, "крипта"))
+        with patch.object(main, 'check_message_with_llm', llm), \
+             patch.object(main, 'update_message_record_after_edit'), \
+             patch.object(main, 'ban_and_report', AsyncMock()) as ban:
+            await main._recheck_overloaded()
+        assert len(main._overload_queue) == 0
+        ban.assert_awaited_once()
+        assert self.admission.active == 0
+
+
+@pytest.mark.asyncio
+class TestLLMPriority:
+    async def test_priority_by_kind(self):
+        import main
+        assert main._priority_for("text") == main.LIVE_TEXT
+        assert main._priority_for("vision") == main.LIVE_VISION
+        assert main._priority_for("generation") == main.GENERATION
+        with main.llm_priority(main.EVALUATION):
+            assert main._priority_for("text") == main.EVALUATION
+        assert main._priority_for("text") == main.LIVE_TEXT
+
+    async def test_evaluation_calls_use_evaluation_class(self):
+        import main
+        seen = []
+
+        async def fake_classify(prompt, text, few_shot=""):
+            seen.append(main._priority_for("text"))
+            return main.SpamResult.SPAM, ""
+
+        with patch.object(main, 'classify_message', fake_classify), \
+             patch.object(main, 'get_few_shot_block', return_value=""):
+            accuracy, *_ = await main.evaluate_prompt("p", [("a", True), ("b", True)])
+        assert accuracy == 1.0
+        assert seen == [main.EVALUATION] * 2
+        assert main._priority_for("text") == main.LIVE_TEXT
+
+
+@pytest.mark.asyncio
+class TestBurstCoalescing:
+    def _ctx(self, text, message_id):
+        import main
+        msg = MagicMock()
+        msg.text, msg.caption, msg.photo, msg.document = text, None, None, None
+        msg.from_user.id, msg.from_user.username = 999, "splitter"
+        msg.chat.id, msg.chat.title, msg.message_id = -100, "Группа", message_id
+        return main.ModerationContext(msg, text, 0)
+
+    async def test_split_message_classified_together(self):
+        import asyncio
+        import main
+        from batching import BurstCoalescer
+        llm = AsyncMock(return_value=(main.SpamResult.SPAM, "реклама заработка"))
+        coalescer = BurstCoalescer(main._classify_burst, window=0.05, max_wait=1)
+        main._join_prefetch.clear()
+        with patch.object(main, '_burst_coalescer', coalescer), \
+             patch.object(main, 'BURST_WINDOW_MS', 50), \
+             patch.object(main.db, 'is_known_spam_text', return_value=False), \
+             patch.object(main, 'check_spam_databases', AsyncMock(return_value=(False, ""))), \
+             patch.object(main, 'check_user_profile', AsyncMock(return_value="")), \
+             patch.object(main, 'check_message_with_llm', llm):
+            ctxs = [self._ctx("Всем привет!", 1), self._ctx("Есть удалёнка", 2), self._ctx("пишите в лс", 3)]
+            verdicts = await asyncio.gather(*[main._moderation_pipeline.run(c) for c in ctxs])
+        llm.assert_awaited_once()
+        assert llm.await_args.args[0] == "Всем привет!\nЕсть удалёнка\nпишите в лс"
+        assert all(v[0][0] == main.SpamResult.SPAM for v in verdicts)
+        assert verdicts[0][0][1].startswith("[серия из 3 сообщений]")
+        assert ctxs[0].burst is ctxs[2].burst
+        assert [main._burst_claim(c, "ban") for c in ctxs] == [True, False, False]
+        assert main._burst_claim(self._ctx("одиночное", 4), "ban")
+
+    async def test_ban_deletes_unsaved_burst_parts(self):
+        import main
+        ctxs = [self._ctx("Всем привет!", 1), self._ctx("Есть удалёнка", 2), self._ctx("пишите в лс", 3)]
+        burst = {"size": 3, "items": ctxs, "claimed": set()}
+        for c in ctxs:
+            c.burst = burst
+            c.message.sender_chat = None
+        # Забанить выпало второй части; остальные ещё не сохранены в БД
+        series = main._burst_messages(ctxs[1])
+        assert [m.text for m in series] == ["Всем привет!", "Есть удалёнка", "пишите в лс"]
+        bot = MagicMock()
+        bot.delete_message = AsyncMock()
+        bot.ban_chat_member = AsyncMock()
+        bot.send_message = AsyncMock()
+        with patch.object(main, 'bot', bot), \
+             patch.object(main.db, 'has_user_old_activity', return_value=False), \
+             patch.object(main.db, 'get_user_messages', return_value=[]), \
+             patch.object(main.db, 'save_banned_profile'), \
+             patch.object(main, 'ban_user_in_all_groups', AsyncMock(return_value=([], []))), \
+             patch.object(main, '_get_profile_data', AsyncMock(return_value={})), \
+             patch.object(main, '_report_reasoning', AsyncMock(return_value="")):
+            await main.ban_and_report(ctxs[1].message, main.SpamResult.SPAM, "", series=series)
+        deleted = sorted(call.args[1] for call in bot.delete_message.await_args_list)
+        assert deleted == [1, 2, 3]
+        report = bot.send_message.await_args.args[1]
+        assert "Всем привет!\nЕсть удалёнка\nпишите в лс" in report
+
+    async def test_shed_burst_marks_every_message(self):
+        import main
+        ctxs = [self._ctx("Всем привет!", 1), self._ctx("пишите в лс", 2)]
+        with patch.object(main._admission, 'acquire', AsyncMock(return_value=False)):
+            result, _ = await main._classify_contexts(ctxs)
+        assert result == main.SpamResult.MAYBE_SPAM
+        assert all(c.shed for c in ctxs)
+
+
+@pytest.mark.asyncio
+class TestRiskScoreStage:
+    def _ctx(self, text="Пишите в лс @earn_money_bot https://t.me/x"):
+        import main
+        msg = MagicMock()
+        msg.text, msg.caption, msg.photo, msg.document = text, None, None, None
+        msg.from_user.id, msg.from_user.username = 999, "newbie"
+        msg.chat.id, msg.chat.title, msg.message_id = -100, "Группа", 1
+        return main.ModerationContext(msg, text, 0)
+
+    def _scorer(self):
+        from risk_scorer import RiskScorer
+        return RiskScorer({"spam_db": 4.0, "link": 1.5, "mention": 1.0}, bias=-1.0,
+                          ban_threshold=3.0, pass_threshold=-0.5, report={"calibrated": True})
+
+    async def _run(self, mode, ctx, in_spam_db=False, profile=None, scorer=None):
+        import main
+        llm = AsyncMock(return_value=(main.SpamResult.NOT_SPAM, "обычное сообщение"))
+        main._join_prefetch.clear()
+        with patch.object(main, '_risk_scorer', scorer or self._scorer()), \
+             patch.object(main, 'RISK_SCORER_MODE', mode), \
+             patch.object(main, 'BURST_WINDOW_MS', 0), \
+             patch.object(main, 'PROFILE_CONTEXT_WAIT_SECONDS', 0), \
+             patch.object(main.db, 'is_known_spam_text', return_value=False), \
+             patch.object(main, 'check_spam_databases', AsyncMock(return_value=(in_spam_db, "CAS"))), \
+             patch.object(main, 'check_user_profile', profile or AsyncMock(return_value="")), \
+             patch.object(main, 'check_message_with_llm', llm):
+            (result, reasoning), stage = await main._moderation_pipeline.run(ctx)
+        return result, reasoning, stage, llm
+
+    async def test_on_mode_skips_llm_and_explains(self):
+        import main
+        ctx = self._ctx()
+        ctx.is_edit = True  # правка: спам-база не банит сразу, доходит до сигналов
+        avoided = main._perf_counters["risk_llm_avoided"]
+        result, reasoning, stage, llm = await self._run("on", ctx, in_spam_db=True)
+        assert stage == "risk_score" and result == main.SpamResult.SPAM
+        llm.assert_not_awaited()
+        assert "спам-база +4.00" in reasoning
+        assert main._perf_counters["risk_llm_avoided"] == avoided + 1
+
+    async def test_shadow_mode_only_records(self):
+        import main
+        ctx = self._ctx("Кто идёт на встречу завтра?")
+        result, _, stage, llm = await self._run("shadow", ctx)
+        llm.assert_awaited_once()
+        assert stage != "risk_score" and ctx.risk_decision is False
+        disagree = main._perf_counters["risk_shadow_disagree"]
+        with patch.object(main.db, 'set_risk_features') as save, \
+             patch.object(main, '_risk_scorer', self._scorer()):
+            main._record_risk_outcome(ctx, main.SpamResult.SPAM, stage)
+        assert main._perf_counters["risk_shadow_disagree"] == disagree + 1
+        import json
+        saved = json.loads(save.call_args.args[2])
+        assert saved["by"] == stage and saved["f"]["no_history"] == 1 and saved["f"]["link"] == 0
+
+    async def test_on_mode_waits_for_late_profile(self):
+        import asyncio
+        import main
+        from risk_scorer import RiskScorer
+
+        async def slow_profile(uid):
+            await asyncio.sleep(0.05)
+            return "Профиль: крипта"
+
+        scorer = RiskScorer({"profile": 5.0}, bias=-1.0, ban_threshold=3.0, pass_threshold=-0.5,
+                            report={"calibrated": True})
+        ctx = self._ctx("Всем привет")
+        result, reasoning, stage, llm = await self._run("on", ctx, profile=slow_profile, scorer=scorer)
+        # Без профиля был бы пропуск; с ним — бан
+        assert stage == "risk_score" and result == main.SpamResult.SPAM
+        assert "профиль +5.00" in reasoning
+        assert [s for s, _ in ctx.risk_signals] == ["Профиль: крипта"]
+        llm.assert_not_awaited()
+
+    async def test_uncertain_score_goes_to_llm(self):
+        ctx = self._ctx("посмотрите https://example.com")
+        _, _, stage, llm = await self._run("on", ctx)
+        llm.assert_awaited_once()
+        assert ctx.risk_decision is None
+
+
+class TestLocalTrainingExamples:
+    def test_only_model_and_admin_labels(self):
+        import main
+        rows = [
+            ("решил llm", '{"f": {}, "by": "llm"}', False, False),
+            ("эскалация", '{"f": {}, "by": "escalation"}', True, False),
+            ("решил риск-скор", '{"f": {}, "by": "risk_score"}', True, False),
+            ("без модели", '{"f": {}, "by": "fallback"}', False, False),
+            ("подтвердил админ", '{"f": {}, "by": "fallback"}', True, True),
+            ("старая запись", None, True, True),
+        ]
+        with patch.object(main.db, 'get_labeled_messages', return_value=rows), \
+             patch.object(main.db, 'get_all_training_examples', return_value=[]):
+            examples = dict(main._local_training_examples())
+        assert examples == {"решил llm": False, "эскалация": True, "подтвердил админ": True, "старая запись": True}
+
+    def test_fallback_verdicts_are_not_model_verdicts(self):
+        import main
+        assert main._is_model_verdict("ссылка на казино")
+        assert not main._is_model_verdict(f"{main.LOCAL_VERDICT_PREFIX} спам (log-odds +5.0)")
+        assert not main._is_model_verdict(main.RATE_LIMIT_TRUSTED_REASON)
+        assert not main._is_model_verdict(f"[серия из 2 сообщений] {main.OVERLOAD_REASON}")
+
+
+@pytest.mark.asyncio
+class TestLocalRetrain:
+    async def test_learned_during_training_replayed(self):
+        import main
+        from local_classifier import LocalClassifier
+        clf = LocalClassifier()
+
+        def examples():
+            # Решение админа приходит, пока идёт обучение
+            main.learn_training_example("продаю аккаунты оптом", True, "text")
+            return [("спам", True), ("не спам", False)]
+
+        with patch.object(main, '_local_classifier', clf), \
+             patch.object(main, '_few_shot_index', MagicMock()), \
+             patch.object(main, '_local_training_examples', examples), \
+             patch.object(main, 'LOCAL_CLASSIFIER_MIN_PER_CLASS', 1):
+            report = await main.train_local_classifier()
+        assert report["examples"] == 2
+        assert clf.model.docs == [1, 2]
+
+
+class TestRiskTrainingRows:
+    def test_own_decisions_excluded_unless_confirmed(self):
+        import main
+        rows = [
+            ('{"f": {"link": 1}, "by": "llm"}', True, False),
+            ('{"f": {"spam_db": 1}, "by": "risk_score"}', True, False),
+            ('{"f": {"photo": 1}, "by": "risk_score"}', False, True),
+            ('not json', True, True),
+        ]
+        with patch.object(main.db, 'get_risk_dataset', return_value=rows):
+            assert main._risk_training_rows() == [({"link": 1}, True), ({"photo": 1}, False)]
+
+
+@pytest.mark.asyncio
+class TestDedupMiddleware:
+    async def test_duplicate_update_never_reaches_handler(self):
+        import main
+        from dedup import UpdateDeduplicator
+        update = MagicMock()
+        update.update_id = 42
+        update.edited_message = None
+        update.message.chat.id, update.message.message_id, update.message.edit_date = -100, 7, None
+        handler = AsyncMock(return_value="ok")
+        with patch.object(main, '_update_dedup', UpdateDeduplicator()):
+            assert await main.dedup_middleware(handler, update, {}) == "ok"
+            assert await main.dedup_middleware(handler, update, {}) is None
+            assert main._update_dedup.duplicates == 1
+        handler.assert_awaited_once()
+
+    async def test_failed_handler_lets_redelivery_through(self):
+        import main
+        from dedup import UpdateDeduplicator
+        update = MagicMock()
+        update.update_id = 43
+        update.edited_message = None
+        update.message.chat.id, update.message.message_id, update.message.edit_date = -100, 8, None
+        rows = set()
+        handler = AsyncMock(side_effect=[RuntimeError("telegram timeout"), "ok"])
+        dedup = UpdateDeduplicator(is_processed=rows.__contains__, mark_processed=rows.add)
+        with patch.object(main, '_update_dedup', dedup):
+            with pytest.raises(RuntimeError):
+                await main.dedup_middleware(handler, update, {})
+            assert not rows
+            assert await main.dedup_middleware(handler, update, {}) == "ok"
+        assert rows == {"m:-100:8:0"}
+        assert handler.await_count == 2
@@ -0,0 +1,73 @@
+"""Тесты для metrics.py — задержки и учёт токенов prefix-кеша."""
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import LatencyWindow, LLMUsageStats, extract_usage
+
+
+class TestLatencyWindow:
+    def test_percentiles(self):
+        w = LatencyWindow()
+        for v in range(1, 101):
+            w.add(v / 100)
+        assert w.percentile(50) == 0.51
+        assert w.percentile(100) == 1.0
+        assert w.percentile(0) == 0.01
+        assert abs(w.avg - 0.505) < 1e-9
+
+    def test_empty(self):
+        w = LatencyWindow()
+        assert w.percentile(95) == 0.0
+        assert w.avg == 0.0
+
+    def test_window_is_bounded(self):
+        w = LatencyWindow(maxlen=3)
+        for v in (10, 1, 2, 3):
+            w.add(v)
+        assert len(w) == 3
+        assert w.percentile(100) == 3
+        assert w.count == 4
+
+
+class TestExtractUsage:
+    def test_with_cached_tokens(self):
+        resp = SimpleNamespace(usage=SimpleNamespace(
+            prompt_tokens=1200, completion_tokens=30,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=1024),
+        ))
+        assert extract_usage(resp) == (1200, 1024, 30)
+
+    def test_provider_without_details(self):
+        resp = SimpleNamespace(usage=SimpleNamespace(prompt_tokens=50, completion_tokens=5))
+        assert extract_usage(resp) == (50, 0, 5)
+
+    def test_no_usage(self):
+        assert extract_usage(SimpleNamespace()) == (0, 0, 0)
+
+
+class TestLLMUsageStats:
+    def test_split_cached_uncached(self):
+        s = LLMUsageStats()
+        s.record("text", 0.2, prompt_tokens=1000, cached_tokens=0)
+        s.record("text", 0.1, prompt_tokens=1000, cached_tokens=900)
+        st = s.by_kind["text"]
+        assert st.calls == 2
+        assert st.cached_calls == 1
+        assert st.cache_hit_ratio == 0.45
+        assert st.latency_cached.percentile(50) == 0.1
+        assert st.latency_uncached.percentile(50) == 0.2
+        assert any("text" in line for line in s.report_lines())
+
+    def test_per_kind_accessors_do_not_create_entries(self):
+        s = LLMUsageStats()
+        assert s.calls("explain") == 0
+        assert s.avg_completion_tokens("explain") == 0.0
+        assert s.latency_percentile("explain", 50) == 0.0
+        assert "explain" not in s.by_kind
+        s.record("explain", 0.3, completion_tokens=40)
+        s.record("explain", 0.1, cached_tokens=10, completion_tokens=20)
+        assert s.avg_completion_tokens("explain") == 30
+        assert s.latency_percentile("explain", 100) == 0.3
@@ -0,0 +1,121 @@
+"""Тесты для pipeline.py — ранний выход, порядок стадий, статистика."""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Pipeline, Stage
+
+
+def _stage(name, verdict=None, calls=None, **kwargs):
+    async def fn(ctx):
+        if calls is not None:
+            calls.append(name)
+        return verdict
+    return Stage(name, fn, **kwargs)
+
+
+def _ctx():
+    return SimpleNamespace()
+
+
+@pytest.mark.asyncio
+class TestPipelineRun:
+    async def test_short_circuit_stops_pipeline(self):
+        calls = []
+        p = Pipeline([
+            _stage("cheap", None, calls, cost_ms=1),
+            _stage("hit", "spam", calls, cost_ms=2),
+            _stage("expensive", "ham", calls, cost_ms=100),
+        ])
+        ctx = _ctx()
+        assert await p.run(ctx) == ("spam", "hit")
+        assert calls == ["cheap", "hit"]
+        assert ctx.decided_by == "hit"
+        assert p.stats["hit"].hits == 1 and p.stats["expensive"].runs == 0
+
+    async def test_non_short_circuit_verdict_can_be_refined(self):
+        async def escalate(ctx):
+            return ctx.verdict + "+escalated"
+        p = Pipeline([
+            _stage("llm", "maybe", cost_ms=100, short_circuit=False),
+            Stage("escalation", escalate, cost_ms=0, short_circuit=False),
+        ])
+        assert await p.run(_ctx()) == ("maybe+escalated", "escalation")
+        assert p.stats["llm"].hits == 0
+        assert p.stats["llm"].verdicts == {"maybe": 1}
+
+    async def test_stage_skipped_when_not_applicable(self):
+        calls = []
+        p = Pipeline([
+            _stage("forward", "spam", calls, cost_ms=1, applies=lambda ctx: ctx.is_forward),
+            _stage("llm", "ham", calls, cost_ms=100),
+        ])
+        ctx = _ctx()
+        ctx.is_forward = False
+        assert await p.run(ctx) == ("ham", "llm")
+        assert calls == ["llm"]
+        assert p.stats["forward"].runs == 0
+
+    async def test_failed_stage_is_counted_and_propagates(self):
+        async def broken(ctx):
+            raise RuntimeError("db down")
+        p = Pipeline([Stage("db", broken, cost_ms=1)])
+        with pytest.raises(RuntimeError):
+            await p.run(_ctx())
+        assert p.stats["db"].runs == 1 and p.stats["db"].latency.count == 1
+
+    async def test_verdict_label(self):
+        p = Pipeline([_stage("hit", ("СПАМ", "reason"), cost_ms=1)], label=lambda v: v[0])
+        await p.run(_ctx())
+        assert p.stats["hit"].verdicts == {"СПАМ": 1}
+
+
+class TestPipelineOrder:
+    def _stages(self):
+        return [
+            _stage("db", cost_ms=300, reorderable=True),
+            _stage("fingerprint", cost_ms=1, reorderable=True),
+            _stage("llm", cost_ms=1500),
+            _stage("escalation", cost_ms=0),
+        ]
+
+    def test_cheap_stages_by_declared_cost(self):
+        p = Pipeline(self._stages())
+        assert [s.name for s in p.ordered()] == ["fingerprint", "db", "llm", "escalation"]
+
+    def test_explicit_order(self):
+        p = Pipeline(self._stages(), order=["db", "unknown"])
+        assert p.order == ["db"]
+        assert [s.name for s in p.ordered()] == ["db", "fingerprint", "llm", "escalation"]
+
+    def test_adaptive_order_by_savings_per_cost(self):
+        p = Pipeline(self._stages(), adaptive=True, adaptive_min_runs=10)
+        # fingerprint: 1% срабатываний за 1 мс; db: 50% за 300 мс
+        for name, runs, hits, latency in (("fingerprint", 100, 1, 0.001), ("db", 100, 50, 0.3)):
+            st = p.stats[name]
+            st.runs, st.hits = runs, hits
+            for _ in range(runs):
+                st.latency.add(latency)
+        assert [s.name for s in p.ordered()][:2] == ["fingerprint", "db"]
+        # db стал быстрым — его экономия на миллисекунду выше
+        p.stats["db"].latency = type(p.stats["db"].latency)()
+        for _ in range(100):
+            p.stats["db"].latency.add(0.002)
+        assert [s.name for s in p.ordered()][:2] == ["db", "fingerprint"]
+
+    def test_adaptive_explores_stages_without_stats_first(self):
+        p = Pipeline(self._stages(), adaptive=True, adaptive_min_runs=10)
+        p.stats["fingerprint"].runs = 100
+        for _ in range(100):
+            p.stats["fingerprint"].latency.add(0.001)
+        assert p.ordered()[0].name == "db"
+
+    def test_report(self):
+        p = Pipeline(self._stages())
+        report = p.report()
+        assert [r["name"] for r in report] == ["fingerprint", "db", "llm", "escalation"]
+        assert report[0]["reorderable"] and report[0]["runs"] == 0
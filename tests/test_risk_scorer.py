@@ -0,0 +1,84 @@
+"""Тесты для risk_scorer.py — подбор весов, пороги, объяснение скора."""
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from risk_scorer import FEATURES, RiskScorer, fit, fit_weights
+
+
+def _dataset(n_each=400, seed=1):
+    """Спам: спам-база/документ/ссылка чаще; чистые — почти без сигналов."""
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(n_each):
+        rows.append(({
+            "spam_db": rng.random() < 0.4, "dangerous_document": rng.random() < 0.1,
+            "no_history": rng.random() < 0.9, "link": rng.random() < 0.7, "profile": rng.random() < 0.5,
+        }, True))
+        rows.append(({
+            "no_history": rng.random() < 0.2, "link": rng.random() < 0.1, "photo": rng.random() < 0.2,
+        }, False))
+    rng.shuffle(rows)
+    return rows
+
+
+class TestFitWeights:
+    def test_learns_signal_direction(self):
+        weights, bias = fit_weights(_dataset())
+        assert weights["spam_db"] > 1
+        assert weights["link"] > 0 and weights["no_history"] > 0
+        assert weights["photo"] < 0
+        # Не встречавшийся признак остаётся нулевым (L2)
+        assert weights["forward"] == 0
+
+    def test_empty(self):
+        weights, bias = fit_weights([])
+        assert bias == 0 and set(weights) == set(FEATURES)
+
+
+class TestRiskScorer:
+    def test_uncalibrated_defers_to_llm(self):
+        scorer = RiskScorer({"spam_db": 10.0})
+        assert not scorer.ready
+        assert scorer.decide({"spam_db": 1}) == (None, 0.0)
+
+    def test_fit_calibrates_and_decides(self):
+        scorer = fit(_dataset(), target_fpr=0.01, target_fnr=0.02)
+        report = scorer.report
+        assert scorer.ready
+        assert report["fpr"] <= 0.01 and report["fnr"] <= 0.02
+        assert report["coverage"] > 0
+        assert scorer.decide({"spam_db": 1, "link": 1, "no_history": 1, "profile": 1})[0] is True
+        assert scorer.decide({})[0] is False
+
+    def test_thresholds_from_out_of_fold_scores(self):
+        rows = _dataset()
+        scorer = fit(rows, folds=4)
+        report = scorer.report
+        # Каждый пример оценён ровно один раз — моделью без его фолда
+        assert report["folds"] == 4
+        assert report["scored_spam"] + report["scored_ham"] == len(rows)
+
+    def test_too_little_data(self):
+        scorer = fit(_dataset(n_each=20))
+        assert not scorer.ready and not scorer.report["calibrated"]
+
+    def test_audit_lists_contributions(self):
+        scorer = RiskScorer({"spam_db": 3.0, "link": 0.5}, bias=-2.0, ban_threshold=1.0, pass_threshold=-1.0,
+                            report={"calibrated": True})
+        features = {"spam_db": 1, "link": 1}
+        assert scorer.score(features) == 1.5
+        audit = scorer.audit(features)
+        assert audit.startswith("риск-скор +1.50 (бан ≥ +1.00, пропуск ≤ -1.00)")
+        # Сначала самый весомый сигнал
+        assert audit.index("спам-база +3.00") < audit.index("ссылка +0.50")
+        assert "база -2.00" in audit
+
+    def test_json_roundtrip(self):
+        scorer = RiskScorer({"link": 0.7}, bias=-1.0, report={"calibrated": False})
+        restored = RiskScorer.from_json(scorer.to_json())
+        assert restored.weights == scorer.weights and restored.bias == -1.0
+        assert restored.ban_threshold == math.inf and restored.pass_threshold == -math.inf
@@ -0,0 +1,59 @@
+"""Тесты для similarity_index.py — поиск похожих размеченных примеров."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from similarity_index import SimilarityIndex
+
+EXAMPLES = [
+    ("Заработок от 5000 в день, пиши в личку", True),
+    ("Набираю команду на удалёнку, доход от 300$ в неделю", True),
+    ("Продаю аккаунты телеграм оптом", True),
+    ("Во сколько завтра встреча у офиса?", False),
+    ("Спасибо за лекцию, пришлите слайды", False),
+    ("Кто едет на дачу в субботу, есть место в машине", False),
+]
+
+
+def _index():
+    index = SimilarityIndex()
+    index.build(EXAMPLES)
+    return index
+
+
+class TestSimilarityIndex:
+    def test_nearest_is_most_similar(self):
+        found = _index().search("Заработок от 7000 в день, пишите в личку", k=2, min_score=0.0)
+        assert found[0][0] == "Заработок от 5000 в день, пиши в личку"
+        assert found[0][1] is True
+        assert found[0][2] > found[-1][2]
+
+    def test_exact_text_excluded(self):
+        found = _index().search("Продаю аккаунты телеграм оптом", k=6, min_score=0.0)
+        assert all(text != "Продаю аккаунты телеграм оптом" for text, _, _ in found)
+
+    def test_min_score_filters_unrelated(self):
+        assert _index().search("qwerty zxcv", k=3, min_score=0.3) == []
+
+    def test_incremental_add_and_label_update(self):
+        index = _index()
+        index.add("Бесплатные курсы по криптовалюте, ссылка в профиле", True)
+        assert len(index) == len(EXAMPLES) + 1
+        found = index.search("Бесплатные курсы по криптовалюте тут", k=1)
+        assert found[0][0].startswith("Бесплатные курсы")
+        index.add("Бесплатные курсы по криптовалюте, ссылка в профиле", False)
+        assert len(index) == len(EXAMPLES) + 1
+        assert index.search("Бесплатные курсы по криптовалюте тут", k=1)[0][1] is False
+
+    def test_generation_changes_with_examples(self):
+        index = _index()
+        gen = index.generation
+        index.add("Бесплатные курсы по криптовалюте", True)
+        index.add("Бесплатные курсы по криптовалюте", True)  # повтор без изменений
+        assert index.generation == gen + 1
+        index.add("Бесплатные курсы по криптовалюте", False)
+        assert index.generation == gen + 2
+
+    def test_empty_index(self):
+        assert SimilarityIndex().search("что угодно") == []
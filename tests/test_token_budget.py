@@ -0,0 +1,60 @@
+"""Тесты для token_budget.py — подсчёт токенов и урезание под бюджет."""
+import os
+import sys
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_budget
+from token_budget import count_message_tokens, count_tokens, fit_examples, truncate_to_budget
+
+
+class TestCountTokens:
+    def test_empty(self):
+        assert count_tokens("") == 0
+
+    def test_heuristic_without_tiktoken(self):
+        with patch.object(token_budget, "tiktoken", None):
+            token_budget._encoding.cache_clear()
+            assert count_tokens("a" * 400) == 101
+            # кириллица «дороже» латиницы
+            assert count_tokens("я" * 100) > count_tokens("a" * 100)
+        token_budget._encoding.cache_clear()
+
+    def test_messages_add_overhead(self):
+        msgs = [{"role": "system", "content": "abc"}, {"role": "user", "content": [{"type": "text", "text": "abc"}]}]
+        assert count_message_tokens(msgs) == 2 * (count_tokens("abc") + 4)
+
+
+class TestTruncateToBudget:
+    def test_short_text_untouched(self):
+        text = "привет, как дела"
+        assert truncate_to_budget(text, 100) is text
+
+    def test_keeps_head_tail_and_links(self):
+        middle = " ".join(["слово"] * 400)
+        text = "НАЧАЛО " + middle + " https://t.me/scam_link @scam_admin " + middle + " КОНЕЦ"
+        out = truncate_to_budget(text, 120)
+        assert count_tokens(out) <= 125
+        assert out.startswith("НАЧАЛО")
+        assert "КОНЕЦ" in out
+        assert "https://t.me/scam_link" in out
+        assert "@scam_admin" in out
+
+    def test_no_extras_line_when_links_already_kept(self):
+        text = "https://t.me/x " + "а" * 3000
+        out = truncate_to_budget(text, 100)
+        assert out.count("https://t.me/x") == 1
+
+
+class TestFitExamples:
+    def test_trims_long_examples(self):
+        out = fit_examples([("a" * 1000, True)], budget_tokens=0, max_example_tokens=10)
+        assert count_tokens(out[0][0]) <= 11
+        assert out[0][0].endswith("…")
+
+    def test_drops_oldest_over_budget(self):
+        examples = [(f"пример номер {i} " * 3, i % 2 == 0) for i in range(10)]
+        out = fit_examples(examples, budget_tokens=60, max_example_tokens=40)
+        assert 0 < len(out) < 10
+        assert out == [(t, s) for t, s in examples[:len(out)]]
@@ -0,0 +1,127 @@
+"""
+Локальный подсчёт токенов и урезание текста под бюджет.
+
+Если установлен tiktoken — считаем токенизатором целевой модели (для
+неизвестных моделей — o200k_base, словарь gpt-4o/gpt-5). Без него —
+эвристика по символам: для бюджета достаточно оценки, ошибка в пределах
+~20% на смеси русского и английского.
+
+truncate_to_budget() обрезает длинное сообщение, сохраняя начало, конец
+и все ссылки/упоминания — именно в них обычно полезная нагрузка спама.
+"""
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # опциональная зависимость
+    tiktoken = None
+
+_URL_RE = re.compile(r"(?:https?://|www\.|t\.me/)\S+", re.I)
+_MENTION_RE = re.compile(r"@\w{4,}")
+# Служебные токены на одно сообщение chat-формата (role, разделители)
+_TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _heuristic_tokens(text: str) -> int:
+    # BPE-словари: латиница ~4 символа на токен, кириллица и прочее ~2.5
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) / 2.5) + 1
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    if not text:
+        return 0
+    enc = _encoding(model)
+    if enc is None:
+        return _heuristic_tokens(text)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list, model: str = "") -> int:
+    """Оценка prompt_tokens для chat.completions (картинки не считаются)."""
+    total = 0
+    for msg in messages:
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += _TOKENS_PER_MESSAGE + count_tokens(content or "", model)
+    return total
+
+
+def _prefix_within(text: str, max_tokens: int, model: str) -> str:
+    """Самый длинный префикс text, укладывающийся в max_tokens (бинпоиск по символам)."""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid], model) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def _suffix_within(text: str, max_tokens: int, model: str) -> str:
+    """Самый длинный суффикс text, укладывающийся в max_tokens."""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if count_tokens(text[mid:], model) <= max_tokens:
+            hi = mid
+        else:
+            lo = mid + 1
+    return text[lo:]
+
+
+def truncate_to_budget(text: str, max_tokens: int, model: str = "", head_share: float = 0.65) -> str:
+    """Урезать text до max_tokens: начало + конец + все ссылки и упоминания.
+
+    Ссылки/упоминания из вырезанной середины дописываются отдельной строкой
+    (каждое один раз), остаток бюджета делится между началом и концом.
+    """
+    if not text or max_tokens <= 0 or count_tokens(text, model) <= max_tokens:
+        return text
+
+    extras = list(dict.fromkeys(_URL_RE.findall(text) + _MENTION_RE.findall(text)))
+    extras_line = ""
+    if extras:
+        extras_line = _prefix_within("\n[ссылки и упоминания: " + " ".join(extras), max_tokens // 3, model) + "]"
+    marker = " … "
+    remaining = max_tokens - count_tokens(extras_line, model) - count_tokens(marker, model)
+    head = _prefix_within(text, int(remaining * head_share), model)
+    tail = _suffix_within(text[len(head):], remaining - count_tokens(head, model), model)
+    # Ссылки, целиком попавшие в начало/конец, повторять незачем
+    kept = head + tail
+    if extras and all(e in kept for e in extras):
+        extras_line = ""
+    return head.rstrip() + marker + tail.lstrip() + extras_line
+
+
+def fit_examples(examples: list, budget_tokens: int, max_example_tokens: int, model: str = "",
+                 render=lambda text, is_spam: text) -> list:
+    """Подогнать few-shot примеры [(text, is_spam), ...] под бюджет.
+
+    Каждый пример урезается до max_example_tokens; если сумма строк
+    render(text, is_spam) не влезает в budget_tokens — хвост списка (самые
+    старые примеры) отбрасывается. Порядок сохраняется.
+    """
+    fitted, used = [], 0
+    for text, is_spam in examples:
+        if count_tokens(text, model) > max_example_tokens:
+            text = _prefix_within(text, max_example_tokens, model).rstrip() + "…"
+        cost = count_tokens(render(text, is_spam), model)
+        if budget_tokens and used + cost > budget_tokens:
+            break
+        fitted.append((text, is_spam))
+        used += cost
+    return fitted